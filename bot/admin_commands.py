@@ -0,0 +1,115 @@
+import discord
+from discord.ext import commands
+import logging
+log = logging.getLogger(__name__)
+
+from .commands import Commands
+from .async_database import AsyncDatabase
+from .permissions import check_user, can_manage_admins
+
+class AdminCommands(Commands):
+    """
+    Commands for choosing which roles make someone a bot admin in a server,
+    and the listeners that keep the cache of who is an admin up to date
+    """
+
+    def __init__(self, database: AsyncDatabase):
+        self.database = database
+
+    def setup(self, bot):
+        bot.add_listener(self.on_member_update, "on_member_update")
+        bot.add_listener(self.on_member_remove, "on_member_remove")
+        bot.add_listener(self.on_guild_role_delete, "on_guild_role_delete")
+        bot.add_listener(self.on_guild_remove, "on_guild_remove")
+
+        admin_group = self.group(bot, self.admin_group_entry, name="admin")
+        self.command(admin_group, self.list_roles, name="roles")
+        self.command(admin_group, self.add_role, name="add")
+        self.command(admin_group, self.remove_role, name="remove")
+
+    async def on_member_update(self, before, after):
+        if before.roles != after.roles:
+            self.database.admin_roles.forget_member(after.guild.id, after.id)
+
+    async def on_member_remove(self, member):
+        self.database.admin_roles.forget_member(member.guild.id, member.id)
+
+    async def on_guild_role_delete(self, role):
+        # Everyone who had the role lost it, and it can't be given out again
+        if role.id in self.database.admin_roles.roles(role.guild.id):
+            await self.database.remove_admin_role(role.guild.id, role.id)
+        self.database.admin_roles.forget_guild(role.guild.id)
+
+    async def on_guild_remove(self, guild):
+        self.database.admin_roles.forget_guild(guild.id)
+
+    @commands.guild_only()
+    @check_user(can_manage_admins)
+    async def admin_group_entry(self, ctx):
+        """
+        (ADMIN ONLY) Choose which roles can use the admin commands
+        """
+        if ctx.invoked_subcommand is None:
+            await self.list_roles(ctx)
+
+    @commands.guild_only()
+    @check_user(can_manage_admins)
+    async def list_roles(self, ctx):
+        """
+        (ADMIN ONLY) List the roles that can use the admin commands
+        """
+        admin_roles = self.database.admin_roles
+        role_ids = admin_roles.roles(ctx.guild.id)
+        names = ", ".join(
+            role.mention if (role := ctx.guild.get_role(role_id)) is not None else f"`{role_id}`"
+            for role_id in sorted(role_ids)
+        )
+
+        if len(role_ids) == 0:
+            response = "No roles can use the admin commands."
+        elif admin_roles.is_configured(ctx.guild.id):
+            response = f"Admin roles: {names}"
+        else:
+            response = f"No admin roles set up for this server, so the default is used: {names}"
+        await self.reply(ctx, response, allowed_mentions=discord.AllowedMentions.none())
+
+    @commands.guild_only()
+    @check_user(can_manage_admins)
+    async def add_role(self, ctx, role: discord.Role):
+        """
+        (ADMIN ONLY) Let everyone with a role use the admin commands. The
+        first role added in a server keeps the default admin roles, which
+        can then be removed like any other.
+        """
+        self.typing(ctx)
+        admin_roles = self.database.admin_roles
+        # Only roles that exist here, so that they can be removed again
+        default_roles = [] if admin_roles.is_configured(ctx.guild.id) else [
+            default_role for role_id in sorted(admin_roles.default_role_ids)
+            if (default_role := ctx.guild.get_role(role_id)) is not None and default_role != role
+        ]
+
+        default_ids = [default_role.id for default_role in default_roles]
+        if await self.database.add_admin_role(ctx.guild.id, role.id, default_ids):
+            response = f"{role.mention} can now use the admin commands."
+            if default_roles:
+                response += (f" The default admin roles ({', '.join(default_role.mention for default_role in default_roles)}) "
+                             f"still can too, until they are removed.")
+        else:
+            response = f"{role.mention} could already use the admin commands."
+        await self.reply(ctx, response, allowed_mentions=discord.AllowedMentions.none())
+
+    @commands.guild_only()
+    @check_user(can_manage_admins)
+    async def remove_role(self, ctx, role: discord.Role):
+        """
+        (ADMIN ONLY) Stop a role from using the admin commands
+        """
+        self.typing(ctx)
+        if not await self.database.remove_admin_role(ctx.guild.id, role.id):
+            response = f"{role.mention} wasn't an admin role."
+        elif not self.database.admin_roles.is_configured(ctx.guild.id):
+            response = f"{role.mention} can no longer use the admin commands. That was the last admin role, so the default is used again."
+        else:
+            response = f"{role.mention} can no longer use the admin commands."
+        await self.reply(ctx, response, allowed_mentions=discord.AllowedMentions.none())
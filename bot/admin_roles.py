@@ -0,0 +1,120 @@
+import logging
+log = logging.getLogger(__name__)
+import threading
+from typing import Dict, FrozenSet, Iterable, List, Tuple
+
+class AdminRoles:
+    """
+    Which roles make someone a bot admin in each guild, as stored in the
+    `admin_roles` table, plus a cache of who turned out to be an admin.
+
+    A guild with no admin roles set up falls back to `default_role_ids`.
+
+    Working out whether a member is an admin means looking through all of
+    their roles, so the answer is remembered per `(guild, member)` and
+    checking again is a single dict lookup. Remembered answers must be
+    forgotten whenever a member's roles change, or the guild's admin roles
+    do; the latter happens here, the former is up to whoever listens to
+    discord's member events. Safe to share between the threads of an
+    `AsyncDatabase`.
+    """
+
+    def __init__(self, default_role_ids: Iterable[int] = ()):
+        self.default_role_ids = frozenset(default_role_ids)
+        self.hits = 0
+        self.misses = 0
+        self._roles: Dict[int, FrozenSet[int]] = {}
+        self._members: Dict[Tuple[int, int], bool] = {}
+        self._lock = threading.Lock()
+
+    def load(self, rows: List[Tuple[int, int]]):
+        """
+        Replaces the admin roles with every `(guild id, role id)` in the
+        database
+        """
+        roles = {}
+        for guild_id, role_id in rows:
+            roles.setdefault(guild_id, set()).add(role_id)
+
+        with self._lock:
+            self._roles = {guild_id: frozenset(role_ids) for guild_id, role_ids in roles.items()}
+            self._members.clear()
+
+        log.info(f"Loaded admin roles for {len(roles)} guilds")
+
+    def add(self, guild_id: int, role_id: int):
+        with self._lock:
+            self._roles[guild_id] = self._roles.get(guild_id, frozenset()) | {role_id}
+            self._forget_guild(guild_id)
+
+    def remove(self, guild_id: int, role_id: int):
+        with self._lock:
+            if (role_ids := self._roles.get(guild_id, frozenset()) - {role_id}):
+                self._roles[guild_id] = role_ids
+            else:
+                self._roles.pop(guild_id, None)
+            self._forget_guild(guild_id)
+
+    def roles(self, guild_id: int) -> FrozenSet[int]:
+        """
+        Returns the ids of the roles that make someone an admin in a guild
+        """
+        return self._roles.get(guild_id, self.default_role_ids)
+
+    def is_configured(self, guild_id: int) -> bool:
+        """
+        Returns whether a guild has its own admin roles, rather than using
+        the defaults
+        """
+        return guild_id in self._roles
+
+    def is_admin(self, user) -> bool:
+        """
+        Returns whether `user` has any of their guild's admin roles. Only
+        guild members have roles, so plain users are never admins.
+        """
+        if (guild := getattr(user, "guild", None)) is None or not hasattr(user, "roles"):
+            return False
+
+        key = (guild.id, user.id)
+        if (admin := self._members.get(key)) is not None:
+            self.hits += 1
+            return admin
+
+        self.misses += 1
+        with self._lock:
+            role_ids = self.roles(guild.id)
+            admin = any(role.id in role_ids for role in user.roles)
+            self._members[key] = admin
+        return admin
+
+    def forget_member(self, guild_id: int, member_id: int):
+        """
+        Forgets whether a member is an admin, because their roles changed
+        """
+        self._members.pop((guild_id, member_id), None)
+
+    def forget_guild(self, guild_id: int):
+        """
+        Forgets whether anyone in a guild is an admin, because one of its
+        roles changed
+        """
+        with self._lock:
+            self._forget_guild(guild_id)
+
+    def _forget_guild(self, guild_id: int):
+        # Must hold the lock
+        for key in [key for key in self._members if key[0] == guild_id]:
+            del self._members[key]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters describing how well the member cache is doing. Every
+        hit is a scan through someone's roles that didn't happen.
+        """
+        return {
+            "guilds": len(self._roles),
+            "members": len(self._members),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
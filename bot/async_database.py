@@ -0,0 +1,330 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+log = logging.getLogger(__name__)
+import threading
+from typing import AsyncIterator, Callable, List, Optional, Tuple, TypeVar
+
+from .admin_roles import AdminRoles
+from .database import BackpackItem, CoinGain, Database, DATABASE_FILE, connect_database, migrate_database
+from .identity_cache import IdentityCache
+from .item_catalog import ItemCatalog
+from .keyed import KeyedLock
+from .ranking import Ranking
+
+T = TypeVar("T")
+
+def _reader(name: str):
+    """
+    Makes an async method that runs `Database.<name>` on one of the read-only
+    connections.
+    """
+    async def method(self, *args, **kwargs):
+        return await self.run_read(lambda db: getattr(db, name)(*args, **kwargs))
+
+    method.__name__ = name
+    method.__doc__ = f"Runs `Database.{name}` on a reader thread"
+    return method
+
+def _writer(name: str):
+    """
+    Makes an async method that runs `Database.<name>` on the writer
+    connection.
+    """
+    async def method(self, *args, **kwargs):
+        return await self.run_write(lambda db: getattr(db, name)(*args, **kwargs))
+
+    method.__name__ = name
+    method.__doc__ = f"Runs `Database.{name}` on the writer thread"
+    return method
+
+def _user_writer(name: str, discord: bool = False):
+    """
+    Makes an async method that runs `Database.<name>` on the writer
+    connection while holding the lock for the user it is about, which is its
+    first argument. With `discord`, that argument is a discord user id and the
+    method returns False for users that aren't registered, just like
+    `Database._discordify`.
+    """
+    async def method(self, user_id: int, *args, **kwargs):
+        if not discord:
+            user_tid = user_id
+        elif (user_tid := await self.get_user_tid(user_id)) is None:
+            return False
+
+        async with self.user_locks(user_tid):
+            return await self.run_write(lambda db: getattr(db, name)(user_tid, *args, **kwargs))
+
+    method.__name__ = f"{name}_discord" if discord else name
+    method.__doc__ = f"Runs `Database.{name}` on the writer thread, one at a time per user"
+    return method
+
+class AsyncDatabase:
+    """
+    An asyncio-friendly interface to `Database`. None of the SQLite work
+    happens on the event loop: all mutations go through one dedicated writer
+    thread (so they are serialized exactly like before), while lookups are
+    spread across a small pool of read-only connections that can run in
+    parallel with the writer thanks to WAL mode.
+
+    Every method has the same name and arguments as its `Database`
+    counterpart, it just needs to be awaited.
+
+    With `group_commit` turned on, mutations are not committed one by one.
+    Instead they queue up and are flushed together in a single transaction
+    every `flush_interval` seconds, or as soon as `flush_operations` of them
+    are waiting, whichever comes first. Each caller still only gets its result
+    once the whole batch has been committed. Every mutation runs inside its own
+    savepoint, so one failing doesn't take the rest of its batch down with it.
+    Use `aclose` to flush anything still queued before shutting down.
+
+    Mutations to a user's coins or backpack are serialized per user by
+    `user_locks`, while different users' mutations proceed in parallel (and
+    can share a group commit batch). Commands that read a user's state and
+    then change it based on what they saw should hold `user_locks(user_tid)`
+    around the whole thing.
+    """
+
+    def __init__(self, path: str = DATABASE_FILE, readers: int = 4,
+                 group_commit: bool = False, flush_interval: float = 0.01, flush_operations: int = 100,
+                 admin_roles: Optional[AdminRoles] = None):
+        self.path = path
+        self.group_commit = group_commit
+        self.flush_interval = flush_interval
+        self.flush_operations = flush_operations
+        self._pending: List[Tuple[Callable[[Database], object], asyncio.Future]] = []
+        self._flush_handle = None
+        self._flushes = set()
+        self.user_locks = KeyedLock()
+
+        self.identities = IdentityCache()
+        self.catalog = ItemCatalog()
+        self.ranking = Ranking()
+        self.admin_roles = admin_roles if admin_roles is not None else AdminRoles()
+        self._reader_local = threading.local()
+        self._reader_dbs = []
+        self._reader_lock = threading.Lock()
+
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        # The writer connection is opened first so that the database file
+        # exists, is migrated and is in WAL mode before any read-only
+        # connection opens it
+        self._writer_db = self._writer_pool.submit(self._make_writer).result()
+        self._reader_pool = ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix="db-reader",
+            initializer=self._make_reader
+        )
+
+    def _make_writer(self) -> Database:
+        conn = connect_database(self.path)
+        migrate_database(conn)
+        self.identities.warm(conn)
+        db = Database(conn, self.identities, self.catalog, self.ranking, self.admin_roles)
+        self.catalog.load(db.select_item_definitions())
+        self.ranking.load(db.select_rankings())
+        self.admin_roles.load(db.select_admin_roles())
+        return db
+
+    def _make_reader(self):
+        db = Database(connect_database(self.path, readonly=True), self.identities, self.catalog, self.ranking,
+                      self.admin_roles)
+        self._reader_local.db = db
+        with self._reader_lock:
+            self._reader_dbs.append(db)
+
+    def _call_reader(self, function: Callable[[Database], T]) -> T:
+        return function(self._reader_local.db)
+
+    def _call_writer(self, function: Callable[[Database], T]) -> T:
+        return function(self._writer_db)
+
+    async def run_read(self, function: Callable[[Database], T]) -> T:
+        """
+        Runs `function(db)` on a reader thread, where `db` is a `Database`
+        backed by a read-only connection.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._reader_pool, functools.partial(self._call_reader, function))
+
+    def _call_writer_batch(self, functions: List[Callable[[Database], object]]) -> List[Tuple[bool, object]]:
+        db = self._writer_db
+        results = []
+        with db.transaction():
+            for function in functions:
+                try:
+                    with db.transaction():
+                        results.append((True, function(db)))
+                except Exception as e:
+                    results.append((False, e))
+
+        return results
+
+    async def run_write(self, function: Callable[[Database], T]) -> T:
+        """
+        Runs `function(db)` on the writer thread, where `db` is the single
+        `Database` allowed to modify the file. In group commit mode, this
+        waits for the batch `function` ended up in to be committed.
+        """
+        loop = asyncio.get_running_loop()
+        if not self.group_commit:
+            return await loop.run_in_executor(
+                self._writer_pool, functools.partial(self._call_writer, function))
+
+        future = loop.create_future()
+        self._pending.append((function, future))
+        if len(self._pending) >= self.flush_operations:
+            self._start_flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._start_flush)
+
+        return await future
+
+    def _start_flush(self):
+        """
+        Sends everything queued so far to the writer thread as one batch
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if len(self._pending) == 0:
+            return
+
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._flush(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _flush(self, batch: List[Tuple[Callable[[Database], object], asyncio.Future]]):
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(
+                self._writer_pool,
+                functools.partial(self._call_writer_batch, [function for function, _ in batch]))
+        except Exception as e:
+            log.error(f"Group commit of {len(batch)} operations failed: {e}")
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), (ok, value) in zip(batch, results):
+            if future.done():
+                continue # Caller gave up waiting
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    async def aclose(self):
+        """
+        Flushes any queued mutations, then closes the database like `close`.
+        """
+        self._start_flush()
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    def close(self):
+        """
+        Waits for all queued work to finish, then closes every connection.
+        Mutations still waiting for a group commit are lost; use `aclose` if
+        group commit is on.
+        """
+        self._writer_pool.shutdown(wait=True)
+        self._reader_pool.shutdown(wait=True)
+
+        self._writer_db.conn.close()
+        with self._reader_lock:
+            for db in self._reader_dbs:
+                db.conn.close()
+            self._reader_dbs.clear()
+
+    # Lookups
+    get_user_tid = _reader("get_user_tid")
+    get_user_discord_id = _reader("get_user_discord_id")
+    get_balance_discord = _reader("get_balance_discord")
+    get_balance = _reader("get_balance")
+    get_coin_gains = _reader("get_coin_gains")
+    get_coin_gains_page = _reader("get_coin_gains_page")
+    get_coin_gain_from_message = _reader("get_coin_gain_from_message")
+    get_item_definitions = _reader("get_item_definitions")
+    get_backpack_items = _reader("get_backpack_items")
+    get_backpack_view = _reader("get_backpack_view")
+    backpack_item_to_definition = _reader("backpack_item_to_definition")
+    user_has_item = _reader("user_has_item")
+    find_item = _reader("find_item")
+    suggest_items = _reader("suggest_items")
+    complete_items = _reader("complete_items")
+    get_top_balances = _reader("get_top_balances")
+    get_rank = _reader("get_rank")
+    get_job_state = _reader("get_job_state")
+    get_piece_emojis = _reader("get_piece_emojis")
+    get_ledger_statuses = _reader("get_ledger_statuses")
+    get_ledger_status = _reader("get_ledger_status")
+    get_outbox = _reader("get_outbox")
+    count_outbox = _reader("count_outbox")
+    get_export_users = _reader("get_export_users")
+    get_export_coin_gains = _reader("get_export_coin_gains")
+
+    # Mutations
+    register_user = _writer("register_user")
+    register_item = _writer("register_item")
+    unregister_item = _writer("unregister_item")
+    give_coins_bulk = _writer("give_coins_bulk")
+    update_coin_gain = _writer("update_coin_gain")
+    clear_outbox = _writer("clear_outbox")
+    import_users = _writer("import_users")
+    checkpoint_ledgers = _writer("checkpoint_ledgers")
+    rebuild_balances = _writer("rebuild_balances")
+    set_job_state = _writer("set_job_state")
+    set_piece_reaction = _writer("set_piece_reaction")
+    replace_piece_reactions = _writer("replace_piece_reactions")
+    add_admin_role = _writer("add_admin_role")
+    remove_admin_role = _writer("remove_admin_role")
+
+    # Mutations to a single user's coins or backpack
+    give_coins = _user_writer("give_coins")
+    give_item = _user_writer("give_item")
+    buy_item = _user_writer("buy_item")
+    use_item = _user_writer("use_item")
+    give_item_discord = _user_writer("give_item", discord=True)
+    give_coins_discord = _user_writer("give_coins", discord=True)
+    buy_item_discord = _user_writer("buy_item", discord=True)
+    use_item_discord = _user_writer("use_item", discord=True)
+
+    async def score_piece(self, discord_id: int, message_id: int, message_date, coins: int) -> int:
+        """
+        Runs `Database.score_piece` on the writer thread for a discord user,
+        registering them first if they aren't yet. Un-scoring a piece by
+        someone who isn't registered has nothing to undo.
+        """
+        if coins == 0 and await self.get_user_tid(discord_id) is None:
+            return 0
+        user_tid, _ = await self.register_user(discord_id)
+        async with self.user_locks(user_tid):
+            return await self.run_write(lambda db: db.score_piece(user_tid, message_id, message_date, coins))
+
+    async def iter_coin_gains(self, discord_id: int, page_size: int = 100) -> AsyncIterator[List[CoinGain]]:
+        """
+        Like `Database.iter_coin_gains`, with each page read on a reader
+        thread as it is asked for
+        """
+        if (user_tid := await self.get_user_tid(discord_id)) is None:
+            return
+
+        before_tid = None
+        while page := await self.get_coin_gains_page(user_tid, before_tid, page_size):
+            yield page
+            if len(page) < page_size:
+                return
+            before_tid = page[-1].tid
+
+    async def update_backpack_item(self, bpi: BackpackItem):
+        """Runs `Database.update_backpack_item` on the writer thread, one at a time per user"""
+        async with self.user_locks(bpi.user_tid):
+            return await self.run_write(lambda db: db.update_backpack_item(bpi))
@@ -0,0 +1,133 @@
+import asyncio
+import discord
+import logging
+log = logging.getLogger(__name__)
+import time
+import traceback
+from typing import Awaitable, Callable, Optional
+
+from .async_database import AsyncDatabase
+
+class Backfill:
+    """
+    Goes through a channel's history, oldest message first, re-scoring every
+    message, to catch up on anything reacted to while the bot wasn't
+    watching.
+
+    Messages are read with `channel.history` and handed to `score` one at a
+    time. It is up to `score` to make sure it can't race the live reaction
+    handlers, by scoring each message from its reactions as they are now,
+    in line with the live events for that message. After every `batch_size`
+    messages, the id of the last one is saved, so a backfill that stops for
+    any reason resumes right after it. Re-scoring is idempotent, so messages
+    scored again after a restart end up the same.
+
+    The backfill runs as its own task, so live reactions are handled as
+    usual while it runs. Discord's rate limits are handled by discord.py; on
+    top of that, the backfill pauses `pause` seconds after every batch to
+    leave the rest of the bot some headroom.
+    """
+
+    def __init__(self, database: AsyncDatabase, channel_id: int,
+                 score: Callable[[discord.Message], Awaitable[Optional[int]]],
+                 batch_size: int = 100, pause: float = 1.0):
+        """
+        score: Re-scores a message, returning how much its score changed by,
+            or None if it has nothing that could be worth anything
+        """
+        self.database = database
+        self.channel_id = channel_id
+        self.score = score
+        self.batch_size = batch_size
+        self.pause = pause
+        self.job = f"backfill:{channel_id}"
+
+        self.scanned = 0
+        self.scored = 0
+        self.changed = 0
+        self.last_message_id: Optional[int] = None
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def _save(self, last_message_id: int):
+        await self.database.set_job_state(self.job, str(last_message_id))
+        self.last_message_id = last_message_id
+
+    async def run(self, channel):
+        """
+        Backfills `channel` from where the last run left off
+        """
+        if (saved := await self.database.get_job_state(self.job)) is not None:
+            after = discord.Object(id=int(saved))
+            self.last_message_id = int(saved)
+        else:
+            after = None
+
+        batch_last_id = None
+        batch_count = 0
+        async for message in channel.history(limit=None, after=after, oldest_first=True):
+            self.scanned += 1
+            batch_count += 1
+            batch_last_id = message.id
+            if (delta := await self.score(message)) is not None:
+                self.scored += 1
+                if delta != 0:
+                    self.changed += 1
+
+            if batch_count >= self.batch_size:
+                await self._save(batch_last_id)
+                batch_count = 0
+                await asyncio.sleep(self.pause)
+
+        if batch_count > 0:
+            await self._save(batch_last_id)
+
+    async def _run(self, channel):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.error = None
+        try:
+            await self.run(channel)
+            log.info(f"Backfill of {channel} done: scanned {self.scanned} messages, re-scored {self.scored} pieces")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.error = str(e)
+            log.error(f"Backfill of {channel} failed:\n{traceback.format_exc()}")
+        finally:
+            self.finished_at = time.time()
+
+    def start(self, channel) -> bool:
+        """
+        Starts backfilling in the background. Returns False if a backfill is
+        already running. Must be called from inside the event loop.
+        """
+        if self.running:
+            return False
+        self.scanned = self.scored = self.changed = 0
+        self._task = asyncio.get_running_loop().create_task(self._run(channel))
+        return True
+
+    def stop(self) -> bool:
+        """
+        Stops the backfill. Everything up to the last saved batch is kept and
+        the next run picks up from there. Returns False if it wasn't running.
+        """
+        if not self.running:
+            return False
+        self._task.cancel()
+        return True
+
+    async def reset(self):
+        """
+        Forgets how far previous backfills got, so the next one starts from
+        the beginning of the channel
+        """
+        await self.database.set_job_state(self.job, None)
+        self.last_message_id = None
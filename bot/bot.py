@@ -2,11 +2,13 @@ import discord
 from discord.ext import commands
 import logging
 log = logging.getLogger(__name__)
-import sqlite3
 
+from .admin_commands import AdminCommands
 from .database_commands import DatabaseCommands
 from .database_reactions import DatabaseReactions
-from .database import Database, DATABASE_FILE
+from .ledger_commands import LedgerCommands
+from .async_database import AsyncDatabase
+from .permissions import admin_roles
 from .sheet_commands import SheetCommands
 from .sheet.google_auth import GoogleAPI
 
@@ -38,17 +40,23 @@ async def on_ready():
 
 def setup(bot):
     google_api = GoogleAPI()
-    sheet = google_api.make_sheet()
+    sheet = google_api.make_async_sheet()
 
-    database = Database(
-        sqlite3.connect(
-            DATABASE_FILE,
-            detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES
-        )
-    )
+    database = AsyncDatabase(admin_roles=admin_roles)
     sc = SheetCommands(sheet, database)
     dc = DatabaseCommands(database)
     dr = DatabaseReactions(database)
+    lc = LedgerCommands(database)
+    ac = AdminCommands(database)
     sc.setup(bot)
     dc.setup(bot)
     dr.setup(bot)
+    lc.setup(bot)
+    ac.setup(bot)
+
+    # Make sure nothing the database still has queued is lost on shutdown
+    bot_close = bot.close
+    async def close():
+        await bot_close()
+        await database.aclose()
+    bot.close = close
@@ -3,11 +3,19 @@ import logging
 log = logging.getLogger(__name__)
 import traceback
 
+from .responses import Responder
+
 class Commands:
     """
     Base class that command registries are expected to inherit from
+
+    Commands should reply with `self.reply` rather than `ctx.send`, and call
+    `self.typing(ctx)` instead of `ctx.channel.trigger_typing()`, so that
+    replies go through the bot-wide `Responder`.
     """
 
+    responder = Responder()
+
     def setup(self, bot):
         """
         Initializes a bot with the commands in this registry
@@ -27,6 +35,7 @@ class Commands:
             error_handler = self.default_error
 
         command_obj.error(error_handler)
+        command_obj.after_invoke(self._after_invoke_hook())
         bot_or_group.add_command(command_obj)
 
         return command_obj
@@ -45,11 +54,40 @@ class Commands:
             error_handler = self.default_error
 
         group.error(error_handler)
+        group.after_invoke(self._after_invoke_hook())
         bot_or_group.add_command(group)
 
         return group
 
+    def typing(self, ctx):
+        """
+        Shows that the bot is typing, but only if the command takes long
+        enough for anyone to notice
+        """
+        self.responder.typing(ctx)
+
+    async def reply(self, ctx, content=None, merge=True, **kwargs):
+        """
+        Replies to a command like `ctx.send`, merging bursts of replies to the
+        same channel. Returns the message the reply ended up in; use
+        `merge=False` if that message is going to be edited.
+        """
+        return await self.responder.reply(ctx, content, merge, **kwargs)
+
+    def _after_invoke_hook(self):
+        """
+        Returns the hook run after each command. It must be a plain function:
+        discord.py calls hooks that have a `__self__` as `hook(instance, ctx)`,
+        as if they were cog methods.
+        """
+        responder = self.responder
+
+        async def after_invoke(ctx):
+            responder.done(ctx)
+
+        return after_invoke
+
     async def default_error(self, ctx, error):
         """Default error handler for discord commands"""
         log.error(traceback.format_exc())
-        await ctx.send(f"Oopsie Woopsie: {error}")
+        await self.reply(ctx, f"Oopsie Woopsie: {error}")
@@ -5,32 +5,46 @@ log = logging.getLogger(__name__)
 import os
 from os.path import dirname, abspath, join
 import sqlite3
-from typing import Optional, List, Tuple
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, Optional, List, Set, Tuple
 
 import discord
 
+from .identity_cache import IdentityCache
+from .item_catalog import ItemCatalog
+from .ranking import Ranking
+from .admin_roles import AdminRoles
+
 DATABASE_FILE = join(dirname(abspath(__file__)), "coins.db")
 
+# Stay well under SQLite's limit on the number of `?` parameters per statement
+MAX_QUERY_PARAMETERS = 500
 
-def create_database(conn: sqlite3.Connection):
-    """
-    Given a connection to an SQLite3 database, initialize it with all the
-    tables required to run the both with.
+# What a user's coin gains add up to, starting from their checkpoint. Expects
+# `users u LEFT JOIN coin_checkpoints cp ON cp.user_id = u.id`
+LEDGER_TOTAL_SQL = '''
+    COALESCE(cp.total, 0) + COALESCE((SELECT SUM(g.coins) FROM coin_gains g
+                                      WHERE g.user_id = u.id AND g.id > COALESCE(cp.gain_id, 0)), 0)
+'''
 
-    conn: the connection
-    """
+# Larger than any rowid SQLite will hand out
+MAX_ROW_ID = 2**63 - 1
+
+# The kinds of rows in the `sheet_outbox` table
+OUTBOX_USER = "user"
+OUTBOX_COIN_GAIN = "coin_gain"
 
-    c = conn.cursor()
-    c.executescript('''
-        PRAGMA foreign_keys = ON;
 
-        CREATE TABLE users (
+MIGRATIONS = [
+    # Version 1: the original schema
+    '''
+        CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY,
             user_id TEXT NOT NULL, -- Discord uses bigints, don't fit into regular int
             coins INT NOT NULL
         );
 
-        CREATE TABLE coin_gains (
+        CREATE TABLE IF NOT EXISTS coin_gains (
             id INTEGER PRIMARY KEY,
             message_id TEXT,
             user_id INT NOT NULL,
@@ -39,7 +53,7 @@ def create_database(conn: sqlite3.Connection):
             FOREIGN KEY(user_id) REFERENCES users(id)
         );
 
-        CREATE TABLE item_definitions (
+        CREATE TABLE IF NOT EXISTS item_definitions (
             id INTEGER PRIMARY KEY,
             title TEXT NOT NULL,
             -- Create an uppercase title column for quicker searching
@@ -50,17 +64,250 @@ def create_database(conn: sqlite3.Connection):
             cost INT NOT NULL
         );
 
-        CREATE TABLE item_backpack (
+        CREATE TABLE IF NOT EXISTS item_backpack (
             item_id INT NOT NULL,
             user_id INT NOT NULL,
             count INT NOT NULL,
             FOREIGN KEY (user_id) REFERENCES users(id),
             FOREIGN KEY (item_id) REFERENCES item_definitions(id)
         );
-    ''')
+    ''',
+
+    # Version 2: merge any duplicate rows, then index every lookup the bot
+    # does and make those duplicates impossible from here on out
+    '''
+        -- Users registered more than once are merged into their oldest row
+        CREATE TEMP TABLE user_merges AS
+            SELECT u.id AS old_id, k.keep_id AS new_id
+            FROM users u
+            JOIN (SELECT user_id, MIN(id) AS keep_id FROM users GROUP BY user_id) k
+                ON u.user_id = k.user_id
+            WHERE u.id != k.keep_id;
+        UPDATE users
+            SET coins = coins + (SELECT SUM(d.coins)
+                                 FROM users d JOIN user_merges m ON d.id = m.old_id
+                                 WHERE m.new_id = users.id)
+            WHERE id IN (SELECT new_id FROM user_merges);
+        UPDATE coin_gains
+            SET user_id = (SELECT new_id FROM user_merges WHERE old_id = coin_gains.user_id)
+            WHERE user_id IN (SELECT old_id FROM user_merges);
+        UPDATE item_backpack
+            SET user_id = (SELECT new_id FROM user_merges WHERE old_id = item_backpack.user_id)
+            WHERE user_id IN (SELECT old_id FROM user_merges);
+        DELETE FROM users WHERE id IN (SELECT old_id FROM user_merges);
+        DROP TABLE user_merges;
+
+        -- Items with the same title are merged into the oldest definition
+        CREATE TEMP TABLE item_merges AS
+            SELECT i.id AS old_id, k.keep_id AS new_id
+            FROM item_definitions i
+            JOIN (SELECT title_upper, MIN(id) AS keep_id FROM item_definitions GROUP BY title_upper) k
+                ON i.title_upper = k.title_upper
+            WHERE i.id != k.keep_id;
+        UPDATE item_backpack
+            SET item_id = (SELECT new_id FROM item_merges WHERE old_id = item_backpack.item_id)
+            WHERE item_id IN (SELECT old_id FROM item_merges);
+        DELETE FROM item_definitions WHERE id IN (SELECT old_id FROM item_merges);
+        DROP TABLE item_merges;
+
+        -- Backpack rows for the same user and item are summed together
+        UPDATE item_backpack
+            SET count = (SELECT SUM(b.count) FROM item_backpack b
+                         WHERE b.user_id = item_backpack.user_id
+                           AND b.item_id = item_backpack.item_id)
+            WHERE rowid IN (SELECT MIN(rowid) FROM item_backpack
+                            GROUP BY user_id, item_id HAVING COUNT(*) > 1);
+        DELETE FROM item_backpack
+            WHERE rowid NOT IN (SELECT MIN(rowid) FROM item_backpack GROUP BY user_id, item_id);
+
+        -- Coin gains for the same message and user are summed together
+        UPDATE coin_gains
+            SET coins = (SELECT SUM(g.coins) FROM coin_gains g
+                         WHERE g.message_id = coin_gains.message_id
+                           AND g.user_id = coin_gains.user_id)
+            WHERE id IN (SELECT MIN(id) FROM coin_gains WHERE message_id IS NOT NULL
+                         GROUP BY message_id, user_id HAVING COUNT(*) > 1);
+        DELETE FROM coin_gains
+            WHERE message_id IS NOT NULL
+              AND id NOT IN (SELECT MIN(id) FROM coin_gains WHERE message_id IS NOT NULL
+                             GROUP BY message_id, user_id);
+
+        CREATE UNIQUE INDEX users_user_id ON users (user_id);
+        CREATE UNIQUE INDEX item_definitions_title_upper ON item_definitions (title_upper);
+        CREATE UNIQUE INDEX item_backpack_user_item ON item_backpack (user_id, item_id);
+        -- Not unique on message_id alone: one command can pay several users
+        CREATE UNIQUE INDEX coin_gains_message_user ON coin_gains (message_id, user_id);
+        -- Covers summing up a user's history without touching the table
+        CREATE INDEX coin_gains_user ON coin_gains (user_id, id, coins);
+    ''',
+
+    # Version 3: an outbox of rows that changed since they were last exported
+    # to the Google Sheet, filled in by triggers so that no mutation can
+    # forget to. Re-marking a row moves it to the back with a new id, which
+    # is how the exporter tells whether a row changed again while it was
+    # being exported.
+    '''
+        CREATE TABLE sheet_outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL, -- 'user' or 'coin_gain'
+            key INT NOT NULL, -- users.id or coin_gains.id
+            UNIQUE (kind, key)
+        );
+
+        -- A user's row holds both their balance and their backpack
+        CREATE TRIGGER sheet_outbox_user_insert AFTER INSERT ON users BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'user' AND key = NEW.id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('user', NEW.id);
+        END;
+        CREATE TRIGGER sheet_outbox_user_update AFTER UPDATE ON users BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'user' AND key = NEW.id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('user', NEW.id);
+        END;
+        CREATE TRIGGER sheet_outbox_backpack_insert AFTER INSERT ON item_backpack BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'user' AND key = NEW.user_id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('user', NEW.user_id);
+        END;
+        CREATE TRIGGER sheet_outbox_backpack_update AFTER UPDATE ON item_backpack BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'user' AND key = NEW.user_id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('user', NEW.user_id);
+        END;
+        CREATE TRIGGER sheet_outbox_backpack_delete AFTER DELETE ON item_backpack BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'user' AND key = OLD.user_id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('user', OLD.user_id);
+        END;
+        -- Unregistered items disappear from everyone's backpack
+        CREATE TRIGGER sheet_outbox_item_delete AFTER DELETE ON item_definitions BEGIN
+            DELETE FROM sheet_outbox
+                WHERE kind = 'user' AND key IN (SELECT user_id FROM item_backpack WHERE item_id = OLD.id);
+            INSERT INTO sheet_outbox (kind, key)
+                SELECT 'user', user_id FROM item_backpack WHERE item_id = OLD.id;
+        END;
+        CREATE TRIGGER sheet_outbox_coin_gain_insert AFTER INSERT ON coin_gains BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'coin_gain' AND key = NEW.id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('coin_gain', NEW.id);
+        END;
+        CREATE TRIGGER sheet_outbox_coin_gain_update AFTER UPDATE ON coin_gains BEGIN
+            DELETE FROM sheet_outbox WHERE kind = 'coin_gain' AND key = NEW.id;
+            INSERT INTO sheet_outbox (kind, key) VALUES ('coin_gain', NEW.id);
+        END;
+
+        -- Nothing has been exported yet
+        INSERT INTO sheet_outbox (kind, key) SELECT 'user', id FROM users ORDER BY id;
+        INSERT INTO sheet_outbox (kind, key) SELECT 'coin_gain', id FROM coin_gains ORDER BY id;
+    ''',
+
+    # Version 4: running totals of each user's coin gains, so that checking a
+    # balance against the ledger only has to add up what came after
+    '''
+        CREATE TABLE coin_checkpoints (
+            user_id INTEGER PRIMARY KEY, -- users.id
+            gain_id INT NOT NULL, -- the last coin_gains.id included in total
+            total INT NOT NULL
+        );
+    ''',
+
+    # Version 5: index balances for the leaderboard
+    '''
+        CREATE INDEX users_coins ON users (coins DESC, id);
+    ''',
+
+    # Version 6: where long-running background jobs got to, so they can pick
+    # up from there after a restart
+    '''
+        CREATE TABLE job_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    ''',
+
+    # Version 7: which roles make someone a bot admin, per guild
+    '''
+        CREATE TABLE admin_roles (
+            guild_id TEXT NOT NULL,
+            role_id TEXT NOT NULL,
+            PRIMARY KEY (guild_id, role_id)
+        ) WITHOUT ROWID;
+    ''',
+
+    # Version 8: which star and category reactions admins put on each piece,
+    # so a reaction event can re-score a piece without asking discord
+    '''
+        CREATE TABLE piece_reactions (
+            message_id TEXT NOT NULL,
+            emoji TEXT NOT NULL,
+            admin_id TEXT NOT NULL,
+            PRIMARY KEY (message_id, emoji, admin_id)
+        ) WITHOUT ROWID;
+    ''',
+]
+"""
+SQL scripts that upgrade the database schema, in order. The script at index
+`i` upgrades a database from `PRAGMA user_version` `i` to `i + 1`. Existing
+scripts must never be edited once released, only new ones appended.
+"""
+
+def migrate_database(conn: sqlite3.Connection, target: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Given a connection to an SQLite3 database, upgrade it in place to the
+    latest schema version (or `target`, if specified). A brand new database is
+    initialized with all the tables required to run the bot with.
+
+    Each migration is applied in its own transaction, so a failure leaves the
+    database at the last version that succeeded.
+
+    Returns the version the database was at before and after migrating.
+    """
+    if target is None:
+        target = len(MIGRATIONS)
+
+    old_version = conn.execute('PRAGMA user_version').fetchone()[0]
+    if old_version > len(MIGRATIONS):
+        raise RuntimeError(f"Database is at version {old_version}, which is newer than this bot knows about ({len(MIGRATIONS)})")
+
+    version = old_version
+    for script in MIGRATIONS[old_version:target]:
+        version += 1
+        log.info(f"Migrating database to version {version}")
+        try:
+            conn.executescript(f'''
+                BEGIN;
+                {script}
+                PRAGMA user_version = {version};
+                COMMIT;
+            ''')
+        except:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+    return old_version, version
+
+def connect_database(path: str = DATABASE_FILE, readonly: bool = False) -> sqlite3.Connection:
+    """
+    Opens a connection to the database file with the settings the bot expects.
 
-    conn.commit()
-    c.close()
+    The database is put into WAL mode so that read-only connections can keep
+    reading while the writer connection is in the middle of a transaction.
+    Connections are not tied to the thread that created them, but each one
+    should still only be used by a single thread at a time.
+    """
+    if readonly:
+        conn = sqlite3.connect(
+            f"file:{path}?mode=ro",
+            uri=True,
+            detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+        )
+    else:
+        conn = sqlite3.connect(
+            path,
+            detect_types=sqlite3.PARSE_COLNAMES | sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+
+    conn.execute('PRAGMA busy_timeout = 5000')
+    return conn
 
 def delete_database():
     """
@@ -95,14 +342,75 @@ class BackpackItem:
     user_tid: int
     count: int
 
+@dataclass
+class BackpackEntry:
+    """An item in a user's backpack, joined with its definition for display"""
+    item_tid: int
+    title: str
+    cost: int
+    image_url: str
+    count: int
+
+@dataclass
+class ImportedUser:
+    """A user's legacy data, as read from the Google Sheet"""
+    discord_id: int
+    coins: Optional[int] # None to leave the balance alone
+    backpack: Dict[str, int] # item title -> count
+
+@dataclass
+class ImportCounts:
+    """What `Database.import_users` changed"""
+    users_created: int
+    balances_changed: int
+    backpack_rows: int
+    unknown_items: List[str]
+
+@dataclass
+class LedgerStatus:
+    """A user's balance next to what their coin gains add up to"""
+    user_tid: int
+    discord_id: int
+    balance: int
+    ledger: int
+
+    @property
+    def drift(self) -> int:
+        return self.balance - self.ledger
+
+@dataclass
+class OutboxEntry:
+    """A row that changed since it was last exported to the Google Sheet"""
+    tid: int
+    kind: str
+    key: int
+
 class Database:
     """
     A python-friendly interface for interacting with the sqlite3 database that
     this file defines.
     """
 
-    def __init__(self, conn):
+    def __init__(self, conn, identities: Optional[IdentityCache] = None, catalog: Optional[ItemCatalog] = None,
+                 ranking: Optional[Ranking] = None, admin_roles: Optional[AdminRoles] = None):
         self.conn = conn
+        # Shared between every connection to the same file when given
+        self.identities = identities if identities is not None else IdentityCache()
+        if catalog is None:
+            catalog = ItemCatalog()
+            catalog.load(self.select_item_definitions())
+        self.catalog = catalog
+        if ranking is None:
+            ranking = Ranking()
+            ranking.load(self.select_rankings())
+        self.ranking = ranking
+        if admin_roles is None:
+            admin_roles = AdminRoles()
+            admin_roles.load(self.select_admin_roles())
+        self.admin_roles = admin_roles
+
+        self._transaction_depth = 0
+        self._commit_hooks = []
 
         # Initialize proxy functions
         self.give_item_discord = self._discordify(self.give_item)
@@ -110,6 +418,58 @@ class Database:
         self.buy_item_discord = self._discordify(self.buy_item)
         self.use_item_discord = self._discordify(self.use_item)
 
+    @contextmanager
+    def transaction(self):
+        """
+        Runs everything inside the `with` block as one unit of work: either
+        all of its statements are committed together (with a single fsync) or,
+        if an exception escapes, none of them are.
+
+        Transactions nest. An inner `with self.transaction()` becomes a
+        savepoint that rolls back on its own if it fails, and only the
+        outermost one actually commits.
+        """
+        depth = self._transaction_depth
+        hooks_before = len(self._commit_hooks)
+        if depth == 0:
+            self.conn.execute('BEGIN IMMEDIATE')
+        else:
+            self.conn.execute(f'SAVEPOINT nested_{depth}')
+
+        self._transaction_depth += 1
+        try:
+            yield
+        except:
+            self._transaction_depth -= 1
+            del self._commit_hooks[hooks_before:]
+            if depth == 0:
+                self.conn.rollback()
+            else:
+                self.conn.execute(f'ROLLBACK TO nested_{depth}')
+                self.conn.execute(f'RELEASE nested_{depth}')
+            raise
+
+        self._transaction_depth -= 1
+        if depth == 0:
+            self.conn.commit()
+            hooks, self._commit_hooks = self._commit_hooks, []
+            for hook in hooks:
+                hook()
+        else:
+            self.conn.execute(f'RELEASE nested_{depth}')
+
+    def after_commit(self, hook: Callable[[], None]):
+        """
+        Calls `hook` once the current transaction commits, or right away if
+        there isn't one. Used to keep in-memory caches from running ahead of
+        what is actually in the database: if the transaction rolls back, the
+        hook is never called.
+        """
+        if self._transaction_depth == 0:
+            hook()
+        else:
+            self._commit_hooks.append(hook)
+
     def _select_user_unchecked(self, sql_statement: str, user_tid: int) -> Optional[int]:
         """
         Utility function to execute an SQL SELECT statement based on
@@ -168,8 +528,15 @@ class Database:
         """
         Returns the database id associated with a discord user's id
         """
+        if (user_tid := self.identities.get(discord_id)) is not None:
+            return user_tid
+
         if (row := self._select_user_checked('SELECT id FROM users WHERE user_id=?', discord_id)) is not None:
-            return row[0]
+            user_tid = row[0]
+            # Inside a transaction, the row may have been inserted by it and
+            # could still be rolled back
+            self.after_commit(lambda: self.identities.put(discord_id, user_tid))
+            return user_tid
         else:
             return None
 
@@ -204,6 +571,9 @@ class Database:
         """
         Returns a list of all the user's coin bank transactions. This is
         always the empty list if the user is not registered.
+
+        A long-time member can have thousands of these; prefer
+        `get_coin_gains_page` or `iter_coin_gains` for anything user facing.
         """
         if (user_id := self.get_user_tid(discord_id)) is None:
             log.debug(f"Attempted to get coin gains for unregistered user {discord_id}")
@@ -217,6 +587,69 @@ class Database:
 
         return [CoinGain(*row) for row in rows]
 
+    def get_coin_gains_page(self, user_tid: int, before_tid: Optional[int] = None, limit: int = 10) -> List[CoinGain]:
+        """
+        Returns up to `limit` of a user's coin gains, newest first, starting
+        just before the coin gain with id `before_tid` (from the newest, if
+        None). Pass the id of the last coin gain on one page to get the next
+        one. Each page is a range scan of the `coin_gains_user` index, no
+        matter how deep into the history it is.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT id, message_id, user_id, date_entered, coins
+                     FROM coin_gains
+                     WHERE user_id=? AND id < ?
+                     ORDER BY id DESC
+                     LIMIT ?''', [user_tid, MAX_ROW_ID if before_tid is None else before_tid, limit])
+        rows = c.fetchall()
+
+        return [CoinGain(*row) for row in rows]
+
+    def iter_coin_gains(self, discord_id: int, page_size: int = 100) -> Iterator[List[CoinGain]]:
+        """
+        Yields a user's coin gains a page at a time, newest first, only
+        querying for each page when it is asked for. Yields nothing if the
+        user is not registered.
+        """
+        if (user_tid := self.get_user_tid(discord_id)) is None:
+            return
+
+        before_tid = None
+        while page := self.get_coin_gains_page(user_tid, before_tid, page_size):
+            yield page
+            if len(page) < page_size:
+                return
+            before_tid = page[-1].tid
+
+    def get_ledger_statuses(self, after_user_tid: int, limit: int) -> List[LedgerStatus]:
+        """
+        Returns the balance and ledger total of up to `limit` users, in table
+        id order, starting after `after_user_tid`. Only the coin gains since
+        each user's checkpoint are added up. Both numbers come from the same
+        statement, so they are consistent with each other.
+        """
+        c = self.conn.cursor()
+        c.execute(f'''SELECT u.id, u.user_id, u.coins, {LEDGER_TOTAL_SQL}
+                      FROM users u
+                      LEFT JOIN coin_checkpoints cp ON cp.user_id = u.id
+                      WHERE u.id > ?
+                      ORDER BY u.id
+                      LIMIT ?''', [after_user_tid, limit])
+        rows = c.fetchall()
+
+        return [LedgerStatus(user_tid, int(discord_id), balance, ledger)
+                for user_tid, discord_id, balance, ledger in rows]
+
+    def get_ledger_status(self, user_tid: int) -> Optional[LedgerStatus]:
+        """
+        Returns a single user's balance and ledger total, or None if they
+        don't exist
+        """
+        statuses = self.get_ledger_statuses(user_tid - 1, 1)
+        if len(statuses) == 0 or statuses[0].user_tid != user_tid:
+            return None
+        return statuses[0]
+
     def get_coin_gain_from_message(self, message_id: int) -> Optional[CoinGain]:
         """
         Returns the CoinGain corresponding to a recorded message, or None if it
@@ -235,11 +668,12 @@ class Database:
             if len(rows) > 1:
                 # Unexpected condition
                 log.warn(f"Message {message_id} recorded multiple times as a coin gain!")
-            return CoinGain(*row[0])
+            return CoinGain(*rows[0])
 
-    def get_item_definitions(self) -> Optional[List[ItemDefinition]]:
+    def select_item_definitions(self) -> List[ItemDefinition]:
         """
-        Returns a list of all registered items
+        Reads every registered item straight from the item definition table.
+        Everything else should go through `self.catalog` instead.
         """
         c = self.conn.cursor()
         c.execute('''SELECT id, title, desc, image_url, cost
@@ -248,6 +682,39 @@ class Database:
 
         return [ItemDefinition(*row) for row in rows]
 
+    def select_rankings(self) -> List[Tuple[int, int, int]]:
+        """
+        Reads every user's `(user_tid, discord id, coins)` straight from the
+        users table, richest first. Everything else should go through
+        `self.ranking` instead.
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT id, user_id, coins
+                     FROM users
+                     ORDER BY coins DESC, id''')
+        rows = c.fetchall()
+
+        return [(user_tid, int(discord_id), coins) for user_tid, discord_id, coins in rows]
+
+    def get_top_balances(self, count: int) -> List[Tuple[int, int, int]]:
+        """
+        Returns `(place, discord id, coins)` for the `count` richest users
+        """
+        return self.ranking.top(count)
+
+    def get_rank(self, discord_id: int) -> Optional[Tuple[int, int]]:
+        """
+        Returns a user's place on the leaderboard and their balance, or None
+        if they aren't registered
+        """
+        return self.ranking.rank(discord_id)
+
+    def get_item_definitions(self) -> Optional[List[ItemDefinition]]:
+        """
+        Returns a list of all registered items
+        """
+        return self.catalog.items()
+
     def get_backpack_items(self, discord_id: int) -> List[BackpackItem]:
         """
         Returns a list of all items a user has in their backpack. This is
@@ -265,22 +732,116 @@ class Database:
 
         return [BackpackItem(*row) for row in rows]
 
-    def backpack_item_to_definition(self, bpi: BackpackItem) -> Optional[BackpackItem]:
+    def get_backpack_view(self, discord_id: int, limit: Optional[int] = None, offset: int = 0) -> List[BackpackEntry]:
         """
-        Looks up the item id of the backpack item in the item definition table
+        Returns the items in a user's backpack together with their
+        definitions, most plentiful first, in a single query. At most `limit`
+        entries are returned (all of them if None), skipping the first
+        `offset`. This is always the empty list if the user is not registered.
         """
+        if (user_id := self.get_user_tid(discord_id)) is None:
+            log.debug(f"Attempted to get items for unregistered user {discord_id}")
+            return []
 
         c = self.conn.cursor()
-        c.execute('''SELECT id, title, desc, image_url, cost
-                     FROM item_definitions
-                     WHERE id=?''', [bpi.item_tid])
+        c.execute('''SELECT d.id, d.title, d.cost, d.image_url, b.count
+                     FROM item_backpack b
+                     JOIN item_definitions d ON d.id = b.item_id
+                     WHERE b.user_id=?
+                     ORDER BY b.count DESC, d.title_upper
+                     LIMIT ? OFFSET ?''', [user_id, -1 if limit is None else limit, offset])
         rows = c.fetchall()
 
-        if len(rows) == 0:
+        return [BackpackEntry(*row) for row in rows]
+
+    def get_outbox(self, limit: int) -> List[OutboxEntry]:
+        """
+        Returns up to `limit` of the rows waiting to be exported to the Google
+        Sheet, the ones that have been waiting longest first
+        """
+        c = self.conn.cursor()
+        c.execute('''SELECT id, kind, key
+                     FROM sheet_outbox
+                     ORDER BY id
+                     LIMIT ?''', [limit])
+        rows = c.fetchall()
+
+        return [OutboxEntry(*row) for row in rows]
+
+    def count_outbox(self) -> int:
+        """
+        Returns how many rows are waiting to be exported to the Google Sheet
+        """
+        return self.conn.execute('SELECT COUNT(*) FROM sheet_outbox').fetchone()[0]
+
+    def get_export_users(self, user_tids: List[int]) -> Dict[int, Tuple[int, int, List[Tuple[str, int]]]]:
+        """
+        Returns `user_tid -> (discord id, coins, [(item title, count)])` for
+        the given users, for exporting to the Google Sheet. Users that don't
+        exist are left out.
+        """
+        users = {}
+        c = self.conn.cursor()
+        for start in range(0, len(user_tids), MAX_QUERY_PARAMETERS):
+            chunk = user_tids[start:start + MAX_QUERY_PARAMETERS]
+            placeholders = ", ".join("?" * len(chunk))
+            c.execute(f'''SELECT id, user_id, coins FROM users
+                          WHERE id IN ({placeholders})''', chunk)
+            for user_tid, discord_id, coins in c.fetchall():
+                users[user_tid] = (int(discord_id), coins, [])
+
+            c.execute(f'''SELECT b.user_id, d.title, b.count
+                          FROM item_backpack b
+                          JOIN item_definitions d ON d.id = b.item_id
+                          WHERE b.user_id IN ({placeholders}) AND b.count > 0
+                          ORDER BY b.user_id, b.count DESC, d.title_upper''', chunk)
+            for user_tid, title, count in c.fetchall():
+                if user_tid in users:
+                    users[user_tid][2].append((title, count))
+
+        return users
+
+    def get_export_coin_gains(self, coin_gain_tids: List[int]) -> Dict[int, Tuple[CoinGain, Optional[int]]]:
+        """
+        Returns `coin_gain_tid -> (coin gain, discord id of its user)` for
+        the given coin gains, for exporting to the Google Sheet. Coin gains
+        that don't exist are left out.
+        """
+        gains = {}
+        c = self.conn.cursor()
+        for start in range(0, len(coin_gain_tids), MAX_QUERY_PARAMETERS):
+            chunk = coin_gain_tids[start:start + MAX_QUERY_PARAMETERS]
+            c.execute(f'''SELECT g.id, g.message_id, g.user_id, g.date_entered, g.coins, u.user_id
+                          FROM coin_gains g
+                          LEFT JOIN users u ON u.id = g.user_id
+                          WHERE g.id IN ({", ".join("?" * len(chunk))})''', chunk)
+            for *row, discord_id in c.fetchall():
+                gains[row[0]] = (CoinGain(*row), None if discord_id is None else int(discord_id))
+
+        return gains
+
+    def clear_outbox(self, entries: List[OutboxEntry]):
+        """
+        Removes entries from the outbox once they have been exported. Rows
+        that changed again since `entries` was read have been given a new id
+        in the meantime, so they stay in the outbox.
+        """
+        tids = [entry.tid for entry in entries]
+        with self.transaction():
+            c = self.conn.cursor()
+            for start in range(0, len(tids), MAX_QUERY_PARAMETERS):
+                chunk = tids[start:start + MAX_QUERY_PARAMETERS]
+                c.execute(f'''DELETE FROM sheet_outbox
+                              WHERE id IN ({", ".join("?" * len(chunk))})''', chunk)
+            c.close()
+
+    def backpack_item_to_definition(self, bpi: BackpackItem) -> Optional[BackpackItem]:
+        """
+        Looks up the item id of the backpack item in the item catalog
+        """
+        if (item := self.catalog.get(bpi.item_tid)) is None:
             log.debug(f"Item definition for {bpi.item_tid=} not found")
-            return None
-        else:
-            return ItemDefinition(*(rows[0]))
+        return item
 
     def register_user(self, discord_id: int) -> Tuple[int, bool]:
         """
@@ -295,12 +856,15 @@ class Database:
             log.debug(f"Attempted to register user {discord_id}, but they were already present!")
             return user_tid, True
 
-        c = self.conn.cursor()
-        c.execute('INSERT INTO users (user_id, coins) VALUES (?, ?)', [str(discord_id), 0])
-        self.conn.commit()
-        c.close()
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('INSERT INTO users (user_id, coins) VALUES (?, ?)', [str(discord_id), 0])
+            user_tid = c.lastrowid
+            c.close()
+            self.after_commit(lambda: self.identities.put(discord_id, user_tid))
+            self.after_commit(lambda: self.ranking.add(user_tid, discord_id, 0))
 
-        return self.get_user_tid(discord_id), False
+        return user_tid, False
 
     def user_has_item(self, user_tid: int, item_tid: int) -> Optional[BackpackItem]:
         """
@@ -322,40 +886,34 @@ class Database:
         Given the `BackpackItem` data, update or insert it into the
         `item_backpack` table.
         """
-        c = self.conn.cursor()
-        if (old_bpi := self.user_has_item(bpi.user_tid, bpi.item_tid)) is not None:
-            # Item already exists, do an update
-            c.execute('''UPDATE item_backpack
-                         SET count=?
-                         WHERE user_id=? AND item_id=?''',
-                         [bpi.count, bpi.user_tid, bpi.item_tid])
-        else:
-            # Item is not yet owned or does not exist, insert it fresh
+        with self.transaction():
+            c = self.conn.cursor()
             c.execute('''INSERT INTO item_backpack (item_id, user_id, count)
-                         VALUES (?, ?, ?)''',
+                         VALUES (?, ?, ?)
+                         ON CONFLICT (user_id, item_id) DO UPDATE
+                         SET count=excluded.count''',
                          [bpi.item_tid, bpi.user_tid, bpi.count])
-
-        self.conn.commit()
-        c.close()
+            c.close()
 
     def find_item(self, item_title: str) -> Optional[ItemDefinition]:
         """
-        Searches the item definition table for an item with a matching title.
-        Returns None if no item with that title could be found.
+        Searches the item catalog for an item with a matching title. Returns
+        None if no item with that title could be found.
         """
-        c = self.conn.cursor()
-        c.execute('''SELECT id, title, desc, image_url, cost
-                     FROM item_definitions
-                     WHERE title_upper=?''', [item_title.upper()])
-        rows = c.fetchall()
+        return self.catalog.find(item_title)
 
-        if len(rows) == 0:
-            return None
-        elif len(rows) == 1:
-            return ItemDefinition(*(rows[0]))
-        else:
-            log.warn(f"Multiple items with {item_title=} found in database! {rows}")
-            return ItemDefinition(*(rows[0]))
+    def suggest_items(self, item_title: str, limit: int = 5) -> List[ItemDefinition]:
+        """
+        Returns up to `limit` items with titles close to `item_title`, best
+        match first, for when `find_item` didn't find anything
+        """
+        return self.catalog.suggest(item_title, limit)
+
+    def complete_items(self, prefix: str, limit: int = 5) -> List[ItemDefinition]:
+        """
+        Returns up to `limit` items with titles starting with `prefix`
+        """
+        return self.catalog.complete(prefix, limit)
 
     def register_item(self, title: str, desc: str, image_url: str, cost: int) -> bool:
         """
@@ -368,12 +926,14 @@ class Database:
         if (existing_item := self.find_item(title)) is not None:
             return False
 
-        c = self.conn.cursor()
-        c.execute('''INSERT INTO item_definitions (title, title_upper, desc, image_url, cost)
-                     VALUES (?, ?, ?, ?, ?)''',
-                     [title, title.upper(), desc, image_url, cost])
-        self.conn.commit()
-        c.close()
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('''INSERT INTO item_definitions (title, title_upper, desc, image_url, cost)
+                         VALUES (?, ?, ?, ?, ?)''',
+                         [title, title.upper(), desc, image_url, cost])
+            item = ItemDefinition(c.lastrowid, title, desc, image_url, cost)
+            c.close()
+            self.after_commit(lambda: self.catalog.add(item))
 
         return True
 
@@ -382,35 +942,219 @@ class Database:
         Deletes an item from the item definition table. This action cannot be
         undone (feasibly).
         """
-        c = self.conn.cursor()
-        c.execute('''DELETE FROM item_definitions
-                     WHERE title_upper=?''', [item_title.upper()])
-        self.conn.commit()
-        c.close()
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('''DELETE FROM item_definitions
+                         WHERE title_upper=?''', [item_title.upper()])
+            c.close()
+            self.after_commit(lambda: self.catalog.remove(item_title))
 
     def give_coins(self, user_tid: int, message_id: int, message_date: datetime.datetime, num_coins: int) -> bool:
         """
         Updates the balance of the specified user to include more or less
         coins. Does not do bounds checking on the amount of coins. Also assumes
         that `user_tid` is a valid table user id.
-        """
 
-        balance = self.get_balance(user_tid)
-        if balance is None or balance + num_coins < min(balance, 0):
-            return False
+        The balance check happens inside the same write transaction as the
+        update, so no other connection can change the balance in between.
+        """
+        with self.transaction():
+            balance = self.get_balance(user_tid)
+            if balance is None or balance + num_coins < min(balance, 0):
+                return False
 
-        c = self.conn.cursor()
-        c.execute('''INSERT INTO coin_gains (message_id, user_id, date_entered, coins)
-                     VALUES (?, ?, ?, ?)''',
-                     [str(message_id), user_tid, message_date, num_coins])
-        c.execute('''UPDATE users
-                     SET coins=?
-                     WHERE id=?''', [balance + num_coins, user_tid])
-        self.conn.commit()
-        c.close()
+            c = self.conn.cursor()
+            c.execute('''INSERT INTO coin_gains (message_id, user_id, date_entered, coins)
+                         VALUES (?, ?, ?, ?)''',
+                         [str(message_id), user_tid, message_date, num_coins])
+            c.execute('''UPDATE users
+                         SET coins=coins + ?
+                         WHERE id=?''', [num_coins, user_tid])
+            c.close()
+            self.after_commit(lambda: self.ranking.update([(user_tid, balance + num_coins)]))
 
         return True
 
+    def give_coins_bulk(self, discord_ids: List[int], message_id: int, message_date: datetime.datetime, num_coins: int) -> Tuple[List[int], List[int]]:
+        """
+        Gives the same number of coins to many discord users at once, in one
+        transaction. Users are looked up and paid set-wise instead of one at a
+        time, so this costs a handful of statements no matter how many users
+        there are.
+
+        Returns the discord ids that were paid, followed by the ones that
+        weren't because they aren't registered (or, when taking coins away,
+        don't have enough of them).
+        """
+        discord_ids = list(dict.fromkeys(int(discord_id) for discord_id in discord_ids))
+
+        with self.transaction():
+            c = self.conn.cursor()
+            balances = {}
+            for start in range(0, len(discord_ids), MAX_QUERY_PARAMETERS):
+                chunk = discord_ids[start:start + MAX_QUERY_PARAMETERS]
+                c.execute(f'''SELECT user_id, id, coins FROM users
+                              WHERE user_id IN ({", ".join("?" * len(chunk))})''',
+                              [str(discord_id) for discord_id in chunk])
+                for user_id, user_tid, balance in c.fetchall():
+                    balances[int(user_id)] = (user_tid, balance)
+
+            def cache_identities():
+                for discord_id, (user_tid, _) in balances.items():
+                    self.identities.put(discord_id, user_tid)
+            self.after_commit(cache_identities)
+
+            paid = []
+            skipped = []
+            for discord_id in discord_ids:
+                if (row := balances.get(discord_id)) is None:
+                    skipped.append(discord_id)
+                elif row[1] + num_coins < min(row[1], 0):
+                    skipped.append(discord_id)
+                else:
+                    paid.append(discord_id)
+
+            user_tids = [balances[discord_id][0] for discord_id in paid]
+            c.executemany('''INSERT INTO coin_gains (message_id, user_id, date_entered, coins)
+                             VALUES (?, ?, ?, ?)''',
+                             [(str(message_id), user_tid, message_date, num_coins) for user_tid in user_tids])
+            for start in range(0, len(user_tids), MAX_QUERY_PARAMETERS):
+                chunk = user_tids[start:start + MAX_QUERY_PARAMETERS]
+                c.execute(f'''UPDATE users
+                              SET coins=coins + ?
+                              WHERE id IN ({", ".join("?" * len(chunk))})''',
+                              [num_coins] + chunk)
+            c.close()
+            new_balances = [(balances[discord_id][0], balances[discord_id][1] + num_coins) for discord_id in paid]
+            self.after_commit(lambda: self.ranking.update(new_balances))
+
+        return paid, skipped
+
+    def import_users(self, users: List[ImportedUser], date: datetime.datetime) -> ImportCounts:
+        """
+        Loads users' balances and backpacks into the database in one
+        transaction, registering anyone who isn't yet. Balances and item
+        counts are set to the imported values, not added to them. Each
+        balance that changes gets a coin gain (with no message) for the
+        difference, so the ledger still adds up to the balance. Items imported
+        with a count of 0 are set to 0 if the user has them, and not added
+        otherwise.
+
+        Everything is done set-wise with `executemany`, so this takes a
+        handful of statements however many users there are. Backpack items
+        whose title isn't registered are skipped and returned.
+        """
+        discord_ids = list(dict.fromkeys(user.discord_id for user in users))
+        unknown_items = {}
+
+        with self.transaction():
+            c = self.conn.cursor()
+            c.executemany('''INSERT INTO users (user_id, coins) VALUES (?, 0)
+                             ON CONFLICT (user_id) DO NOTHING''',
+                             [(str(discord_id),) for discord_id in discord_ids])
+            users_created = c.rowcount
+
+            balances = {}
+            for start in range(0, len(discord_ids), MAX_QUERY_PARAMETERS):
+                chunk = discord_ids[start:start + MAX_QUERY_PARAMETERS]
+                c.execute(f'''SELECT user_id, id, coins FROM users
+                              WHERE user_id IN ({", ".join("?" * len(chunk))})''',
+                              [str(discord_id) for discord_id in chunk])
+                for user_id, user_tid, balance in c.fetchall():
+                    balances[int(user_id)] = (user_tid, balance)
+
+            adjustments = []
+            backpack = []
+            for user in users:
+                user_tid, balance = balances[user.discord_id]
+                if user.coins is not None and user.coins != balance:
+                    adjustments.append((user_tid, user.coins - balance))
+                    balances[user.discord_id] = (user_tid, user.coins)
+                for title, count in user.backpack.items():
+                    if (item := self.catalog.find(title)) is None:
+                        if count != 0:
+                            unknown_items[title] = None
+                    else:
+                        backpack.append((item.tid, user_tid, count))
+
+            c.executemany('''INSERT INTO coin_gains (message_id, user_id, date_entered, coins)
+                             VALUES (NULL, ?, ?, ?)''',
+                             [(user_tid, date, delta) for user_tid, delta in adjustments])
+            c.executemany('''UPDATE users
+                             SET coins=coins + ?
+                             WHERE id=?''',
+                             [(delta, user_tid) for user_tid, delta in adjustments])
+            # Rows that already have the right count aren't touched at all,
+            # so importing the same sheet twice doesn't mark them for export
+            c.executemany('''INSERT INTO item_backpack (item_id, user_id, count)
+                             VALUES (?, ?, ?)
+                             ON CONFLICT (user_id, item_id) DO UPDATE
+                             SET count=excluded.count
+                             WHERE count != excluded.count''',
+                             [row for row in backpack if row[2] != 0])
+            backpack_rows = c.rowcount
+            # Every blank cell on the sheet is a 0, so zeros only update the
+            # rows that exist instead of adding one per user per item
+            c.executemany('''UPDATE item_backpack
+                             SET count=0
+                             WHERE item_id=? AND user_id=? AND count != 0''',
+                             [(item_tid, user_tid) for item_tid, user_tid, count in backpack if count == 0])
+            backpack_rows += c.rowcount
+            c.close()
+
+            def cache_identities():
+                for discord_id, (user_tid, balance) in balances.items():
+                    self.identities.put(discord_id, user_tid)
+                    self.ranking.add(user_tid, discord_id, balance)
+            self.after_commit(cache_identities)
+
+        return ImportCounts(users_created, len(adjustments), backpack_rows, list(unknown_items))
+
+    def checkpoint_ledgers(self, user_tids: List[int]):
+        """
+        Moves the given users' checkpoints up to their latest coin gain, so
+        the next check only has to add up coin gains after that
+        """
+        with self.transaction():
+            c = self.conn.cursor()
+            for start in range(0, len(user_tids), MAX_QUERY_PARAMETERS):
+                chunk = user_tids[start:start + MAX_QUERY_PARAMETERS]
+                c.execute(f'''INSERT INTO coin_checkpoints (user_id, gain_id, total)
+                              SELECT g.user_id, MAX(g.id), COALESCE(cp.total, 0) + SUM(g.coins)
+                              FROM coin_gains g
+                              LEFT JOIN coin_checkpoints cp ON cp.user_id = g.user_id
+                              WHERE g.user_id IN ({", ".join("?" * len(chunk))})
+                                AND g.id > COALESCE(cp.gain_id, 0)
+                              GROUP BY g.user_id
+                              ON CONFLICT (user_id) DO UPDATE
+                              SET gain_id=excluded.gain_id, total=excluded.total''', chunk)
+            c.close()
+
+    def rebuild_balances(self, user_tids: List[int]) -> int:
+        """
+        Sets the given users' balances to what their coin gains add up to.
+        Returns how many balances actually changed.
+        """
+        with self.transaction():
+            c = self.conn.cursor()
+            changes = []
+            for start in range(0, len(user_tids), MAX_QUERY_PARAMETERS):
+                chunk = user_tids[start:start + MAX_QUERY_PARAMETERS]
+                c.execute(f'''SELECT u.id, {LEDGER_TOTAL_SQL}
+                              FROM users u
+                              LEFT JOIN coin_checkpoints cp ON cp.user_id = u.id
+                              WHERE u.id IN ({", ".join("?" * len(chunk))})
+                                AND u.coins != {LEDGER_TOTAL_SQL}''', chunk)
+                changes += [(ledger, user_tid) for user_tid, ledger in c.fetchall()]
+
+            c.executemany('''UPDATE users
+                             SET coins=?
+                             WHERE id=?''', changes)
+            c.close()
+            self.after_commit(lambda: self.ranking.update([(user_tid, coins) for coins, user_tid in changes]))
+
+        return len(changes)
+
     def update_coin_gain(self, coin_gain_tid: int, new_coins: int) -> bool:
         """
         Updates a specified coin gain to reflect a new number of coins. Also
@@ -419,51 +1163,154 @@ class Database:
 
         Returns True iff the update succeeded
         """
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('''SELECT id, message_id, user_id, date_entered, coins
+                         FROM coin_gains
+                         WHERE id=?''', [coin_gain_tid])
+            rows = c.fetchall()
+
+            if len(rows) == 0:
+                return False # No coin gain to update
+
+            coin_gain = CoinGain(*rows[0])
+
+            c.execute('''UPDATE users
+                         SET coins=coins + ?
+                         WHERE id=?''', [new_coins - coin_gain.coins, coin_gain.user_id])
+            if c.rowcount == 0:
+                log.debug(f"No corresponding user {coin_gain.user_id} to update coin gain for")
+                return False
+            balance = self.get_balance(coin_gain.user_id)
+            self.after_commit(lambda: self.ranking.update([(coin_gain.user_id, balance)]))
+            c.execute('''UPDATE coin_gains
+                         SET coins=?
+                         WHERE id=?''', [new_coins, coin_gain_tid])
+            # History before the checkpoint changed, so its total has to as well
+            c.execute('''UPDATE coin_checkpoints
+                         SET total=total + ?
+                         WHERE user_id=? AND gain_id >= ?''',
+                         [new_coins - coin_gain.coins, coin_gain.user_id, coin_gain_tid])
+            c.close()
+
+        return True
 
+    def score_piece(self, user_tid: int, message_id: int, message_date: datetime.datetime, coins: int) -> int:
+        """
+        Sets how many coins a message earned its author, whether it was never
+        scored before, is being re-scored, or is being un-scored (0 coins).
+        The message has a single coin gain, updated in place, and the user's
+        balance moves by the difference. Doing the same thing twice changes
+        nothing, and un-scoring a message that was never scored doesn't add a
+        0 coin gain. Assumes `user_tid` is a valid table user id.
+
+        Returns how much the user's balance changed by.
+
+        Every statement is a lookup on a unique index, so this costs the same
+        however long the user's history is.
+        """
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('''SELECT id, coins FROM coin_gains
+                         WHERE message_id=? AND user_id=?''', [str(message_id), user_tid])
+            rows = c.fetchall()
+            old_coins = rows[0][1] if rows else 0
+            if old_coins == coins:
+                return 0
+
+            c.execute('''INSERT INTO coin_gains (message_id, user_id, date_entered, coins)
+                         VALUES (?, ?, ?, ?)
+                         ON CONFLICT (message_id, user_id) DO UPDATE
+                         SET coins=excluded.coins''',
+                         [str(message_id), user_tid, message_date, coins])
+            delta = coins - old_coins
+            c.execute('''UPDATE users
+                         SET coins=coins + ?
+                         WHERE id=?''', [delta, user_tid])
+            if rows:
+                # Re-scoring edits history the checkpoint may already cover
+                c.execute('''UPDATE coin_checkpoints
+                             SET total=total + ?
+                             WHERE user_id=? AND gain_id >= ?''', [delta, user_tid, rows[0][0]])
+            c.close()
+
+            balance = self.get_balance(user_tid)
+            self.after_commit(lambda: self.ranking.update([(user_tid, balance)]))
+
+        return delta
+
+    def get_piece_emojis(self, message_id: int) -> Set[str]:
+        """
+        Returns the star and category emojis at least one admin has on a piece
+        """
         c = self.conn.cursor()
-        c.execute('''SELECT id, message_id, user_id, date_entered, coins
-                     FROM coin_gains
-                     WHERE id=?''', [coin_gain_tid])
-        rows = c.fetchall()
+        c.execute('SELECT DISTINCT emoji FROM piece_reactions WHERE message_id=?', [str(message_id)])
+        emojis = {emoji for emoji, in c.fetchall()}
+        c.close()
 
-        if len(rows) == 0:
-            return False # No coin gain to update
-        if len(rows) > 1:
-            # Unexpected condition, log and continue
-            log.warn(f"Coin Gain {coin_gain_tid} recorded multiple times??")
+        return emojis
 
-        coin_gain = CoinGain(*row[0])
+    def set_piece_reaction(self, message_id: int, admin_id: int, emoji: str, present: bool) -> Set[str]:
+        """
+        Records an admin adding (`present`) or removing a reaction on a piece.
+        Returns the emojis at least one admin has on it afterwards.
+        """
+        with self.transaction():
+            if present:
+                self.conn.execute('''INSERT INTO piece_reactions (message_id, emoji, admin_id) VALUES (?, ?, ?)
+                                     ON CONFLICT DO NOTHING''',
+                                     [str(message_id), emoji, str(admin_id)])
+            else:
+                self.conn.execute('DELETE FROM piece_reactions WHERE message_id=? AND emoji=? AND admin_id=?',
+                                  [str(message_id), emoji, str(admin_id)])
+            return self.get_piece_emojis(message_id)
+
+    def replace_piece_reactions(self, message_id: int, reactions: List[Tuple[int, str]]) -> Set[str]:
+        """
+        Replaces everything recorded about a piece's reactions with the
+        `(admin id, emoji)` pairs read from discord. Returns the emojis at
+        least one admin has on it.
+        """
+        with self.transaction():
+            self.conn.execute('DELETE FROM piece_reactions WHERE message_id=?', [str(message_id)])
+            self.conn.executemany('INSERT INTO piece_reactions (message_id, emoji, admin_id) VALUES (?, ?, ?)',
+                                  [(str(message_id), emoji, str(admin_id)) for admin_id, emoji in set(reactions)])
 
-        if (user_tid := self.get_user_tid(coin_gain.user_id)) is None:
-            log.debug(f"No corresponding user {coin_gain.user_id} to update coin gain for")
-            return False
-        if (balance := self.get_balance(user_tid)) is None:
-            log.warn(f"User {coin_gain.user_id} registered but no balance?")
-            return False
+        return {emoji for _, emoji in reactions}
 
-        new_balance = balance + new_coins - coin_gain.coins
-        c.execute('''UPDATE coin_gains
-                     SET coins=?
-                     WHERE id=?''', [new_coins, coin_gain_tid])
-        c.execute('''UPDATE users
-                     SET coins=?
-                     WHERE id=?''', [new_balance, user_tid])
-        self.conn.commit()
-        c.close()
+    def get_job_state(self, name: str) -> Optional[str]:
+        """
+        Returns what a background job saved about how far it got, or None if
+        it never saved anything
+        """
+        row = self.conn.execute('SELECT value FROM job_state WHERE name=?', [name]).fetchone()
+        return None if row is None else row[0]
 
-        return True
+    def set_job_state(self, name: str, value: Optional[str]):
+        """
+        Saves how far a background job got, or forgets it if `value` is None
+        """
+        with self.transaction():
+            if value is None:
+                self.conn.execute('DELETE FROM job_state WHERE name=?', [name])
+            else:
+                self.conn.execute('''INSERT INTO job_state (name, value) VALUES (?, ?)
+                                     ON CONFLICT (name) DO UPDATE SET value=excluded.value''',
+                                     [name, value])
 
     def give_item(self, user_tid: int, item_tid: int) -> bool:
         """
         Unconditionally gives a user the specified item. Assumes that both
         user_tid and item_tid are valid table ids.
         """
-        if (bpi := self.user_has_item(user_tid, item_tid)) is None:
-            bpi = BackpackItem(item_tid, user_tid, 1)
-        else:
-            bpi.count += 1
-
-        self.update_backpack_item(bpi)
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('''INSERT INTO item_backpack (item_id, user_id, count)
+                         VALUES (?, ?, 1)
+                         ON CONFLICT (user_id, item_id) DO UPDATE
+                         SET count=count + 1''',
+                         [item_tid, user_tid])
+            c.close()
 
         return True
 
@@ -473,15 +1320,18 @@ class Database:
         if the user is not registered or doesn't have enough coins. If the item
         is successfully bought, return True.
 
+        The payment and the item land in the same transaction, so a purchase
+        can never be half-recorded.
+
         The ItemDefinition to buy must be acquired by find_item or through
         the get_item_definitions function calls, not constructed manually
         (bad idea).
         """
-        if not self.give_coins(user_tid, message_id, message_date, -item.cost):
-            return False
+        with self.transaction():
+            if not self.give_coins(user_tid, message_id, message_date, -item.cost):
+                return False
 
-        if not self.give_item(user_tid, item.tid):
-            return False
+            self.give_item(user_tid, item.tid)
 
         return True
 
@@ -491,27 +1341,89 @@ class Database:
         valid. Returns False when the user doesn't have the item or doesn't
         have enough of that item.
 
-        Really, there should be a Lock here so that we don't have races for
-        using an item multiple times when there's only one, but as long as we
-        aren't multithreaded we should be fine (thank goodness for Asyncio!).
+        The check and the decrement are a single statement, so two uses racing
+        each other (from any thread or connection) can never spend the same
+        item twice.
         """
-        if (bpi := self.user_has_item(user_tid, item_tid)) is None:
-            return False
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('''UPDATE item_backpack
+                         SET count=count - 1
+                         WHERE user_id=? AND item_id=? AND count > 0''',
+                         [user_tid, item_tid])
+            used = c.rowcount == 1
+            c.close()
 
-        if bpi.count <= 0:
-            return False
-        else:
-            bpi.count -= 1
-            self.update_backpack_item(bpi)
-            return True
+        return used
+
+    def select_admin_roles(self) -> List[Tuple[int, int]]:
+        """
+        Reads every `(guild id, role id)` from the admin roles table.
+        Everything else should go through `self.admin_roles` instead.
+        """
+        c = self.conn.cursor()
+        c.execute('SELECT guild_id, role_id FROM admin_roles')
+        rows = c.fetchall()
+        c.close()
+
+        return [(int(guild_id), int(role_id)) for guild_id, role_id in rows]
+
+    def add_admin_role(self, guild_id: int, role_id: int, default_role_ids: Iterable[int] = ()) -> bool:
+        """
+        Makes everyone with a role a bot admin in a guild. Returns False if it
+        already was an admin role.
+
+        If the guild had no admin roles of its own yet, `default_role_ids` are
+        added along with it, so that whoever was an admin through the
+        defaults stays one.
+        """
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('SELECT 1 FROM admin_roles WHERE guild_id=? LIMIT 1', [str(guild_id)])
+            first = c.fetchone() is None
+            c.execute('''INSERT INTO admin_roles (guild_id, role_id) VALUES (?, ?)
+                         ON CONFLICT DO NOTHING''',
+                         [str(guild_id), str(role_id)])
+            added = c.rowcount == 1
+            kept_ids = [default_id for default_id in default_role_ids if default_id != role_id] if first else []
+            c.executemany('''INSERT INTO admin_roles (guild_id, role_id) VALUES (?, ?)
+                             ON CONFLICT DO NOTHING''',
+                             [(str(guild_id), str(default_id)) for default_id in kept_ids])
+            c.close()
+            if added:
+                def cache_roles():
+                    for added_id in (role_id, *kept_ids):
+                        self.admin_roles.add(guild_id, added_id)
+                self.after_commit(cache_roles)
+
+        return added
+
+    def remove_admin_role(self, guild_id: int, role_id: int) -> bool:
+        """
+        Stops a role from making anyone a bot admin in a guild. Returns False
+        if it wasn't an admin role.
+        """
+        with self.transaction():
+            c = self.conn.cursor()
+            c.execute('DELETE FROM admin_roles WHERE guild_id=? AND role_id=?',
+                      [str(guild_id), str(role_id)])
+            removed = c.rowcount == 1
+            c.close()
+            if removed:
+                self.after_commit(lambda: self.admin_roles.remove(guild_id, role_id))
+
+        return removed
 
 if __name__ == "__main__":
     """
-    If we are run directly, recreate the database
+    If we are run directly, upgrade the database in place
     """
-    resp = input("This will delete the database and start fresh, are you sure you want to do this? [y/N]: ")
-    if 'y' in resp.lower():
-        delete_database()
-        conn = sqlite3.connect(DATABASE_FILE)
-        create_database(conn)
-        conn.close()
+    logging.basicConfig(level=logging.INFO)
+    conn = connect_database(DATABASE_FILE)
+    old_version, new_version = migrate_database(conn)
+    conn.close()
+
+    if old_version == new_version:
+        print(f"Database already up to date (version {new_version})")
+    else:
+        print(f"Database migrated from version {old_version} to {new_version}")
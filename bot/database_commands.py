@@ -3,10 +3,12 @@ from discord.ext import commands
 import logging
 log = logging.getLogger(__name__)
 import re
-from typing import List
+from typing import Dict, List, Optional, Tuple, Union
 
 from .commands import Commands
-from .database import Database, ItemDefinition, BackpackItem
+from .async_database import AsyncDatabase
+from .database import ItemDefinition, BackpackEntry, CoinGain
+from .paginator import ReactionPaginator
 from .permissions import check_user, is_admin
 
 URL_REGEX = re.compile(
@@ -17,14 +19,34 @@ r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})' # ...or ip
 r'(?::\d+)?' # optional port
 r'(?:/?|[/?]\S+)$', re.IGNORECASE)
 
+# Discord refuses to send embeds with more fields than this
+EMBED_FIELD_LIMIT = 25
+
+# How many items `ca!list` shows per page, unless configured otherwise
+ITEM_PAGE_SIZE = 12
+
+# How many items to suggest when a title doesn't match any item
+SUGGESTION_COUNT = 3
+
+# How many coin gains `ca!history` shows per page
+HISTORY_PAGE_SIZE = 10
+
+# How many places `ca!leaderboard` shows unless asked for more
+LEADERBOARD_DEFAULT_SIZE = 10
+
 def validate_url(s: str):
     return re.match(URL_REGEX, s) is not None
 
 class DatabaseCommands(Commands):
     """WIP: Commands for interacting with and updating the bot's database"""
 
-    def __init__(self, database: Database):
+    def __init__(self, database: AsyncDatabase, item_page_size: int = ITEM_PAGE_SIZE):
         self.database = database
+        self.item_page_size = max(1, min(item_page_size, EMBED_FIELD_LIMIT))
+        # (catalog version, items at that version, page index -> rendered embed)
+        self._item_pages: Optional[Tuple[int, List[ItemDefinition], Dict[int, discord.Embed]]] = None
+        # size -> (ranking top_version, rendered embed)
+        self._leaderboard_embeds: Dict[int, Tuple[int, discord.Embed]] = {}
 
     def setup(self, bot):
         item_group = self.group(bot, self.item_group_entry, name="items")
@@ -39,30 +61,67 @@ class DatabaseCommands(Commands):
         self.command(user_group, self.register_user_admin, name="register")
         self.command(user_group, self.get_user_backpack, name="backpack")
         self.command(bot, self.get_user_backpack, name="backpack")
+        self.command(user_group, self.coin_history, name="history")
+        self.command(bot, self.coin_history, name="history")
 
         self.command(bot, self.buy_item, name="buy")
         self.command(bot, self.give_coins, name="givecoin")
+        self.command(bot, self.give_coins_bulk, name="givecoins")
+        self.command(bot, self.cache_stats, name="stats")
+        self.command(bot, self.leaderboard, name="leaderboard", aliases=["top"])
 
-    def make_item_list_embed(self, items: List[ItemDefinition]) -> discord.Embed:
+    def make_item_list_embed(self, items: List[ItemDefinition], page: int, page_count: int) -> discord.Embed:
         embed = discord.Embed(title="Item List", type="rich")
         for item in items:
             embed.add_field(name=item.title, value=f"{item.cost} coins")
+        if page_count > 1:
+            embed.set_footer(text=f"Page {page + 1} of {page_count}")
 
         return embed
 
-    def make_backpack_embed(self, items: List[BackpackItem]) -> discord.Embed:
-        embed = discord.Embed(title="Backpack", type="rich")
+    def item_list_pages(self) -> Tuple[int, List[ItemDefinition], Dict[int, discord.Embed]]:
+        """
+        Returns the items in the store and the item list pages rendered so
+        far, starting over whenever the catalog changed since
+        """
+        version = self.database.catalog.version
+        if self._item_pages is None or self._item_pages[0] != version:
+            self._item_pages = (*self.database.catalog.snapshot(), {})
+        return self._item_pages
 
-        item_data = []
-        for bpi in items:
-            item = self.database.backpack_item_to_definition(bpi)
-            if item is not None:
-                item_data.append((item.title, bpi.count))
+    def item_list_page(self, items: List[ItemDefinition], pages: Dict[int, discord.Embed], index: int) -> Optional[discord.Embed]:
+        """
+        Returns page `index` of the item list, rendering it only the first
+        time anyone asks for it
+        """
+        page_count = -(-len(items) // self.item_page_size)
+        if not 0 <= index < page_count:
+            return None
+        if (embed := pages.get(index)) is None:
+            start = index * self.item_page_size
+            embed = pages[index] = self.make_item_list_embed(items[start:start + self.item_page_size], index, page_count)
+        return embed
 
-        item_data.sort(key=lambda t: t[1], reverse=True)
+    def make_history_embed(self, user: discord.User, gains: List[CoinGain], page: int) -> discord.Embed:
+        lines = []
+        for gain in gains:
+            line = f"**{gain.coins:+}** coins on {str(gain.date_entered)[:16]}"
+            if gain.message_id is not None:
+                line += f" (message {gain.message_id})"
+            lines.append(line)
 
-        for title, count in item_data:
-            embed.add_field(name=title, value=f"x{count}")
+        embed = discord.Embed(title=f"Coin History for {user.display_name}", type="rich", description="\n".join(lines))
+        embed.set_footer(text=f"Page {page + 1}")
+        return embed
+
+    def make_leaderboard_embed(self, top: List[Tuple[int, int, int]]) -> discord.Embed:
+        lines = [f"**#{place}** <@{discord_id}>: {coins} coins" for place, discord_id, coins in top]
+        return discord.Embed(title="Leaderboard", type="rich", description="\n".join(lines))
+
+    def make_backpack_embed(self, entries: List[BackpackEntry]) -> discord.Embed:
+        embed = discord.Embed(title="Backpack", type="rich")
+        for entry in entries:
+            embed.add_field(name=entry.title, value=f"x{entry.count}")
 
         return embed
 
@@ -77,13 +136,19 @@ class DatabaseCommands(Commands):
         """
         List all the items in the store
         """
-        await ctx.channel.trigger_typing()
-        items = self.database.get_item_definitions()
-
+        _, items, pages = self.item_list_pages()
         if len(items) == 0:
-            await ctx.send("Items? We don't have any yet!")
-        else:
-            await ctx.send(embed=self.make_item_list_embed(items))
+            await self.reply(ctx, "Items? We don't have any yet!")
+            return
+
+        # Holds on to this version's items and pages, so turning pages keeps
+        # showing the same list even if the store changes in the meantime
+        async def render_page(index):
+            return self.item_list_page(items, pages, index)
+
+        paginator = ReactionPaginator(render_page, page_count=-(-len(items) // self.item_page_size),
+                                      responder=self.responder)
+        await paginator.run(ctx)
 
     @check_user(is_admin)
     async def register_item(self, ctx, title: str, desc: str, image_url: str, cost: int):
@@ -91,38 +156,50 @@ class DatabaseCommands(Commands):
         (ADMIN ONLY) Add a new item to the store
         """
         if cost < 0:
-            await ctx.send(f"A cost of **{cost} coins** doesn't really make sense...")
+            await self.reply(ctx, f"A cost of **{cost} coins** doesn't really make sense...")
             return
 
         if not validate_url(image_url):
-            await ctx.send(f"Image url {image_url} doesn't look like a URL to me...")
+            await self.reply(ctx, f"Image url {image_url} doesn't look like a URL to me...")
             return
 
-        await ctx.channel.trigger_typing()
-        did_register = self.database.register_item(title, desc, image_url, cost)
+        self.typing(ctx)
+        did_register = await self.database.register_item(title, desc, image_url, cost)
+        self._item_pages = None
 
         if did_register:
-            await ctx.send(f"Successfully registered item **\"{title}\"**!")
+            await self.reply(ctx, f"Successfully registered item **\"{title}\"**!")
         else:
-            await ctx.send(f"Item \"{title}\" already registered.")
+            await self.reply(ctx, f"Item \"{title}\" already registered.")
 
     @check_user(is_admin)
     async def unregister_item(self, ctx, title: str):
         """
         (ADMIN ONLY) Remove an item from the store
         """
-        await ctx.channel.trigger_typing()
-        self.database.unregister_item(title)
+        self.typing(ctx)
+        await self.database.unregister_item(title)
+        self._item_pages = None
+
+        await self.reply(ctx, f"Item \"{title}\" removed from store (if it existed!)")
 
-        await ctx.send(f"Item \"{title}\" removed from store (if it existed!)")
+    async def did_you_mean(self, title: str) -> str:
+        """
+        Returns a sentence suggesting items `title` might have meant, or a
+        guess at what went wrong if there aren't any
+        """
+        suggestions = await self.database.suggest_items(title, SUGGESTION_COUNT)
+        if len(suggestions) == 0:
+            return " Did you spell it wrong?"
+        return " Did you mean " + " or ".join(f"**\"{item.title}\"**" for item in suggestions) + "?"
 
     async def item_details(self, ctx, title: str):
         """
         View details about an item
         """
-        await ctx.channel.trigger_typing()
-        if (item := self.database.find_item(title)) is None:
-            await ctx.send(f"Could not find item \"{title}\"! Did you spell it wrong?")
+        self.typing(ctx)
+        if (item := await self.database.find_item(title)) is None:
+            await self.reply(ctx, f"Could not find item \"{title}\"!" + await self.did_you_mean(title))
             return
 
         embed = discord.Embed(
@@ -133,82 +210,211 @@ class DatabaseCommands(Commands):
         embed.add_field(name="Cost", value=f"{item.cost} coins")
         embed.set_image(url=item.image_url)
 
-        await ctx.send(embed=embed)
+        await self.reply(ctx, embed=embed)
 
     async def user_group_entry(self, ctx):
         """
         Get information about yourself or other users
         """
         if ctx.invoked_subcommand is None:
-            await ctx.channel.trigger_typing()
-            balance = self.database.get_balance_discord(ctx.author.id)
-            await ctx.send(f"Your fake balance is **{balance} coins**!")
+            self.typing(ctx)
+            balance = await self.database.get_balance_discord(ctx.author.id)
+            await self.reply(ctx, f"Your fake balance is **{balance} coins**!")
 
     @check_user(is_admin)
     async def register_user_admin(self, ctx, user: discord.User):
         """
         (ADMIN ONLY) Register another user in the coin system
         """
-        await ctx.channel.trigger_typing()
+        self.typing(ctx)
 
-        _, already_registered = self.database.register_user(user.id)
+        _, already_registered = await self.database.register_user(user.id)
         if already_registered:
-            await ctx.send(f"User {user} already registered!")
+            await self.reply(ctx, f"User {user} already registered!")
         else:
-            await ctx.send(f"User {user} successfully registered!")
+            await self.reply(ctx, f"User {user} successfully registered!")
 
     async def register_user_self(self, ctx):
         """
         Register yourself for the coin system
         """
-        await ctx.channel.trigger_typing()
+        self.typing(ctx)
 
-        _, already_registered = self.database.register_user(ctx.author.id)
+        _, already_registered = await self.database.register_user(ctx.author.id)
         if already_registered:
-            await ctx.send(f"User {ctx.author} already registered!")
+            await self.reply(ctx, f"User {ctx.author} already registered!")
         else:
-            await ctx.send(f"User {ctx.author} successfully registered!")
+            await self.reply(ctx, f"User {ctx.author} successfully registered!")
 
     async def buy_item(self, ctx, item: str):
         """
         Buy an item from the store
         """
-        await ctx.channel.trigger_typing()
+        self.typing(ctx)
 
-        if (item_def := self.database.find_item(item)) is None:
-            await ctx.send(f"Item \"{item}\" doesn't exist!")
+        if (item_def := await self.database.find_item(item)) is None:
+            await self.reply(ctx, f"Item \"{item}\" doesn't exist!" + await self.did_you_mean(item))
             return
 
-        if self.database.buy_item_discord(
+        if await self.database.buy_item_discord(
             ctx.author.id,
             ctx.message.id, ctx.message.created_at,
             item_def):
-            await ctx.send(f"Cha-ching! You bought **{item}**! No refunds!")
+            await self.reply(ctx, f"Cha-ching! You bought **{item}**! No refunds!")
         else:
-            await ctx.send("You don't have enough coins :(")
+            await self.reply(ctx, "You don't have enough coins :(")
 
     @check_user(is_admin)
     async def give_coins(self, ctx, user: discord.User, coins: int):
         """
         (ADMIN ONLY): Users can have a little coin, as a treat
         """
-        await ctx.channel.trigger_typing()
+        self.typing(ctx)
 
-        if self.database.give_coins_discord(
+        if await self.database.give_coins_discord(
             user.id,
             ctx.message.id, ctx.message.created_at,
             coins):
-            await ctx.send(f"Gave {user} **{coins} coins**!")
+            await self.reply(ctx, f"Gave {user} **{coins} coins**!")
         else:
-            await ctx.send(f"Error giving {user} coins; are they registered?")
+            await self.reply(ctx, f"Error giving {user} coins; are they registered?")
+
+    @check_user(is_admin)
+    async def give_coins_bulk(self, ctx, coins: int, *targets: Union[discord.Member, discord.Role]):
+        """
+        (ADMIN ONLY): Give everyone mentioned, or everyone with a role, some coins
+        """
+        members = {}
+        for target in targets:
+            for member in (target.members if isinstance(target, discord.Role) else [target]):
+                if not member.bot:
+                    members[member.id] = member
+
+        if len(members) == 0:
+            await self.reply(ctx, "Who am I giving coins to? Mention some users or a role!")
+            return
+
+        self.typing(ctx)
+
+        paid, skipped = await self.database.give_coins_bulk(
+            list(members),
+            ctx.message.id, ctx.message.created_at,
+            coins)
+
+        response = f"Gave **{coins} coins** to {len(paid)} users!"
+        if skipped:
+            names = ", ".join(str(members[discord_id]) for discord_id in skipped[:10])
+            if len(skipped) > 10:
+                names += f" and {len(skipped) - 10} more"
+            response += f"\nCouldn't give coins to {names}; are they registered?"
+        await self.reply(ctx, response)
+
+    @check_user(is_admin)
+    async def cache_stats(self, ctx):
+        """
+        (ADMIN ONLY) Show how well the bot's caches are doing
+        """
+        embed = discord.Embed(title="Cache Stats", type="rich")
+
+        stats = self.database.identities.stats()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = stats["hits"] / lookups if lookups else 0.0
+        embed.add_field(
+            name="User IDs",
+            value=f"{stats['size']}/{stats['capacity']} cached\n"
+                  f"{stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0%})\n"
+                  f"{stats['hits']} queries saved"
+        )
+
+        catalog = self.database.catalog
+        embed.add_field(
+            name="Item Catalog",
+            value=f"{len(catalog)} items\nVersion {catalog.version}"
+        )
+
+        stats = self.database.admin_roles.stats()
+        embed.add_field(
+            name="Admin Checks",
+            value=f"{stats['guilds']} guilds with admin roles\n"
+                  f"{stats['members']} members cached\n"
+                  f"{stats['hits']} hits, {stats['misses']} misses"
+        )
+
+        stats = self.responder.stats()
+        embed.add_field(
+            name="Replies",
+            value=f"{stats['messages_sent']} messages sent, {stats['replies_merged']} merged\n"
+                  f"{stats['typing_sent']} typing sent, {stats['typing_elided']} elided, "
+                  f"{stats['typing_skipped']} skipped"
+        )
+
+        await self.reply(ctx, embed=embed)
+
+    async def coin_history(self, ctx, *, user: discord.User = None):
+        """
+        Look through how you or another user got (and spent) your coins
+        """
+        if user is None: user = ctx.author
+
+        if (user_tid := await self.database.get_user_tid(user.id)) is None:
+            await self.reply(ctx, f"User {user} isn't registered.")
+            return
+
+        # Where each page starts, filled in as pages are turned to. The
+        # paginator only ever moves one page at a time, so the previous
+        # page's cursor is always known.
+        cursors = {0: None}
+
+        async def render_page(index):
+            if index not in cursors:
+                return None
+            gains = await self.database.get_coin_gains_page(user_tid, cursors[index], HISTORY_PAGE_SIZE)
+            if len(gains) == 0:
+                return None
+            if len(gains) == HISTORY_PAGE_SIZE:
+                cursors[index + 1] = gains[-1].tid
+            return self.make_history_embed(user, gains, index)
+
+        paginator = ReactionPaginator(render_page, responder=self.responder)
+        if await paginator.page(0) is None:
+            await self.reply(ctx, f"{user} hasn't gotten any coins yet.")
+            return
+        await paginator.run(ctx)
+
+    async def leaderboard(self, ctx, size: int = LEADERBOARD_DEFAULT_SIZE):
+        """
+        Show the richest users, and where you stand
+        """
+        size = max(1, min(size, self.database.ranking.tracked))
+
+        # Only re-rendered when the top of the leaderboard actually changed
+        version = self.database.ranking.top_version
+        if (cached := self._leaderboard_embeds.get(size)) is not None and cached[0] == version:
+            embed = cached[1]
+        else:
+            top = await self.database.get_top_balances(size)
+            if len(top) == 0:
+                await self.reply(ctx, "Nobody has any coins yet!")
+                return
+            embed = self.make_leaderboard_embed(top)
+            self._leaderboard_embeds[size] = (version, embed)
+
+        if (rank := await self.database.get_rank(ctx.author.id)) is None:
+            content = "You aren't registered yet, so you're not on the leaderboard."
+        else:
+            place, coins = rank
+            content = f"You're **#{place}** of {len(self.database.ranking)} with **{coins} coins**."
+
+        # The mentions in the embed are just for showing names, don't ping anyone
+        await self.reply(ctx, content, embed=embed, allowed_mentions=discord.AllowedMentions.none())
 
     async def get_user_backpack(self, ctx, *, user: discord.User = None):
         """
         List the items in your or another user's backpack
         """
-        await ctx.channel.trigger_typing()
+        self.typing(ctx)
 
         if user is None: user = ctx.author
 
-        items = self.database.get_backpack_items(user.id)
-        await ctx.send(embed=self.make_backpack_embed(items))
+        entries = await self.database.get_backpack_view(user.id, limit=EMBED_FIELD_LIMIT)
+        await self.reply(ctx, embed=self.make_backpack_embed(entries))
@@ -1,10 +1,13 @@
 import discord
 import logging
 log = logging.getLogger(__name__)
+import time
+from typing import List, Optional, Set, Tuple
 
-from .reactions import Reactions
-from .database import Database, ItemDefinition, BackpackItem
-from .permissions import is_admin
+from .reactions import Reactions, MESSAGE, USER
+from .async_database import AsyncDatabase
+from .backfill import Backfill
+from .permissions import check_user, is_admin
 
 """
 Provisional emoji plan:
@@ -27,43 +30,240 @@ EMOJI_SET = {
     '\U0001f360': "weekly",     # :sweet_potato:
     '\U0001f911': "monthly",    # :money_mouth:
     '\U0001f315': "full",       # :full_moon:
-    '\U0000fe0f': "event"       # :seven:
+    '7\ufe0f\u20e3': "event"    # :seven:
 }
 
+STAR = '\U00002b50' # :star:
+
+# Coins a counted piece earns, plus the points of each category it was
+# reacted with
+BASE_POINTS = 1
+CATEGORY_POINTS = {
+    "oc": 2,
+    "daily": 1,
+    "weekly": 3,
+    "monthly": 5,
+    "full": 3,
+    "event": 2,
+}
+
+# Precomputed so that scoring a message is one lookup per reaction on it
+EMOJI_POINTS = {emoji: CATEGORY_POINTS[category] for emoji, category in EMOJI_SET.items()}
+
+def score_emojis(emojis: Set[str]) -> int:
+    """
+    Returns how many coins a piece is worth, given the star and category
+    emojis admins have on it. Pieces no admin starred are worth nothing.
+    """
+    if STAR not in emojis:
+        return 0
+    return BASE_POINTS + sum(EMOJI_POINTS.get(emoji, 0) for emoji in emojis)
+
+async def admin_reactions(message: discord.Message) -> List[Tuple[int, str]]:
+    """
+    Returns `(admin id, emoji)` for every star or category reaction an admin
+    put on a message; anyone can react, but only admins decide whether a
+    piece counts and what category it is in. Costs a request for the users
+    of each star or category reaction on it.
+    """
+    reactions = []
+    for reaction in message.reactions:
+        if not isinstance(reaction.emoji, str) or (reaction.emoji != STAR and reaction.emoji not in EMOJI_POINTS):
+            continue
+        async for reactor in reaction.users():
+            if is_admin(reactor):
+                reactions.append((reactor.id, reaction.emoji))
+    return reactions
+
 class DatabaseReactions(Reactions):
     """
     Watches for certain reactions signalling and art message to be counted and
     updates the user's point total in the database accordingly.
 
-    TODO: also update the google sheet
+    A piece in the art share channel is counted once an admin stars it, and
+    earns its author coins depending on which category reactions admins put
+    on it. Each message has at most one coin gain, which is updated in place
+    whenever the piece is starred, unstarred or re-categorized, so handling a
+    reaction costs the same no matter how many pieces have been counted.
+
+    Which admin put which star and category reaction on a piece is kept in
+    the database, so an event only has to apply its own reaction to that,
+    rather than asking discord who reacted with what. Only the first event
+    for a piece reads its reactions from discord.
+    Changes reach the Google Sheet through the exporter.
     """
-    def __init__(self, db: Database):
+    def __init__(self, db: AsyncDatabase):
         super().__init__()
         self.db = db
+        self.backfill = Backfill(db, ART_SHARE_CHANNEL, self.backfill_piece)
 
     def setup(self, bot):
         super().setup(bot)
-        self.reaction(self.also_add_robot, None, '\U0001f916') # :robot:
-        self.reaction(self.record_piece, self.try_erase_piece, '\U00002b50') # :star:
+        self.reaction(self.also_add_robot, None, '\U0001f916', needs={MESSAGE, USER}) # :robot:
+        for emoji in (STAR, *EMOJI_SET):
+            self.reaction(self.piece_reaction_handler(emoji, True), self.piece_reaction_handler(emoji, False), emoji,
+                          needs={MESSAGE, USER}, predicate=self.is_admin_piece_event)
+        self.command(bot, self.reaction_stats, name="reactionstats")
+        backfill_group = self.group(bot, self.backfill_group_entry, name="backfill")
+        self.command(backfill_group, self.start_backfill, name="start")
+        self.command(backfill_group, self.backfill_status, name="status")
+        self.command(backfill_group, self.stop_backfill, name="stop")
+
+    @check_user(is_admin)
+    async def reaction_stats(self, ctx):
+        """
+        (ADMIN ONLY) Show how many message fetches reaction handling is saving
+        """
+        stats = self.messages.stats()
+        fetches = stats["hits"] + stats["misses"] + stats["coalesced"]
+        saved = stats["hits"] + stats["coalesced"]
+        hit_rate = saved / fetches if fetches else 0.0
+
+        await self.reply(ctx,
+            f"Message cache: {stats['size']}/{stats['capacity']} cached, "
+            f"{stats['in_flight']} being fetched\n"
+            f"{stats['hits']} hits, {stats['coalesced']} coalesced, {stats['misses']} misses "
+            f"({hit_rate:.0%} of fetches saved)"
+        )
 
     async def also_add_robot(self, message, user, channel, guild):
         await message.add_reaction('\U0001f916') # :robot:
         log.info(f"Saw a robot from {user}!")
 
-    async def record_piece(self, message, user, channel, guild):
+    def is_admin_piece_event(self, rrae) -> bool:
+        """
+        Rules out reactions that can't change any piece's score, before the
+        message is fetched: anything outside the art share channel, or by
+        someone who isn't an admin
+        """
+        if rrae.channel_id != ART_SHARE_CHANNEL:
+            return False
+        return (member := self.event_member(rrae)) is not None and is_admin(member)
+
+    def is_piece(self, message: discord.Message) -> bool:
+        return message.channel.id == ART_SHARE_CHANNEL and not message.author.bot
+
+    async def score_piece(self, message: discord.Message, coins: int) -> int:
+        delta = await self.db.score_piece(message.author.id, message.id, message.created_at, coins)
+        if delta != 0:
+            log.info(f"Piece {message.id} by {message.author} is now worth {coins} coins ({delta:+})")
+        return delta
+
+    def piece_reaction_handler(self, emoji: str, present: bool):
+        """
+        Returns a reaction handler for an admin adding (`present`) or removing
+        `emoji` on a piece
+        """
+        async def handler(message, user, channel, guild):
+            await self.update_piece(message, user, emoji, present)
+
+        handler.__name__ = f"{'add' if present else 'remove'}_piece_reaction"
+        return handler
+
+    async def update_piece(self, message, user, emoji: str, present: bool):
         """
-        Check if an admin has reacted to a piece with :star:, updating the point
-        total awarded to the user by that piece if necessary.
+        Re-scores a piece after an admin added or removed one of its star or
+        category reactions
         """
         if user is None or not is_admin(user):
             return # Ignore non-admin responses
+        if not self.is_piece(message):
+            return
 
-        # Check if piece was already recorded
-        # TODO: finish this code
-        if (coin_gain := self.db.get_coin_gain_from_message(message.id)) is not None:
-            pass
+        if len(await self.db.get_piece_emojis(message.id)) == 0:
+            # Nothing is known about this piece yet, maybe because it was
+            # reacted to before the bot kept track. Its reactions are read
+            # once, this event's included.
+            await self.sync_piece(message)
+            return
+
+        emojis = await self.db.set_piece_reaction(message.id, user.id, emoji, present)
+        await self.score_piece(message, score_emojis(emojis))
+
+    async def sync_piece(self, message: discord.Message) -> int:
+        """
+        Reads every admin's star and category reactions on a piece from
+        discord, replacing what was known about them, and re-scores it.
+        Returns how much its score changed by.
+        """
+        message = await self.messages.fetch(message.channel, message.id, fresh=True)
+        emojis = await self.db.replace_piece_reactions(message.id, await admin_reactions(message))
+        return await self.score_piece(message, score_emojis(emojis))
+
+    async def backfill_piece(self, message: discord.Message) -> Optional[int]:
+        """
+        Re-scores a message the backfill came across, returning how much its
+        score changed by, or None if there is nothing to score
+        """
+        if not self.is_piece(message):
+            return None
+        if (not any(reaction.emoji == STAR or reaction.emoji in EMOJI_POINTS
+                    for reaction in message.reactions if isinstance(reaction.emoji, str))
+                and len(await self.db.get_piece_emojis(message.id)) == 0):
+            return None # Never reacted to, and still isn't
+
+        # The history page may be out of date by now, so the piece is read
+        # again, queued behind any live events for it so that neither can
+        # overwrite the other with something older
+        return await self.events.run(message.id, lambda: self.sync_piece(message))
+
+    @check_user(is_admin)
+    async def backfill_group_entry(self, ctx):
+        """
+        (ADMIN ONLY) Score pieces that were starred while the bot wasn't looking
+        """
+        if ctx.invoked_subcommand is None:
+            await self.backfill_status(ctx)
+
+    @check_user(is_admin)
+    async def start_backfill(self, ctx, from_scratch: bool = False):
+        """
+        (ADMIN ONLY) Start going through the art share channel's history,
+        carrying on from where the last backfill stopped unless `from_scratch`
+        """
+        if (channel := self.bot.get_channel(ART_SHARE_CHANNEL)) is None:
+            await self.reply(ctx, "I can't see the art share channel!")
+            return
+
+        if self.backfill.running:
+            await self.reply(ctx, "A backfill is already running. Check on it with `ca!backfill status`.")
+            return
+
+        if from_scratch:
+            await self.backfill.reset()
+        self.backfill.start(channel)
+        await self.reply(ctx, f"Started backfilling {channel.mention}. Check on it with `ca!backfill status`.")
+
+    @check_user(is_admin)
+    async def backfill_status(self, ctx):
+        """
+        (ADMIN ONLY) Show how far the backfill got
+        """
+        backfill = self.backfill
+        if backfill.started_at is None:
+            await self.reply(ctx, "No backfill has run since the bot started.")
+            return
+
+        if backfill.running:
+            response = f"Backfilling for {time.time() - backfill.started_at:.0f}s: "
+        elif backfill.error is not None:
+            response = f"The backfill failed ({backfill.error}) after "
         else:
-            pass
+            response = f"The backfill finished {time.time() - backfill.finished_at:.0f}s ago after "
+        response += (f"scanning {backfill.scanned} messages, re-scoring {backfill.scored} reacted-to pieces "
+                     f"and changing the score of {backfill.changed}.")
+        if backfill.last_message_id is not None:
+            response += f"\nSaved up to message {backfill.last_message_id}."
+
+        await self.reply(ctx, response)
 
-    async def try_erase_piece(self, message, user, channel, guild):
-        pass
+    @check_user(is_admin)
+    async def stop_backfill(self, ctx):
+        """
+        (ADMIN ONLY) Stop the backfill; starting it again carries on from
+        where it stopped
+        """
+        if self.backfill.stop():
+            await self.reply(ctx, "Stopped the backfill.")
+        else:
+            await self.reply(ctx, "No backfill is running.")
@@ -0,0 +1,78 @@
+from collections import OrderedDict
+import logging
+log = logging.getLogger(__name__)
+import sqlite3
+import threading
+from typing import Dict, Optional
+
+class IdentityCache:
+    """
+    A bounded map from Discord user ids to table user ids (`users.id`), kept
+    in least-recently-used order so that the members who actually use the bot
+    stay cached.
+
+    A user's table id never changes once they are registered, so entries never
+    need invalidating; they only fall out when the cache is full. Safe to share
+    between the threads of an `AsyncDatabase`.
+    """
+
+    def __init__(self, capacity: int = 10000):
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, discord_id: int) -> Optional[int]:
+        """
+        Returns the cached table id for a discord user, or None if it isn't
+        cached. Counts as a hit or a miss either way.
+        """
+        with self._lock:
+            user_tid = self._entries.get(int(discord_id))
+            if user_tid is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(int(discord_id))
+            return user_tid
+
+    def put(self, discord_id: int, user_tid: int):
+        """
+        Remembers a discord user's table id, evicting the least recently used
+        entry if the cache is full.
+        """
+        with self._lock:
+            self._entries[int(discord_id)] = user_tid
+            self._entries.move_to_end(int(discord_id))
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+
+    def warm(self, conn: sqlite3.Connection):
+        """
+        Fills the cache with the most recently registered users
+        """
+        c = conn.cursor()
+        c.execute('''SELECT user_id, id FROM users
+                     ORDER BY id DESC LIMIT ?''', [self.capacity])
+        rows = c.fetchall()
+        c.close()
+
+        # Oldest first, so the newest users end up least likely to be evicted
+        for discord_id, user_tid in reversed(rows):
+            self.put(discord_id, user_tid)
+
+        log.info(f"Warmed identity cache with {len(rows)} users")
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters describing how well the cache is doing. Every hit is
+        one `SELECT` on the users table that didn't have to happen.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,111 @@
+import logging
+log = logging.getLogger(__name__)
+import threading
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from .title_index import TitleIndex
+
+if TYPE_CHECKING:
+    # Only for annotations: bot.database imports this module
+    from .database import ItemDefinition
+
+class ItemCatalog:
+    """
+    An in-memory copy of the `item_definitions` table, indexed both by table
+    id and by uppercased title, so that looking items up never touches
+    SQLite. Titles are also kept in a `TitleIndex`, for suggesting items when
+    a title doesn't match exactly.
+
+    The store only changes when an admin registers or unregisters an item;
+    every change bumps `version`, which anything derived from the catalog
+    (rendered embeds, search indexes, ...) can use as a cache key. Safe to
+    share between the threads of an `AsyncDatabase`.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._by_tid: Dict[int, "ItemDefinition"] = {}
+        self._by_title: Dict[str, "ItemDefinition"] = {}
+        self._search = TitleIndex()
+        self._lock = threading.Lock()
+
+    def load(self, items: List["ItemDefinition"]):
+        """
+        Replaces the catalog's contents with every item in the database
+        """
+        with self._lock:
+            self._by_tid = {item.tid: item for item in items}
+            self._by_title = {item.title.upper(): item for item in items}
+            self._search = TitleIndex(self._by_title)
+            self.version += 1
+
+        log.info(f"Loaded {len(items)} items into the catalog")
+
+    def add(self, item: "ItemDefinition"):
+        """
+        Adds a newly registered item to the catalog
+        """
+        with self._lock:
+            self._by_tid[item.tid] = item
+            self._by_title[item.title.upper()] = item
+            self._search.add(item.title.upper())
+            self.version += 1
+
+    def remove(self, title: str) -> Optional["ItemDefinition"]:
+        """
+        Removes an unregistered item from the catalog, returning it if it was
+        present
+        """
+        with self._lock:
+            if (item := self._by_title.pop(title.upper(), None)) is None:
+                return None
+            del self._by_tid[item.tid]
+            self._search.remove(title.upper())
+            self.version += 1
+            return item
+
+    def get(self, item_tid: int) -> Optional["ItemDefinition"]:
+        """
+        Looks up an item by its table id
+        """
+        return self._by_tid.get(item_tid)
+
+    def find(self, title: str) -> Optional["ItemDefinition"]:
+        """
+        Looks up an item by its title, ignoring case
+        """
+        return self._by_title.get(title.upper())
+
+    def suggest(self, title: str, limit: int = 5) -> List["ItemDefinition"]:
+        """
+        Returns up to `limit` items whose titles look most like `title`, best
+        first, for when `find` came up empty
+        """
+        with self._lock:
+            return [self._by_title[match] for match in self._search.closest(title.upper(), limit)]
+
+    def complete(self, prefix: str, limit: int = 5) -> List["ItemDefinition"]:
+        """
+        Returns up to `limit` items whose titles start with `prefix`, ignoring
+        case, in alphabetical order
+        """
+        with self._lock:
+            return [self._by_title[match] for match in self._search.complete(prefix.upper(), limit)]
+
+    def items(self) -> List["ItemDefinition"]:
+        """
+        Returns every item in the catalog, in the order they were registered
+        """
+        with self._lock:
+            return sorted(self._by_tid.values(), key=lambda item: item.tid)
+
+    def snapshot(self) -> Tuple[int, List["ItemDefinition"]]:
+        """
+        Returns the current `version` together with `items()`, read at the
+        same time so that one can't be newer than the other
+        """
+        with self._lock:
+            return self.version, sorted(self._by_tid.values(), key=lambda item: item.tid)
+
+    def __len__(self):
+        return len(self._by_tid)
@@ -0,0 +1,86 @@
+import asyncio
+from contextlib import asynccontextmanager
+import logging
+log = logging.getLogger(__name__)
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+class KeyedSerialQueue:
+    """
+    Runs jobs one at a time per key, in the order they were submitted, while
+    jobs for different keys run concurrently.
+
+    Only keys with work outstanding take up any memory.
+    """
+
+    def __init__(self):
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, job: Callable[[], Awaitable[T]]) -> T:
+        """
+        Waits for every job previously submitted under `key` to finish, then
+        runs `job()` and returns its result. The place in line is taken as
+        soon as this is called, before the first `await`.
+
+        If this is cancelled while still waiting, the job never runs, but the
+        jobs after it keep waiting for the ones before it.
+        """
+        previous = self._tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self._tails[key] = done
+
+        def release(_=None):
+            if not done.done():
+                done.set_result(None)
+            if self._tails.get(key) is done:
+                del self._tails[key]
+
+        try:
+            if previous is not None:
+                # Shielded so that cancelling this doesn't cancel `previous`,
+                # which belongs to the job before
+                await asyncio.shield(previous)
+            return await job()
+        finally:
+            if previous is None or previous.done():
+                release()
+            else:
+                previous.add_done_callback(release)
+
+    def __len__(self):
+        return len(self._tails)
+
+class KeyedLock:
+    """
+    A set of asyncio locks, one per key, created on demand. Holding the lock
+    for one key never blocks anyone working on a different key.
+
+    A key's lock is thrown away as soon as nobody holds it or is waiting for
+    it, so memory use depends on how many keys are busy right now, not on how
+    many keys have ever been locked.
+    """
+
+    def __init__(self):
+        # key -> [lock, number of tasks holding or waiting for it]
+        self._locks: Dict[Hashable, list] = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: Hashable):
+        """
+        Use as `async with keyed_lock(key):` to hold the lock for `key`
+        """
+        if (entry := self._locks.get(key)) is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self):
+        return len(self._locks)
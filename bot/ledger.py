@@ -0,0 +1,129 @@
+import asyncio
+import logging
+log = logging.getLogger(__name__)
+import time
+import traceback
+from typing import Dict, Optional
+
+from .async_database import AsyncDatabase
+from .database import LedgerStatus
+
+# How many users are checked per step of an audit, and how long to pause
+# between steps so that the audit never hogs the database
+AUDIT_BATCH_SIZE = 500
+AUDIT_PAUSE = 0.05
+# How often, in seconds, a full audit runs by itself
+AUDIT_INTERVAL = 6 * 60 * 60
+
+class LedgerAuditor:
+    """
+    Checks every user's balance against their ledger (what their coin gains
+    add up to) in the background.
+
+    Users are audited `batch_size` at a time, in table id order. Each batch
+    is checked with a single read, after which the batch's checkpoints are
+    moved up to their latest coin gain, so the next audit only adds up coin
+    gains that came after this one. Users whose balance and ledger disagree
+    are kept in `drift` until they are fixed or a later audit finds them
+    fine again.
+    """
+
+    def __init__(self, database: AsyncDatabase, batch_size: int = AUDIT_BATCH_SIZE,
+                 pause: float = AUDIT_PAUSE, audit_interval: float = AUDIT_INTERVAL):
+        self.database = database
+        self.batch_size = batch_size
+        self.pause = pause
+        self.audit_interval = audit_interval
+
+        self.drift: Dict[int, LedgerStatus] = {}
+        self.checked = 0
+        self.cursor = 0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._task = None
+        self._schedule = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def audit_batch(self) -> int:
+        """
+        Audits and checkpoints the next batch of users. Returns how many users
+        were in it; 0 means the audit reached the end.
+        """
+        statuses = await self.database.get_ledger_statuses(self.cursor, self.batch_size)
+        if len(statuses) == 0:
+            return 0
+
+        for status in statuses:
+            if status.drift != 0:
+                if status.user_tid not in self.drift:
+                    log.warning(f"User {status.discord_id} has {status.balance} coins, "
+                                f"but their ledger adds up to {status.ledger}")
+                self.drift[status.user_tid] = status
+            else:
+                self.drift.pop(status.user_tid, None)
+
+        await self.database.checkpoint_ledgers([status.user_tid for status in statuses])
+        self.cursor = statuses[-1].user_tid
+        self.checked += len(statuses)
+        return len(statuses)
+
+    async def audit(self):
+        """
+        Audits every user, from the start
+        """
+        self.cursor = 0
+        self.checked = 0
+        self.started_at = time.time()
+        self.finished_at = None
+        while await self.audit_batch() > 0:
+            await asyncio.sleep(self.pause)
+
+        self.finished_at = time.time()
+        log.info(f"Ledger audit checked {self.checked} users, {len(self.drift)} have drifted")
+
+    def start(self) -> bool:
+        """
+        Starts an audit in the background. Returns False if one was already
+        running. Must be called from inside the event loop.
+        """
+        if self.running:
+            return False
+        self._task = asyncio.get_running_loop().create_task(self.audit())
+        return True
+
+    async def _audit_forever(self):
+        while True:
+            try:
+                if self.start():
+                    await self._task
+            except Exception:
+                log.error(f"Ledger audit failed:\n{traceback.format_exc()}")
+            await asyncio.sleep(self.audit_interval)
+
+    def schedule(self):
+        """
+        Runs an audit every `audit_interval` seconds, if that isn't happening
+        already. Must be called from inside the event loop.
+        """
+        if self._schedule is None or self._schedule.done():
+            self._schedule = asyncio.get_running_loop().create_task(self._audit_forever())
+
+    def stop(self):
+        for task in (self._task, self._schedule):
+            if task is not None:
+                task.cancel()
+        self._task = self._schedule = None
+
+    async def fix(self, user_tid: Optional[int] = None) -> int:
+        """
+        Sets the balance of a drifted user (or every drifted user, if None)
+        to what their ledger adds up to. Returns how many balances changed.
+        """
+        user_tids = list(self.drift) if user_tid is None else [user_tid]
+        changed = await self.database.rebuild_balances(user_tids)
+        for user_tid in user_tids:
+            self.drift.pop(user_tid, None)
+        return changed
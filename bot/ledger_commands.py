@@ -0,0 +1,97 @@
+import discord
+import logging
+log = logging.getLogger(__name__)
+import time
+
+from .commands import Commands
+from .async_database import AsyncDatabase
+from .ledger import LedgerAuditor
+from .permissions import check_user, is_admin
+
+class LedgerCommands(Commands):
+    """
+    Commands for checking that everyone's balance matches their history of
+    coin gains
+    """
+
+    def __init__(self, database: AsyncDatabase):
+        self.database = database
+        self.auditor = LedgerAuditor(database)
+
+    def setup(self, bot):
+        bot.add_listener(self.on_ready, "on_ready")
+        ledger_group = self.group(bot, self.ledger_group_entry, name="ledger")
+        self.command(ledger_group, self.audit, name="audit")
+        self.command(ledger_group, self.status, name="status")
+        self.command(ledger_group, self.fix, name="fix")
+
+    async def on_ready(self):
+        self.auditor.schedule()
+
+    @check_user(is_admin)
+    async def ledger_group_entry(self, ctx):
+        """
+        (ADMIN ONLY) Check balances against the coin gains that make them up
+        """
+        if ctx.invoked_subcommand is None:
+            await self.status(ctx)
+
+    @check_user(is_admin)
+    async def audit(self, ctx):
+        """
+        (ADMIN ONLY) Start checking every user's balance in the background
+        """
+        if self.auditor.start():
+            await self.reply(ctx, "Started auditing every balance. Check on it with `ca!ledger status`.")
+        else:
+            await self.reply(ctx, f"An audit is already running, {self.auditor.checked} users checked so far.")
+
+    @check_user(is_admin)
+    async def status(self, ctx):
+        """
+        (ADMIN ONLY) Show how the last audit went, and who has drifted
+        """
+        auditor = self.auditor
+        if auditor.started_at is None:
+            response = "No audit has run yet."
+        elif auditor.running:
+            response = f"Auditing... {auditor.checked} users checked so far."
+        else:
+            ago = time.time() - auditor.finished_at
+            took = auditor.finished_at - auditor.started_at
+            response = f"The last audit checked {auditor.checked} users {ago:.0f}s ago, taking {took:.1f}s."
+
+        if len(auditor.drift) == 0:
+            response += "\nEvery balance matches its ledger."
+        else:
+            lines = [
+                f"<@{status.discord_id}>: balance {status.balance}, ledger {status.ledger} ({status.drift:+})"
+                for status in list(auditor.drift.values())[:20]
+            ]
+            if len(auditor.drift) > 20:
+                lines.append(f"...and {len(auditor.drift) - 20} more")
+            response += f"\n{len(auditor.drift)} balances don't match their ledger:\n" + "\n".join(lines)
+            response += "\nUse `ca!ledger fix` to set them to what their ledger says."
+
+        await self.reply(ctx, response, allowed_mentions=discord.AllowedMentions.none())
+
+    @check_user(is_admin)
+    async def fix(self, ctx, user: discord.User = None):
+        """
+        (ADMIN ONLY) Set drifted balances (or one user's balance) to what their
+        ledger adds up to
+        """
+        self.typing(ctx)
+
+        if user is None:
+            if len(self.auditor.drift) == 0:
+                await self.reply(ctx, "Nothing to fix! Run `ca!ledger audit` to look for drift.")
+                return
+            changed = await self.auditor.fix()
+        else:
+            if (user_tid := await self.database.get_user_tid(user.id)) is None:
+                await self.reply(ctx, f"User {user} isn't registered.")
+                return
+            changed = await self.auditor.fix(user_tid)
+
+        await self.reply(ctx, f"Fixed {changed} balances.")
@@ -0,0 +1,91 @@
+import asyncio
+from collections import OrderedDict
+import logging
+log = logging.getLogger(__name__)
+import time
+from typing import Dict
+
+import discord
+
+class MessageCache:
+    """
+    A small TTL + LRU cache in front of `channel.fetch_message`.
+
+    When several people react to the same message at once, every reaction
+    event wants the same message. Only the first one actually fetches it;
+    the others wait on that same in-flight request ("single-flight"), and
+    anything arriving within `ttl` seconds afterwards gets the cached copy.
+
+    Entries should be invalidated whenever the message is edited or deleted.
+    """
+
+    def __init__(self, capacity: int = 500, ttl: float = 30.0):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight: Dict[int, asyncio.Task] = {}
+
+    async def fetch(self, channel, message_id: int, fresh: bool = False) -> discord.Message:
+        """
+        Returns the message, from the cache if possible. With `fresh`, any
+        cached copy is ignored, though a fetch that is already running is
+        still shared. Raises whatever `fetch_message` raises.
+        """
+        if not fresh and (entry := self._entries.get(message_id)) is not None:
+            expires_at, message = entry
+            if expires_at > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(message_id)
+                return message
+            del self._entries[message_id]
+
+        if (task := self._in_flight.get(message_id)) is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.get_running_loop().create_task(channel.fetch_message(message_id))
+            task.add_done_callback(lambda task: self._fetched(message_id, task))
+            self._in_flight[message_id] = task
+
+        # Shielded so one waiter being cancelled doesn't cancel the others
+        return await asyncio.shield(task)
+
+    def _fetched(self, message_id: int, task: asyncio.Task):
+        # If the message was invalidated while this fetch was running, a newer
+        # fetch may have replaced it, and either way this result is outdated
+        if self._in_flight.get(message_id) is not task:
+            return
+        del self._in_flight[message_id]
+
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        self._entries[message_id] = (time.monotonic() + self.ttl, task.result())
+        self._entries.move_to_end(message_id)
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, message_id: int):
+        """
+        Forgets a message, because it was edited or deleted. Requests for it
+        from now on fetch it again, even if an older fetch is still running.
+        """
+        self._entries.pop(message_id, None)
+        self._in_flight.pop(message_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters describing how well the cache is doing. Every hit and
+        every coalesced request is a `fetch_message` call that didn't happen.
+        """
+        return {
+            "size": len(self._entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._in_flight),
+        }
@@ -0,0 +1,94 @@
+import asyncio
+import discord
+import logging
+log = logging.getLogger(__name__)
+from typing import Awaitable, Callable, Dict, Optional
+
+from .responses import Responder
+
+PREVIOUS_PAGE = '◀' # :arrow_backward:
+NEXT_PAGE = '▶' # :arrow_forward:
+
+class ReactionPaginator:
+    """
+    Shows one page of a long list at a time, flipping between pages when the
+    person who asked for it reacts with the arrows under the message.
+
+    Pages are only rendered when someone actually turns to them, by calling
+    `render_page(index)`, which returns None if there is no such page. Each
+    page is rendered at most once per paginator, so flipping back is free.
+    If `page_count` is known up front, no one can turn past the last page;
+    otherwise `render_page` is asked, and turning past the end does nothing.
+
+    The arrows stop working after `timeout` seconds without any flipping.
+    The first page is sent through `responder` if given, as a message of its
+    own since it gets edited, and straight to the channel otherwise.
+    """
+
+    def __init__(self, render_page: Callable[[int], Awaitable[Optional[discord.Embed]]],
+                 page_count: Optional[int] = None, timeout: float = 120.0,
+                 responder: Optional[Responder] = None):
+        self.render_page = render_page
+        self.page_count = page_count
+        self.timeout = timeout
+        self.responder = responder
+        self.index = 0
+        self._pages: Dict[int, Optional[discord.Embed]] = {}
+
+    async def page(self, index: int) -> Optional[discord.Embed]:
+        """
+        Returns page `index`, rendering it if this is the first time it was
+        asked for
+        """
+        if index < 0 or (self.page_count is not None and index >= self.page_count):
+            return None
+        if index not in self._pages:
+            self._pages[index] = await self.render_page(index)
+        return self._pages[index]
+
+    async def run(self, ctx, content: Optional[str] = None):
+        """
+        Sends the first page in reply to `ctx`, then flips pages whenever the
+        author reacts, until the paginator times out. Returns once it has.
+        """
+        if (embed := await self.page(0)) is None:
+            return
+
+        if self.responder is not None:
+            message = await self.responder.reply(ctx, content, merge=False, embed=embed)
+        else:
+            message = await ctx.send(content, embed=embed)
+        if self.page_count == 1:
+            return
+
+        for emoji in (PREVIOUS_PAGE, NEXT_PAGE):
+            await message.add_reaction(emoji)
+
+        def check(reaction, user):
+            return (reaction.message.id == message.id
+                    and user.id == ctx.author.id
+                    and str(reaction.emoji) in (PREVIOUS_PAGE, NEXT_PAGE))
+
+        while True:
+            try:
+                reaction, user = await ctx.bot.wait_for("reaction_add", check=check, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                break
+
+            # Lets the same arrow be pressed again. Needs Manage Messages,
+            # without which the author has to un-react first.
+            try:
+                await message.remove_reaction(reaction.emoji, user)
+            except discord.HTTPException:
+                pass
+
+            index = self.index + (1 if str(reaction.emoji) == NEXT_PAGE else -1)
+            if (embed := await self.page(index)) is None:
+                continue
+            self.index = index
+            await message.edit(embed=embed)
+
+        try:
+            await message.clear_reactions()
+        except discord.HTTPException:
+            pass
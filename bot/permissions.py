@@ -4,9 +4,14 @@ from discord.ext import commands
 from typing import Callable
 import inspect
 
-# TODO: change this to be customizable per server. Not needed atm tho
+from .admin_roles import AdminRoles
+
+# The admin role in guilds that haven't set up their own with `ca!admin add`
 ADMIN_ROLE_ID = 765320566739435550
 
+# Loaded from the database by `AsyncDatabase`
+admin_roles = AdminRoles(default_role_ids=[ADMIN_ROLE_ID])
+
 def has_role(role_id):
     def predicate(user: User):
         if hasattr(user, "roles"):
@@ -27,7 +32,17 @@ def has_any_role(role_ids):
 
     return predicate
 
-is_admin = has_role(ADMIN_ROLE_ID)
+def is_admin(user: User) -> bool:
+    return admin_roles.is_admin(user)
+
+def can_manage_admins(user: User) -> bool:
+    """
+    Bot admins, and anyone who can administer the server itself, so that a
+    server whose admin roles were all removed can't be locked out
+    """
+    if is_admin(user):
+        return True
+    return hasattr(user, "guild_permissions") and user.guild_permissions.administrator
 
 def check_user(predicate: Callable[[User], bool]):
     """
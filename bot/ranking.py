@@ -0,0 +1,110 @@
+from bisect import bisect_left
+import logging
+log = logging.getLogger(__name__)
+import threading
+from typing import Dict, List, Optional, Tuple
+
+class Ranking:
+    """
+    Every user's balance, kept sorted from richest to poorest, so that
+    finding someone's rank or the top of the leaderboard never touches
+    SQLite.
+
+    The sorted order is a list of `(-coins, user_tid)` keys that is searched
+    with `bisect`, so a rank lookup is O(log n). Balance changes are applied
+    by the `Database` once they commit.
+
+    `top_version` only changes when the first `tracked` places do, so
+    anything rendered from the top of the leaderboard can use it as a cache
+    key and survive changes further down. Safe to share between the threads
+    of an `AsyncDatabase`.
+    """
+
+    def __init__(self, tracked: int = 25):
+        self.tracked = tracked
+        self.top_version = 0
+        self._keys: List[Tuple[int, int]] = []
+        self._coins: Dict[int, int] = {}
+        self._discord_ids: Dict[int, int] = {}
+        self._user_tids: Dict[int, int] = {}
+        self._lock = threading.Lock()
+
+    def load(self, users: List[Tuple[int, int, int]]):
+        """
+        Replaces the ranking with every `(user_tid, discord id, coins)` in the
+        database
+        """
+        with self._lock:
+            self._coins = {user_tid: coins for user_tid, _, coins in users}
+            self._discord_ids = {user_tid: int(discord_id) for user_tid, discord_id, _ in users}
+            self._user_tids = {discord_id: user_tid for user_tid, discord_id in self._discord_ids.items()}
+            self._keys = sorted((-coins, user_tid) for user_tid, coins in self._coins.items())
+            self.top_version += 1
+
+        log.info(f"Loaded {len(users)} users into the ranking")
+
+    def _move(self, user_tid: int, coins: int) -> bool:
+        """
+        Moves a user to their new place. Returns whether the top places
+        changed. Must hold the lock.
+        """
+        place = None
+        if (old_coins := self._coins.get(user_tid)) is not None:
+            if old_coins == coins:
+                return False
+            place = bisect_left(self._keys, (-old_coins, user_tid))
+            del self._keys[place]
+
+        key = (-coins, user_tid)
+        new_place = bisect_left(self._keys, key)
+        self._keys.insert(new_place, key)
+        self._coins[user_tid] = coins
+        return new_place < self.tracked or (place is not None and place < self.tracked)
+
+    def add(self, user_tid: int, discord_id: int, coins: int):
+        """
+        Adds a newly registered user, or updates one that is already ranked
+        """
+        with self._lock:
+            self._discord_ids[user_tid] = int(discord_id)
+            self._user_tids[int(discord_id)] = user_tid
+            if self._move(user_tid, coins):
+                self.top_version += 1
+
+    def update(self, balances: List[Tuple[int, int]]):
+        """
+        Applies new `(user_tid, coins)` balances of already ranked users
+        """
+        with self._lock:
+            changed = False
+            for user_tid, coins in balances:
+                if user_tid in self._discord_ids:
+                    changed |= self._move(user_tid, coins)
+            if changed:
+                self.top_version += 1
+
+    def rank(self, discord_id: int) -> Optional[Tuple[int, int]]:
+        """
+        Returns a user's place (starting at 1, shared by everyone with the
+        same balance) and balance, or None if they aren't registered
+        """
+        with self._lock:
+            if (user_tid := self._user_tids.get(int(discord_id))) is None:
+                return None
+            coins = self._coins[user_tid]
+            # Everyone strictly richer sorts before (-coins,)
+            return bisect_left(self._keys, (-coins,)) + 1, coins
+
+    def top(self, count: int) -> List[Tuple[int, int, int]]:
+        """
+        Returns `(place, discord id, coins)` for the `count` richest users
+        """
+        with self._lock:
+            top = []
+            for i, (negative_coins, user_tid) in enumerate(self._keys[:count]):
+                place = top[-1][0] if top and top[-1][2] == -negative_coins else i + 1
+                top.append((place, self._discord_ids[user_tid], -negative_coins))
+            return top
+
+    def __len__(self):
+        return len(self._keys)
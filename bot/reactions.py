@@ -1,45 +1,94 @@
+import asyncio
 import discord
 from collections import defaultdict
 import logging
 log = logging.getLogger(__name__)
+import traceback
 
 from .commands import Commands
+from .keyed import KeyedSerialQueue
+from .message_cache import MessageCache
+
+# The discord objects a reaction handler can ask to be given
+MESSAGE = "message"
+USER = "user"
+CHANNEL = "channel"
+GUILD = "guild"
+ALL_OBJECTS = frozenset((MESSAGE, USER, CHANNEL, GUILD))
+# Like MESSAGE, but never a cached copy, for handlers that look at the
+# message's current reactions
+FRESH_MESSAGE = "fresh_message"
 
 class Reactions(Commands):
     """
     Class that watches messages for certain reactions, automatically calling
     handlers when certain reactions appear/disappear.
+
+    Reaction events on the same message are handled one at a time, in the
+    order they arrived. Within an event, all of its handlers run at the same
+    time, with at most `max_handlers` running across the whole bot. Each
+    handler gets `handler_timeout` seconds, and one failing or timing out
+    doesn't affect the others.
     """
 
-    def __init__(self):
+    def __init__(self, max_handlers: int = 16, handler_timeout: float = 30.0):
         self.handler_map = defaultdict(list, dict())
+        self.messages = MessageCache()
+        self.events = KeyedSerialQueue()
+        self.handler_timeout = handler_timeout
+        self.handler_slots = asyncio.Semaphore(max_handlers)
 
     def setup(self, bot):
         self.bot = bot
         bot.add_listener(self.on_raw_reaction_add, "on_raw_reaction_add")
         bot.add_listener(self.on_raw_reaction_remove, "on_raw_reaction_remove")
+        bot.add_listener(self.on_raw_message_edit, "on_raw_message_edit")
+        bot.add_listener(self.on_raw_message_delete, "on_raw_message_delete")
+        bot.add_listener(self.on_raw_bulk_message_delete, "on_raw_bulk_message_delete")
 
-    def reaction(self, add_function, remove_function, emoji_id):
+    def reaction(self, add_function, remove_function, emoji_id, needs=ALL_OBJECTS, predicate=None):
         """
         Adds a new reaction handler to the specified bot.
 
         Whenever `bot` sees an emoji with id or unicode codepoint `emoji_id`
         being added to a message, it will call
-        `add_function(message_id, user_id, channel_id, guild_id)` where
-        all items are `int`s except for `guild_id`, which may be optional if
-        this was called from a DM. This corresponds with the fields returned by
-        a `discord.RawReactionAddEvent`.
+        `add_function(message, user, channel, guild)` with the full discord
+        objects behind the `discord.RawReactionActionEvent`. `guild` may be
+        None if this was called from a DM.
 
         Whenever `bot` sees an emoji with id or unicode codepoint `emoji_id`
         begin removed from a message, it will call
-        `remove_function(message_id, user_id, channel_id, guild_id)` for each
+        `remove_function(message, user, channel, guild)` for each
         user that removed a reaction from the message. This *is not* called
         when the message is deleted instead of simply un-reacted to. A lot of
         state would need to be kept for that to happen, so we just don't.
+
+        `needs` is the set of objects (out of `MESSAGE`, `USER`, `CHANNEL` and
+        `GUILD`) the handlers actually use; the rest are passed as None.
+        Fetching the message costs a REST call, so leave it out if you can.
+        Use `FRESH_MESSAGE` instead of `MESSAGE` if the handler needs the
+        message's reactions to be up to date.
+
+        If given, `predicate(rrae)` is called with the raw event first, and the
+        handlers are skipped if it returns False. It must only use what the
+        event and the bot's caches already know, since the point is to rule
+        out events before anything is fetched for them.
         """
 
         # Append handlers to end of list of existing ones
-        self.handler_map[emoji_id] += [(add_function, remove_function)]
+        self.handler_map[emoji_id] += [(add_function, remove_function, frozenset(needs), predicate)]
+
+    def event_member(self, rrae):
+        """
+        Returns the member behind a `discord.RawReactionActionEvent` from the
+        bot's caches, or None if it isn't known without a REST call. Removal
+        events don't come with the member, so it's looked up in the guild.
+        """
+        if rrae.member is not None:
+            return rrae.member
+        if rrae.guild_id is None or (guild := self.bot.get_guild(rrae.guild_id)) is None:
+            return None
+        return guild.get_member(rrae.user_id)
 
     def partial_emoji_to_key(self, pe):
         """
@@ -50,38 +99,99 @@ class Reactions(Commands):
         else:
             return pe.name
 
-    async def rrae_to_objects(self, rrae):
+    async def rrae_to_objects(self, rrae, needs=ALL_OBJECTS):
         """
         Converts a `discord.RawReactionActionEvent` to a series of full discord
-        objects. Requires the user and message intents enabled to work fully.
+        objects, only looking up the ones in `needs`. Requires the user and
+        message intents enabled to work fully.
         """
-        channel = self.bot.get_channel(rrae.channel_id)
-        if channel is None:
-            log.debug(f"Channel {rrae.channel_id} was None")
-            message = None
-        else:
-            message = await channel.fetch_message(rrae.message_id)
-        user = self.bot.get_user(rrae.user_id)
-        guild = self.bot.get_guild(rrae.guild_id)
+        message = user = channel = guild = None
 
-        return message, user, channel, guild
+        if MESSAGE in needs or FRESH_MESSAGE in needs or CHANNEL in needs:
+            channel = self.bot.get_channel(rrae.channel_id)
+            if channel is None:
+                log.debug(f"Channel {rrae.channel_id} was None")
+            elif MESSAGE in needs or FRESH_MESSAGE in needs:
+                message = await self.messages.fetch(channel, rrae.message_id, fresh=FRESH_MESSAGE in needs)
 
-    async def on_raw_reaction_add(self, rrae):
-        emoji_id = self.partial_emoji_to_key(rrae.emoji)
-        message, user, channel, guild = await self.rrae_to_objects(rrae)
-        if message is None:
+        if (GUILD in needs or USER in needs) and rrae.guild_id is not None:
+            guild = self.bot.get_guild(rrae.guild_id)
+
+        if USER in needs:
+            # Prefer full members, which know about their roles
+            if rrae.member is not None:
+                user = rrae.member
+            elif guild is not None and (member := guild.get_member(rrae.user_id)) is not None:
+                user = member
+            else:
+                user = self.bot.get_user(rrae.user_id)
+
+        if GUILD not in needs:
+            guild = None
+
+        return message, user, channel if CHANNEL in needs else None, guild
+
+    async def dispatch(self, rrae, handlers):
+        """
+        Looks up only the objects `handlers` need, then calls each of them
+        """
+        needs = frozenset().union(*(needs for _, needs in handlers))
+        message, user, channel, guild = await self.rrae_to_objects(rrae, needs)
+        if (MESSAGE in needs or FRESH_MESSAGE in needs) and message is None:
             log.error(f"Message {rrae.message_id} not found!")
-        else:
-            for add_fn, _ in self.handler_map[emoji_id]:
-                if add_fn is not None:
-                    await add_fn(message, user, channel, guild)
+            return
+
+        await asyncio.gather(*(
+            self.run_handler(function, message, user, channel, guild)
+            for function, _ in handlers
+        ))
+
+    async def run_handler(self, function, message, user, channel, guild):
+        """
+        Runs a single handler, making sure it can't hold things up forever or
+        take the other handlers down with it
+        """
+        async with self.handler_slots:
+            try:
+                await asyncio.wait_for(function(message, user, channel, guild), self.handler_timeout)
+            except asyncio.TimeoutError:
+                log.error(f"Reaction handler {function.__name__} timed out after {self.handler_timeout}s")
+            except Exception:
+                log.error(f"Reaction handler {function.__name__} failed:\n{traceback.format_exc()}")
+
+    async def on_raw_reaction_add(self, rrae):
+        # Most reactions have no handlers at all, so check before fetching anything
+        if (handlers := self.handler_map.get(self.partial_emoji_to_key(rrae.emoji))) is None:
+            return
+
+        handlers = [
+            (add_fn, needs) for add_fn, _, needs, predicate in handlers
+            if add_fn is not None and (predicate is None or predicate(rrae))
+        ]
+        if len(handlers) == 0:
+            return
+
+        await self.events.run(rrae.message_id, lambda: self.dispatch(rrae, handlers))
 
     async def on_raw_reaction_remove(self, rrae):
-        emoji_id = self.partial_emoji_to_key(rrae.emoji)
-        message, user, channel, guild = await self.rrae_to_objects(rrae)
-        if message is None:
-            log.error(f"Message {rrae.message_id} not found!")
-        else:
-            for _, remove_fn in self.handler_map[emoji_id]:
-                if remove_fn is not None:
-                    await remove_fn(message, user, channel, guild)
+        if (handlers := self.handler_map.get(self.partial_emoji_to_key(rrae.emoji))) is None:
+            return
+
+        handlers = [
+            (remove_fn, needs) for _, remove_fn, needs, predicate in handlers
+            if remove_fn is not None and (predicate is None or predicate(rrae))
+        ]
+        if len(handlers) == 0:
+            return
+
+        await self.events.run(rrae.message_id, lambda: self.dispatch(rrae, handlers))
+
+    async def on_raw_message_edit(self, payload):
+        self.messages.invalidate(payload.message_id)
+
+    async def on_raw_message_delete(self, payload):
+        self.messages.invalidate(payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        for message_id in payload.message_ids:
+            self.messages.invalidate(message_id)
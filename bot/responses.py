@@ -0,0 +1,174 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import logging
+log = logging.getLogger(__name__)
+import time
+from typing import Deque, Dict, List, Optional, Set
+
+import discord
+
+# Discord won't send messages longer than this
+MESSAGE_LENGTH_LIMIT = 2000
+
+@dataclass
+class _Reply:
+    author_id: int
+    content: Optional[str]
+    kwargs: dict
+    merge: bool
+    future: asyncio.Future = field(repr=False)
+
+    def mergeable(self) -> bool:
+        return self.merge and self.content is not None and len(self.kwargs) == 0
+
+class Responder:
+    """
+    Sends command replies, spending as few REST calls as possible.
+
+    Typing: instead of every command announcing it is typing up front, a
+    command asks for typing with `typing(ctx)`, and the indicator is only
+    sent if the command is still working `typing_delay` seconds later.
+    Quick commands reply before that and never send it at all.
+
+    Merging: a reply to a channel that already has a reply on the way waits
+    for it, and the plain text replies to the same user that piled up in the
+    meantime go out together as one message. Replies to different users are
+    never merged, so nobody's answer ends up under someone else's command.
+
+    Headroom: every call made to a channel is remembered for `window`
+    seconds. Discord allows about `limit` messages per channel in that time,
+    so typing indicators are skipped for channels close to the limit, where
+    they would only delay the replies themselves.
+    """
+
+    def __init__(self, typing_delay: float = 0.5, window: float = 5.0, limit: int = 5):
+        self.typing_delay = typing_delay
+        self.window = window
+        self.limit = limit
+
+        self.messages_sent = 0
+        self.replies_merged = 0
+        self.typing_sent = 0
+        self.typing_elided = 0
+        self.typing_skipped = 0
+
+        self._typing: Dict[int, asyncio.TimerHandle] = {}
+        self._queues: Dict[int, List[_Reply]] = {}
+        self._sending: Set[int] = set()
+        self._drains: Set[asyncio.Task] = set()
+        self._calls: Dict[int, Deque[float]] = {}
+
+    def _record_call(self, channel_id: int):
+        self._calls.setdefault(channel_id, deque()).append(time.monotonic())
+
+    def headroom(self, channel_id: int) -> int:
+        """
+        Returns roughly how many more calls can be made to a channel right
+        now before Discord starts rate limiting it
+        """
+        if (calls := self._calls.get(channel_id)) is None:
+            return self.limit
+
+        cutoff = time.monotonic() - self.window
+        while calls and calls[0] < cutoff:
+            calls.popleft()
+        if not calls:
+            del self._calls[channel_id]
+        return self.limit - len(calls)
+
+    def typing(self, ctx):
+        """
+        Shows the typing indicator in the command's channel if the command
+        hasn't replied `typing_delay` seconds from now
+        """
+        if ctx.message.id in self._typing:
+            return
+        self._typing[ctx.message.id] = asyncio.get_running_loop().call_later(
+            self.typing_delay, self._send_typing, ctx)
+
+    def _send_typing(self, ctx):
+        del self._typing[ctx.message.id]
+        if self.headroom(ctx.channel.id) <= 1:
+            self.typing_skipped += 1
+            return
+
+        self.typing_sent += 1
+        self._record_call(ctx.channel.id)
+        task = asyncio.get_running_loop().create_task(ctx.channel.trigger_typing())
+        task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+    def done(self, ctx):
+        """
+        Called when a command replies or finishes, to call off its typing
+        indicator if it hasn't been sent yet
+        """
+        if (handle := self._typing.pop(ctx.message.id, None)) is not None:
+            handle.cancel()
+            self.typing_elided += 1
+
+    async def reply(self, ctx, content: Optional[str] = None, merge: bool = True, **kwargs) -> discord.Message:
+        """
+        Sends a reply to the command's channel, like `ctx.send`. Returns the
+        message it ended up in, which is shared with other replies if it
+        was merged with them. Pass `merge=False` to get a message of its own,
+        e.g. to edit it later.
+        """
+        self.done(ctx)
+
+        channel = ctx.channel
+        future = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(channel.id, []).append(
+            _Reply(ctx.author.id, None if content is None else str(content), kwargs, merge, future))
+        if channel.id not in self._sending:
+            self._sending.add(channel.id)
+            task = asyncio.get_running_loop().create_task(self._drain(channel))
+            self._drains.add(task)
+            task.add_done_callback(self._drains.discard)
+
+        return await future
+
+    async def _drain(self, channel):
+        try:
+            while queue := self._queues.get(channel.id):
+                batch = [queue.pop(0)]
+                if batch[0].mergeable():
+                    length = len(batch[0].content)
+                    while (queue and queue[0].mergeable() and queue[0].author_id == batch[0].author_id
+                           and length + 1 + len(queue[0].content) <= MESSAGE_LENGTH_LIMIT):
+                        length += 1 + len(queue[0].content)
+                        batch.append(queue.pop(0))
+                if not queue:
+                    del self._queues[channel.id]
+
+                content = batch[0].content if len(batch) == 1 else "\n".join(reply.content for reply in batch)
+                self.messages_sent += 1
+                self.replies_merged += len(batch) - 1
+                self._record_call(channel.id)
+                try:
+                    message = await channel.send(content, **batch[0].kwargs)
+                except Exception as e:
+                    for reply in batch:
+                        if not reply.future.done():
+                            reply.future.set_exception(e)
+                    continue
+
+                for reply in batch:
+                    if not reply.future.done():
+                        reply.future.set_result(message)
+        finally:
+            self._sending.discard(channel.id)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns counters describing how many REST calls were saved. Every
+        elided typing indicator and every merged reply is one call that
+        didn't happen.
+        """
+        return {
+            "messages_sent": self.messages_sent,
+            "replies_merged": self.replies_merged,
+            "typing_sent": self.typing_sent,
+            "typing_elided": self.typing_elided,
+            "typing_skipped": self.typing_skipped,
+        }
@@ -0,0 +1,134 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+log = logging.getLogger(__name__)
+import random
+from typing import Dict, List, Sequence
+
+from .errors import SheetTransientError, to_sheet_error
+from .settings import SPREADSHEET_ID
+
+class AsyncGoogleSheet:
+    """
+    An async version of `GoogleSheet`.
+
+    `googleapiclient` only has blocking calls, so they are run on a dedicated
+    single-thread executor: the event loop never waits on the network, and
+    the underlying `httplib2` connection (which isn't thread-safe) is only
+    ever used by one thread. Several ranges can be read or written in one
+    HTTP request with `batch_get` and `batch_update`.
+
+    Requests that fail with a `SheetTransientError` are retried up to
+    `retries` times, waiting `backoff * 2**attempt` seconds (capped at
+    `max_backoff`, with jitter) in between. Anything else, or running out of
+    retries, is raised as a `SheetError`.
+    """
+
+    def __init__(self, sheet_api, sheet_id=SPREADSHEET_ID, retries: int = 5,
+                 backoff: float = 0.5, max_backoff: float = 30.0):
+        """
+        Should be constructed by means of GoogleAPI object, or with a
+        `FakeSheetsAPI` for testing
+
+        sheet_api: Authenticated Google Sheets API object
+        sheet_id: The spreadsheet to access. Default: settings.SPREADSHEET_ID
+        """
+        self.sheet_api = sheet_api
+        self.sheet_id = sheet_id
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets")
+
+    async def _execute(self, make_request):
+        """
+        Builds a request with `make_request()` and executes it on the sheets
+        thread, retrying transient failures
+        """
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            try:
+                return await loop.run_in_executor(self.executor, lambda: make_request().execute())
+            except Exception as e:
+                error = to_sheet_error(e)
+                if not isinstance(error, SheetTransientError) or attempt >= self.retries:
+                    raise error from e
+
+            delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+            delay *= random.uniform(0.5, 1.0)
+            attempt += 1
+            log.warning(f"Sheets request failed ({error}), retry {attempt}/{self.retries} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    async def fetch(self, cell: str) -> List[List[str]]:
+        """
+        Fetches a cell (or range of cells) from the spreadsheet. Must include
+        the sheet name, like "Sheet1!A1"
+        """
+        result = await self._execute(lambda: self.sheet_api.values().get(
+            spreadsheetId=self.sheet_id,
+            range=cell))
+        return result.get('values', [])
+
+    async def batch_get(self, cells: Sequence[str]) -> List[List[List[str]]]:
+        """
+        Fetches several ranges in a single request. Returns the rows of each
+        range, in the same order as `cells`
+        """
+        if len(cells) == 0:
+            return []
+
+        result = await self._execute(lambda: self.sheet_api.values().batchGet(
+            spreadsheetId=self.sheet_id,
+            ranges=list(cells)))
+        return [value_range.get('values', []) for value_range in result.get('valueRanges', [])]
+
+    async def batch_update(self, updates: Dict[str, List[List]],
+                           value_input_option: str = "RAW") -> int:
+        """
+        Writes several ranges in a single request. `updates` maps each range
+        to the rows to write there. Returns the number of cells updated.
+
+        Writing needs the read-write spreadsheets scope.
+        """
+        if len(updates) == 0:
+            return 0
+
+        result = await self._execute(lambda: self.sheet_api.values().batchUpdate(
+            spreadsheetId=self.sheet_id,
+            body={
+                "valueInputOption": value_input_option,
+                "data": [{"range": cell, "values": rows} for cell, rows in updates.items()],
+            }))
+        return result.get('totalUpdatedCells', 0)
+
+    async def tab_properties(self) -> Dict[str, dict]:
+        """
+        Returns the properties of every tab in the spreadsheet, by title, like
+        `{"sheetId": 0, "title": "Sheet1", "gridProperties": {"rowCount":
+        1000, "columnCount": 26}}`
+        """
+        result = await self._execute(lambda: self.sheet_api.get(
+            spreadsheetId=self.sheet_id,
+            fields="sheets.properties"))
+        return {sheet['properties']['title']: sheet['properties'] for sheet in result.get('sheets', [])}
+
+    async def update_spreadsheet(self, requests: List[dict]) -> List[dict]:
+        """
+        Sends several spreadsheet-level requests, like `addSheet` or
+        `appendDimension`, in a single request. They are applied all together
+        or not at all. Returns the reply to each request, in the same order.
+
+        Needs the read-write spreadsheets scope.
+        """
+        if len(requests) == 0:
+            return []
+
+        result = await self._execute(lambda: self.sheet_api.batchUpdate(
+            spreadsheetId=self.sheet_id,
+            body={"requests": list(requests)}))
+        return result.get('replies', [{} for _ in requests])
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,36 @@
+import httplib2
+from googleapiclient.errors import HttpError
+
+class SheetError(Exception):
+    """Something went wrong talking to the Google Sheets API"""
+
+class SheetTransientError(SheetError):
+    """
+    A failure that might go away by itself if the request is retried later,
+    like being rate limited or the API having a bad moment
+    """
+
+class SheetRequestError(SheetError):
+    """
+    A failure that retrying won't fix, like asking for a range that doesn't
+    exist or not having permission
+    """
+
+# HTTP statuses that mean "try again later" rather than "you did it wrong"
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+def to_sheet_error(e: Exception) -> SheetError:
+    """
+    Converts an exception raised while executing a Sheets API request into
+    the matching `SheetError`
+    """
+    if isinstance(e, SheetError):
+        return e
+    if isinstance(e, HttpError):
+        status = int(e.resp.status)
+        if status in RETRYABLE_STATUSES:
+            return SheetTransientError(f"Sheets API returned {status}: {e}")
+        return SheetRequestError(f"Sheets API returned {status}: {e}")
+    if isinstance(e, (OSError, httplib2.HttpLib2Error)):
+        return SheetTransientError(f"Couldn't reach the Sheets API: {e}")
+    return SheetError(f"Sheets API request failed: {e!r}")
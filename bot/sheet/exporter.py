@@ -0,0 +1,251 @@
+import asyncio
+import logging
+log = logging.getLogger(__name__)
+import time
+import traceback
+from typing import Dict, List, Optional, Tuple
+
+from ..async_database import AsyncDatabase
+from ..database import OUTBOX_USER, OUTBOX_COIN_GAIN
+from .async_sheet import AsyncGoogleSheet
+from .settings import (EXPORT_USERS_TAB, EXPORT_COIN_GAINS_TAB, EXPORT_INTERVAL, EXPORT_BATCH_SIZE,
+                       EXPORT_MAX_ROWS, EXPORT_GROW_ROWS)
+
+USER_HEADER = ["Discord ID", "Coins", "Backpack"]
+COIN_GAIN_HEADER = ["ID", "Message ID", "Discord ID", "Date", "Coins"]
+
+def coalesce(keys: List[int]) -> List[Tuple[int, int]]:
+    """
+    Groups keys into runs of consecutive numbers, returned as inclusive
+    (first, last) pairs, so that neighbouring rows are written as one range
+    """
+    runs = []
+    for key in sorted(set(keys)):
+        if runs and runs[-1][1] == key - 1:
+            runs[-1] = (runs[-1][0], key)
+        else:
+            runs.append((key, key))
+    return runs
+
+def sheet_range(tab: str, first_row: int, last_row: int, width: int) -> str:
+    """
+    Returns the A1 range covering columns A onwards of rows `first_row` to
+    `last_row` (1-based) of `tab`
+    """
+    last_column = chr(ord('A') + width - 1)
+    tab = tab.replace("'", "''")
+    return f"'{tab}'!A{first_row}:{last_column}{last_row}"
+
+class SheetExporter:
+    """
+    Copies changes from the database to the Google Sheet.
+
+    The database keeps an outbox of every user and coin gain that changed
+    since it was last exported. Each table row has a fixed row on its tab
+    (the row after its id, under a header), so exporting is just rewriting
+    the rows in the outbox: the cost depends on how much changed, not on how
+    many users there are. Runs of neighbouring rows are written as a single
+    range, and everything in a batch goes out in one `batchUpdate`.
+
+    Before the first export, the tabs are created if they are missing. They
+    are grown `grow_rows` rows at a time as ids go up, but never past
+    `max_rows` rows: rows with a higher id are dropped from the export, and
+    an error is logged once per tab.
+
+    Entries only leave the outbox after the sheet accepted the write, and
+    rewriting a row is harmless, so a crash at any point just means some rows
+    get exported again next time.
+    """
+
+    def __init__(self, database: AsyncDatabase, sheet: AsyncGoogleSheet,
+                 users_tab: str = EXPORT_USERS_TAB, coin_gains_tab: str = EXPORT_COIN_GAINS_TAB,
+                 export_interval: float = EXPORT_INTERVAL, batch_size: int = EXPORT_BATCH_SIZE,
+                 max_rows: int = EXPORT_MAX_ROWS, grow_rows: int = EXPORT_GROW_ROWS):
+        self.database = database
+        self.sheet = sheet
+        self.users_tab = users_tab
+        self.coin_gains_tab = coin_gains_tab
+        self.export_interval = export_interval
+        self.batch_size = batch_size
+        self.max_rows = max_rows
+        self.grow_rows = grow_rows
+
+        # tab -> [sheetId, rowCount], once the tabs are known to exist
+        self._grids: Optional[Dict[str, List[int]]] = None
+        self._full_tabs = set()
+        self.exported_at: Optional[float] = None
+        self.rows_exported = 0
+        self.requests = 0
+        self._headers_written = False
+        self._task = None
+        self._export_lock = asyncio.Lock()
+
+    @staticmethod
+    def user_row(user) -> list:
+        if user is None:
+            return [""] * len(USER_HEADER)
+        discord_id, coins, backpack = user
+        return [str(discord_id), coins, ", ".join(f"{count}x {title}" for title, count in backpack)]
+
+    @staticmethod
+    def coin_gain_row(coin_gain) -> list:
+        if coin_gain is None:
+            return [""] * len(COIN_GAIN_HEADER)
+        gain, discord_id = coin_gain
+        return [
+            str(gain.tid),
+            "" if gain.message_id is None else str(gain.message_id),
+            "" if discord_id is None else str(discord_id),
+            str(gain.date_entered),
+            gain.coins,
+        ]
+
+    async def prepare(self):
+        """
+        Creates whichever of the export tabs don't exist yet, and notes how
+        many rows each has. Raises a `SheetError` if that can't be done.
+        """
+        widths = {self.users_tab: len(USER_HEADER), self.coin_gains_tab: len(COIN_GAIN_HEADER)}
+        properties = await self.sheet.tab_properties()
+        missing = [tab for tab in widths if tab not in properties]
+        if missing:
+            replies = await self.sheet.update_spreadsheet([
+                {"addSheet": {"properties": {"title": tab, "gridProperties": {
+                    "rowCount": self.grow_rows, "columnCount": widths[tab], "frozenRowCount": 1}}}}
+                for tab in missing
+            ])
+            for reply in replies:
+                tab_properties = reply["addSheet"]["properties"]
+                properties[tab_properties["title"]] = tab_properties
+            log.info(f"Created the {', '.join(missing)} tabs to export to")
+
+        self._grids = {
+            tab: [properties[tab]["sheetId"], properties[tab]["gridProperties"]["rowCount"]]
+            for tab in widths
+        }
+
+    def _exportable(self, tab: str, keys: List[int]) -> List[int]:
+        """
+        Returns the keys whose rows fit on the tab, logging when some don't
+        """
+        # Row 1 is the header, so table id N lives on row N + 1
+        exportable = [key for key in keys if key + 1 <= self.max_rows]
+        if len(exportable) < len(keys) and tab not in self._full_tabs:
+            self._full_tabs.add(tab)
+            log.error(f"The {tab} tab is full at {self.max_rows} rows, so rows with ids over "
+                      f"{self.max_rows - 1} aren't exported to it")
+        return exportable
+
+    async def _grow(self, rows_needed: Dict[str, int]):
+        """
+        Adds rows to the tabs that are shorter than `rows_needed`, rounding
+        up to a multiple of `grow_rows`
+        """
+        requests = []
+        grown = {}
+        for tab, needed in rows_needed.items():
+            sheet_id, row_count = self._grids[tab]
+            if needed > row_count:
+                new_count = min(self.max_rows, -(-needed // self.grow_rows) * self.grow_rows)
+                requests.append({"appendDimension": {
+                    "sheetId": sheet_id, "dimension": "ROWS", "length": new_count - row_count}})
+                grown[tab] = new_count
+
+        await self.sheet.update_spreadsheet(requests)
+        for tab, new_count in grown.items():
+            self._grids[tab][1] = new_count
+
+    def _rows_to_ranges(self, tab, header, keys, lookup, make_row) -> Dict[str, List[list]]:
+        updates = {}
+        for first, last in coalesce(keys):
+            # Row 1 is the header, so table id N lives on row N + 1
+            updates[sheet_range(tab, first + 1, last + 1, len(header))] = [
+                make_row(lookup.get(key)) for key in range(first, last + 1)
+            ]
+        return updates
+
+    async def export_batch(self) -> int:
+        """
+        Exports the oldest `batch_size` entries in the outbox in a single
+        request. Returns how many entries were exported.
+        """
+        entries = await self.database.get_outbox(self.batch_size)
+        if len(entries) == 0:
+            return 0
+
+        user_tids = self._exportable(
+            self.users_tab, [entry.key for entry in entries if entry.kind == OUTBOX_USER])
+        coin_gain_tids = self._exportable(
+            self.coin_gains_tab, [entry.key for entry in entries if entry.kind == OUTBOX_COIN_GAIN])
+        await self._grow({
+            self.users_tab: max(user_tids, default=0) + 1,
+            self.coin_gains_tab: max(coin_gain_tids, default=0) + 1,
+        })
+        users = await self.database.get_export_users(user_tids)
+        coin_gains = await self.database.get_export_coin_gains(coin_gain_tids)
+
+        updates = {}
+        if not self._headers_written:
+            updates[sheet_range(self.users_tab, 1, 1, len(USER_HEADER))] = [USER_HEADER]
+            updates[sheet_range(self.coin_gains_tab, 1, 1, len(COIN_GAIN_HEADER))] = [COIN_GAIN_HEADER]
+        updates.update(self._rows_to_ranges(
+            self.users_tab, USER_HEADER, user_tids, users, self.user_row))
+        updates.update(self._rows_to_ranges(
+            self.coin_gains_tab, COIN_GAIN_HEADER, coin_gain_tids, coin_gains, self.coin_gain_row))
+
+        await self.sheet.batch_update(updates)
+        self.requests += 1
+        self._headers_written = True
+
+        await self.database.clear_outbox(entries)
+        self.rows_exported += len(entries)
+        return len(entries)
+
+    async def export(self) -> int:
+        """
+        Exports everything in the outbox, one batch at a time. Returns how
+        many entries were exported. Raises a `SheetError` if the sheet
+        couldn't be written to; whatever wasn't exported stays in the outbox.
+        """
+        async with self._export_lock:
+            if self._grids is None:
+                await self.prepare()
+
+            exported = 0
+            while (count := await self.export_batch()) > 0:
+                exported += count
+                if count < self.batch_size:
+                    break
+
+            self.exported_at = time.time()
+            if exported > 0:
+                log.info(f"Exported {exported} changed rows to the sheet")
+            return exported
+
+    async def _export_forever(self):
+        while True:
+            try:
+                await self.export()
+            except Exception:
+                if self._grids is None:
+                    # Every export would fail the same way until someone fixes
+                    # the spreadsheet, so this is only reported once
+                    log.error(f"Couldn't set up the tabs to export to, so automatic exports are off "
+                              f"until an export is run by hand:\n{traceback.format_exc()}")
+                    return
+                log.error(f"Failed to export to the sheet:\n{traceback.format_exc()}")
+            await asyncio.sleep(self.export_interval)
+
+    def start(self):
+        """
+        Starts exporting in the background, if that isn't happening already.
+        If the export tabs can't be set up, that is logged and the background
+        export stops. Must be called from inside the event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._export_forever())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
@@ -0,0 +1,215 @@
+"""
+An in-memory stand-in for the `spreadsheets()` resource of the Google Sheets
+API, for exercising `GoogleSheet`/`AsyncGoogleSheet` offline.
+
+Only the parts the bot uses are implemented: `values().get`, `batchGet` and
+`batchUpdate`, with plain A1 ranges like "'Tab name'!A3:C" or "Tab!B2", and
+`get` and `batchUpdate` with `addSheet` and `appendDimension` requests.
+Like the real API, writing outside a tab's grid fails.
+"""
+
+import json
+import re
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+_A1_CELL = re.compile(r"^([A-Z]*)([0-9]*)$")
+
+def column_to_index(column: str) -> int:
+    """'A' -> 0, 'Z' -> 25, 'AA' -> 26"""
+    index = 0
+    for c in column:
+        index = index * 26 + ord(c) - ord('A') + 1
+    return index - 1
+
+def index_to_column(index: int) -> str:
+    """0 -> 'A', 25 -> 'Z', 26 -> 'AA'"""
+    column = ""
+    index += 1
+    while index > 0:
+        index, rem = divmod(index - 1, 26)
+        column = chr(ord('A') + rem) + column
+    return column
+
+def parse_range(cell_range: str):
+    """
+    Splits an A1 range into (tab, first row, last row, first column, last
+    column), all 0-based and inclusive. Open ends are None.
+    """
+    tab, _, cells = cell_range.rpartition('!')
+    if tab.startswith("'") and tab.endswith("'"):
+        tab = tab[1:-1].replace("''", "'")
+    start, _, end = cells.partition(':')
+    if not end:
+        end = start
+
+    bounds = []
+    for cell in (start, end):
+        if (match := _A1_CELL.match(cell.upper())) is None:
+            raise ValueError(f"Bad A1 range {cell_range!r}")
+        column, row = match.groups()
+        bounds.append((int(row) - 1 if row else None,
+                       column_to_index(column) if column else None))
+
+    (row_start, col_start), (row_end, col_end) = bounds
+    return tab, row_start or 0, row_end, col_start or 0, col_end
+
+class _Request:
+    def __init__(self, api, function):
+        self.api = api
+        self.function = function
+
+    def execute(self):
+        return self.api._execute(self.function)
+
+class _Values:
+    def __init__(self, api):
+        self.api = api
+
+    def get(self, spreadsheetId, range):
+        return _Request(self.api, lambda: self.api._get(range))
+
+    def batchGet(self, spreadsheetId, ranges):
+        return _Request(self.api, lambda: {
+            "spreadsheetId": spreadsheetId,
+            "valueRanges": [self.api._get(r) for r in ranges],
+        })
+
+    def batchUpdate(self, spreadsheetId, body):
+        def update():
+            cells = sum(self.api._update(data["range"], data["values"]) for data in body["data"])
+            return {"spreadsheetId": spreadsheetId, "totalUpdatedCells": cells}
+        return _Request(self.api, update)
+
+class FakeSheetsAPI:
+    """
+    Holds each tab as a list of rows of strings. Every executed request
+    sleeps for `latency` seconds first, and counts towards `requests`.
+
+    Call `fail_next(status, times)` to make the next `times` requests raise
+    an `HttpError` with that HTTP status, like the real API does.
+    """
+
+    def __init__(self, tabs: Optional[Dict[str, List[List]]] = None, latency: float = 0.0):
+        self.tabs = {tab: [list(row) for row in rows] for tab, rows in (tabs or {}).items()}
+        # tab -> [sheetId, rowCount, columnCount]
+        self.grids = {
+            tab: [i, max(1000, len(rows)), max([26] + [len(row) for row in rows])]
+            for i, (tab, rows) in enumerate(self.tabs.items())
+        }
+        self.latency = latency
+        self.requests = 0
+        self._failures = []
+        self._lock = threading.Lock()
+
+    def values(self):
+        return _Values(self)
+
+    def get(self, spreadsheetId, fields=None):
+        return _Request(self, lambda: {
+            "sheets": [{"properties": self._properties(tab)} for tab in self.tabs],
+        })
+
+    def batchUpdate(self, spreadsheetId, body):
+        def update():
+            # Checked up front, so that a bad request changes nothing
+            for request in body["requests"]:
+                if "addSheet" in request and request["addSheet"]["properties"]["title"] in self.tabs:
+                    self._bad_request(f"A sheet with the name {request['addSheet']['properties']['title']!r} already exists")
+                if "appendDimension" in request and request["appendDimension"]["sheetId"] not in self._tabs_by_id():
+                    self._bad_request(f"No grid with id: {request['appendDimension']['sheetId']}")
+
+            replies = []
+            for request in body["requests"]:
+                if "addSheet" in request:
+                    properties = request["addSheet"]["properties"]
+                    grid = properties.get("gridProperties", {})
+                    tab = properties["title"]
+                    sheet_id = max([-1] + [g[0] for g in self.grids.values()]) + 1
+                    self.tabs[tab] = []
+                    self.grids[tab] = [sheet_id, grid.get("rowCount", 1000), grid.get("columnCount", 26)]
+                    replies.append({"addSheet": {"properties": self._properties(tab)}})
+                elif "appendDimension" in request:
+                    append = request["appendDimension"]
+                    grid = self.grids[self._tabs_by_id()[append["sheetId"]]]
+                    grid[1 if append["dimension"] == "ROWS" else 2] += append["length"]
+                    replies.append({})
+                else:
+                    raise NotImplementedError(f"FakeSheetsAPI can't handle {request}")
+            return {"spreadsheetId": spreadsheetId, "replies": replies}
+        return _Request(self, update)
+
+    def fail_next(self, status: int, times: int = 1):
+        with self._lock:
+            self._failures += [status] * times
+
+    def _execute(self, function):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.requests += 1
+            if self._failures:
+                status = self._failures.pop(0)
+                content = json.dumps({"error": {"code": status, "message": "Injected failure"}})
+                raise HttpError(httplib2.Response({"status": status}), content.encode())
+            return function()
+
+    @staticmethod
+    def _bad_request(message):
+        content = json.dumps({"error": {"code": 400, "message": message}})
+        raise HttpError(httplib2.Response({"status": 400}), content.encode())
+
+    def _properties(self, tab):
+        sheet_id, rows, columns = self.grids[tab]
+        return {"sheetId": sheet_id, "title": tab, "gridProperties": {"rowCount": rows, "columnCount": columns}}
+
+    def _tabs_by_id(self):
+        return {grid[0]: tab for tab, grid in self.grids.items()}
+
+    def _rows(self, tab):
+        if tab not in self.tabs:
+            self._bad_request(f"Unable to parse range: {tab}")
+        return self.tabs[tab]
+
+    def _get(self, cell_range):
+        tab, row_start, row_end, col_start, col_end = parse_range(cell_range)
+        rows = self._rows(tab)
+        stop = len(rows) if row_end is None else row_end + 1
+
+        values = []
+        for row in rows[row_start:stop]:
+            row = row[col_start:None if col_end is None else col_end + 1]
+            while row and row[-1] in ("", None):
+                row = row[:-1]
+            values.append([str(v) for v in row])
+        # The real API leaves out trailing empty rows too
+        while values and not values[-1]:
+            values.pop()
+
+        result = {"range": cell_range, "majorDimension": "ROWS"}
+        if values:
+            result["values"] = values
+        return result
+
+    def _update(self, cell_range, values) -> int:
+        tab, row_start, _, col_start, _ = parse_range(cell_range)
+        rows = self._rows(tab)
+        _, row_count, column_count = self.grids[tab]
+        if (row_start + len(values) > row_count
+                or col_start + max([0] + [len(row) for row in values]) > column_count):
+            self._bad_request(f"Range ({cell_range}) exceeds grid limits. Max rows: {row_count}, max columns: {column_count}")
+
+        cells = 0
+        for i, new_row in enumerate(values):
+            while len(rows) <= row_start + i:
+                rows.append([])
+            row = rows[row_start + i]
+            if len(row) < col_start + len(new_row):
+                row += [""] * (col_start + len(new_row) - len(row))
+            row[col_start:col_start + len(new_row)] = new_row
+            cells += len(new_row)
+        return cells
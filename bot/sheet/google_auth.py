@@ -1,8 +1,8 @@
-import traceback
-
 from googleapiclient.discovery import build
 from oauth2client.service_account import ServiceAccountCredentials
 
+from .async_sheet import AsyncGoogleSheet
+from .errors import to_sheet_error
 from .settings import GOOGLE_SCOPES, GOOGLE_CREDENTIALS_FILE, SPREADSHEET_ID
 
 class GoogleSheet:
@@ -22,16 +22,17 @@ class GoogleSheet:
 
         cell: The cell (or range of cells) to fetch. Must include the sheet
               name. An example format is "Sheet1!A1"
+
+        Raises a `SheetError` if the request fails.
         """
         try:
             result = self.sheet_api.values().get(
                 spreadsheetId=self.sheet_id,
                 range=cell).execute()
-            result = result.get('values', [])
-            return result
-        except:
-            traceback.print_exc()
-            return []
+        except Exception as e:
+            raise to_sheet_error(e) from e
+
+        return result.get('values', [])
 
 class GoogleAPI:
     def __init__(self, scopes=GOOGLE_SCOPES, cred_file=GOOGLE_CREDENTIALS_FILE):
@@ -62,6 +63,10 @@ class GoogleAPI:
 
         return GoogleSheet(self.sheet_api, sheet_id)
 
+    def make_async_sheet(self, sheet_id=SPREADSHEET_ID):
+        self.make_sheet(sheet_id)
+        return AsyncGoogleSheet(self.sheet_api, sheet_id)
+
 if __name__ == "__main__":
     b = GoogleAPI()
     print("Authenticating with Google...")
@@ -0,0 +1,174 @@
+from dataclasses import dataclass, field
+import datetime
+import logging
+log = logging.getLogger(__name__)
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from ..async_database import AsyncDatabase
+from ..database import ImportedUser, ImportCounts
+from .async_sheet import AsyncGoogleSheet
+from .settings import (IMPORT_BACKPACK_TAB, IMPORT_DIRECTORY_TAB, IMPORT_HEADER_ROW,
+                       IMPORT_FIRST_ROW, IMPORT_PAGE_ROWS)
+
+# Column positions on the backpack tab
+BACKPACK_NAME, BACKPACK_DISCRIMINATOR, BACKPACK_COINS, BACKPACK_ITEMS = 0, 1, 2, 3
+# Column positions on the directory tab
+DIRECTORY_NAME, DIRECTORY_DISCRIMINATOR = 2, 3
+
+def member_key(name: str, discriminator: str) -> Tuple[str, str]:
+    """
+    Normalizes a name and discriminator the way the sheet might have them
+    ("#0042", "0042", "42") into the `(name, "#0042")` form the member
+    lookup table uses
+    """
+    discriminator = str(discriminator).strip().lstrip('#')
+    if discriminator.isdigit():
+        discriminator = discriminator.zfill(4)
+    return str(name).strip(), '#' + discriminator
+
+def make_member_table(members) -> Dict[Tuple[str, str], int]:
+    """
+    Builds the `(name, "#discriminator") -> discord id` lookup table used to
+    resolve the names on the sheet, from a guild's members
+    """
+    return {member_key(member.name, member.discriminator): member.id for member in members}
+
+def parse_count(value) -> Optional[int]:
+    """
+    Reads a number off the sheet. Blank cells are 0, anything that isn't a
+    whole number is None.
+    """
+    value = str(value).strip().replace(',', '')
+    if value == "":
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return int(number) if number.is_integer() else None
+
+@dataclass
+class ImportReport:
+    """What an import from the sheet found and did"""
+    rows_read: int = 0
+    requests: int = 0
+    unmatched: List[str] = field(default_factory=list) # Each name once, where it was first seen
+    bad_rows: List[str] = field(default_factory=list)
+    counts: Optional[ImportCounts] = None
+
+class SheetImporter:
+    """
+    Loads the legacy data on the Google Sheet into the database.
+
+    Both tabs are downloaded `page_rows` rows at a time, one page of each
+    per request. Rows are parsed as their page arrives, names being resolved
+    to discord ids through a lookup table built once from the guild's
+    members. Once every page is in, everything is written in a single
+    transaction by `Database.import_users`.
+
+    Paging stops once a page comes back short, so the tabs must not have
+    blank rows in the middle.
+    """
+
+    def __init__(self, database: AsyncDatabase, sheet: AsyncGoogleSheet,
+                 backpack_tab: str = IMPORT_BACKPACK_TAB, directory_tab: str = IMPORT_DIRECTORY_TAB,
+                 page_rows: int = IMPORT_PAGE_ROWS):
+        self.database = database
+        self.sheet = sheet
+        self.backpack_tab = backpack_tab
+        self.directory_tab = directory_tab
+        self.page_rows = page_rows
+
+    def _rows(self, tab: str, first: int, last: int) -> str:
+        tab = tab.replace("'", "''")
+        return f"'{tab}'!{first}:{last}"
+
+    async def run(self, members: Dict[Tuple[str, str], int],
+                  progress: Optional[Callable[[str], Awaitable[None]]] = None) -> ImportReport:
+        """
+        Imports everything on the sheet. `members` is the table from
+        `make_member_table`. If given, `progress` is called with a short
+        description of how far along the import is after every page.
+
+        Raises a `SheetError` if the sheet can't be read, in which case
+        nothing is written to the database.
+        """
+        report = ImportReport()
+        users: Dict[int, ImportedUser] = {}
+        unmatched_keys = set()
+        item_titles = None
+
+        def resolve(name, discriminator, row_number, tab) -> Optional[int]:
+            key = member_key(name, discriminator)
+            if (discord_id := members.get(key)) is None and key not in unmatched_keys:
+                # Most names are on both tabs, so only the first is reported
+                unmatched_keys.add(key)
+                report.unmatched.append(f"{key[0]}{key[1]} ({tab} row {row_number})")
+            return discord_id
+
+        first = IMPORT_FIRST_ROW
+        backpack_done = directory_done = False
+        while not (backpack_done and directory_done):
+            last = first + self.page_rows - 1
+            ranges = []
+            if item_titles is None:
+                ranges.append(self._rows(self.backpack_tab, IMPORT_HEADER_ROW, IMPORT_HEADER_ROW))
+            if not backpack_done:
+                ranges.append(self._rows(self.backpack_tab, first, last))
+            if not directory_done:
+                ranges.append(self._rows(self.directory_tab, first, last))
+
+            pages = await self.sheet.batch_get(ranges)
+            report.requests += 1
+            if item_titles is None:
+                header, *pages = pages
+                item_titles = [str(title).strip() for title in (header[0] if header else [])]
+
+            if not backpack_done:
+                page, *pages = pages
+                backpack_done = len(page) < self.page_rows
+                for row_number, row in enumerate(page, first):
+                    if len(row) < 2:
+                        continue
+                    if (discord_id := resolve(row[BACKPACK_NAME], row[BACKPACK_DISCRIMINATOR],
+                                              row_number, self.backpack_tab)) is None:
+                        continue
+
+                    coins = parse_count(row[BACKPACK_COINS]) if len(row) > BACKPACK_COINS else 0
+                    backpack = {
+                        item_titles[column]: parse_count(row[column])
+                        for column in range(BACKPACK_ITEMS, min(len(row), len(item_titles)))
+                        if item_titles[column]
+                    }
+                    if coins is None or None in backpack.values():
+                        report.bad_rows.append(f"{self.backpack_tab} row {row_number}")
+                        continue
+
+                    # Zero counts are kept, so items taken away on the sheet
+                    # are taken away in the database too
+                    users[discord_id] = ImportedUser(discord_id, coins, backpack)
+                report.rows_read += len(page)
+
+            if not directory_done:
+                page, = pages
+                directory_done = len(page) < self.page_rows
+                for row_number, row in enumerate(page, first):
+                    if len(row) <= DIRECTORY_DISCRIMINATOR:
+                        continue
+                    if (discord_id := resolve(row[DIRECTORY_NAME], row[DIRECTORY_DISCRIMINATOR],
+                                              row_number, self.directory_tab)) is None:
+                        continue
+                    if discord_id not in users:
+                        users[discord_id] = ImportedUser(discord_id, None, {})
+                report.rows_read += len(page)
+
+            first = last + 1
+            if progress is not None:
+                await progress(f"Read {report.rows_read} rows, found {len(users)} users...")
+
+        report.counts = await self.database.import_users(list(users.values()), datetime.datetime.now())
+        log.info(f"Imported {len(users)} users from {report.rows_read} rows in {report.requests} requests")
+        return report
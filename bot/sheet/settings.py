@@ -1,5 +1,41 @@
 from os.path import join, dirname, abspath
 
-GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
+# Read-write, not read-only: the exporter writes to its own tabs, and creates
+# them if they are missing, so the service account has to be an editor of the
+# spreadsheet
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 GOOGLE_CREDENTIALS_FILE = join(dirname(abspath(__file__)), "google-service-account.json")
 SPREADSHEET_ID = "1O1TvSiz3OahPaZQq_M4IMYukYHjFlEyj1fCyimoYIJo"
+
+# Where users' balances live on the sheet: name, #discriminator, balance
+BALANCE_RANGE = "'User Backpack'!A3:C"
+# How often, in seconds, the in-memory copy of the balances is refreshed
+SNAPSHOT_REFRESH_INTERVAL = 300
+
+# Tabs the bot exports its database to. These are owned by the bot: anything
+# typed into them by hand will be overwritten. They are created when the bot
+# starts if they don't exist.
+EXPORT_USERS_TAB = "Bot Users"
+EXPORT_COIN_GAINS_TAB = "Bot Coin Gains"
+# Every user and coin gain is written to the row after its id (row 1 is the
+# header), so ids that were deleted leave blank rows. The tabs are grown
+# EXPORT_GROW_ROWS rows at a time, up to EXPORT_MAX_ROWS rows; anything with
+# a higher id is left out of the export. A spreadsheet can hold 10 million
+# cells in total, so this keeps the coin gains tab to at most a tenth of that.
+EXPORT_MAX_ROWS = 200_000
+EXPORT_GROW_ROWS = 1000
+# How often, in seconds, changes are exported, and at most how many changed
+# rows go into each request
+EXPORT_INTERVAL = 60
+EXPORT_BATCH_SIZE = 1000
+
+# Where the legacy data is imported from. 'User Backpack' has a user's name,
+# #discriminator and balance in columns A to C, followed by one column per
+# item, with the item titles in the header row. 'User Directory' lists
+# everyone taking part, name and #discriminator in columns C and D.
+IMPORT_BACKPACK_TAB = "User Backpack"
+IMPORT_DIRECTORY_TAB = "User Directory"
+IMPORT_HEADER_ROW = 2
+IMPORT_FIRST_ROW = 3
+# How many rows of each tab are downloaded per request
+IMPORT_PAGE_ROWS = 5000
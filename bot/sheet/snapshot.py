@@ -0,0 +1,109 @@
+import asyncio
+import hashlib
+import json
+import logging
+log = logging.getLogger(__name__)
+import time
+import traceback
+from typing import Dict, Optional, Tuple
+
+from .async_sheet import AsyncGoogleSheet
+from .settings import BALANCE_RANGE, SNAPSHOT_REFRESH_INTERVAL
+
+class BalanceSnapshot:
+    """
+    An in-memory copy of the balances on the Google Sheet, indexed by
+    `(name, "#discriminator")`, so that looking up a balance doesn't need to
+    download and scan the whole sheet.
+
+    A background task refreshes it every `refresh_interval` seconds. The
+    Sheets API can't tell us whether a range changed since we last read it,
+    so the next best thing is done: the download is hashed, and the index is
+    only rebuilt when the hash differs.
+    """
+
+    def __init__(self, sheet: AsyncGoogleSheet, cell_range: str = BALANCE_RANGE,
+                 refresh_interval: float = SNAPSHOT_REFRESH_INTERVAL):
+        self.sheet = sheet
+        self.cell_range = cell_range
+        self.refresh_interval = refresh_interval
+
+        self.balances: Dict[Tuple[str, str], str] = {}
+        self.refreshed_at: Optional[float] = None
+        self.changed_at: Optional[float] = None
+        self._digest = None
+        self._task = None
+        self._refresh_lock = asyncio.Lock()
+
+    @staticmethod
+    def index_rows(rows) -> Dict[Tuple[str, str], str]:
+        """
+        Builds the `(name, "#discriminator") -> balance` index from the rows of
+        the balance range. A user with no balance filled in has 0 coins.
+        """
+        balances = {}
+        for row in rows:
+            if len(row) >= 2:
+                row_user, row_disc, *rest = row
+                balances[(row_user, row_disc)] = rest[0] if len(rest) > 0 else 0
+
+        return balances
+
+    async def refresh(self) -> bool:
+        """
+        Downloads the balance range and updates the index if it changed.
+        Returns whether anything changed. Raises a `SheetError` if the sheet
+        couldn't be read, leaving the previous snapshot in place.
+        """
+        async with self._refresh_lock:
+            rows = await self.sheet.fetch(self.cell_range)
+
+            digest = hashlib.sha256(json.dumps(rows).encode()).digest()
+            self.refreshed_at = time.time()
+            if digest == self._digest:
+                return False
+
+            self.balances = self.index_rows(rows)
+            self._digest = digest
+            self.changed_at = self.refreshed_at
+            log.info(f"Balance snapshot refreshed with {len(self.balances)} users")
+            return True
+
+    async def _refresh_forever(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                log.error(f"Failed to refresh balance snapshot:\n{traceback.format_exc()}")
+            await asyncio.sleep(self.refresh_interval)
+
+    def start(self):
+        """
+        Starts refreshing in the background, if that isn't happening already.
+        Must be called from inside the event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._refresh_forever())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def age(self) -> Optional[float]:
+        """
+        Returns how many seconds ago the snapshot was last refreshed, or None
+        if it never has been
+        """
+        if self.refreshed_at is None:
+            return None
+        return time.time() - self.refreshed_at
+
+    async def get(self, name: str, discriminator: str) -> Optional[str]:
+        """
+        Returns the balance for a user, or None if they aren't on the sheet.
+        Only waits on the sheet if there is no snapshot yet at all.
+        """
+        if self.refreshed_at is None:
+            await self.refresh()
+        return self.balances.get((name, discriminator))
@@ -2,11 +2,16 @@ import discord
 from discord.ext import commands
 import logging
 log = logging.getLogger(__name__)
+import time
 
 from .commands import Commands
-from .database import Database
+from .async_database import AsyncDatabase
 from .permissions import check_user, is_admin
-from .sheet.google_auth import GoogleSheet
+from .sheet.async_sheet import AsyncGoogleSheet
+from .sheet.errors import SheetError
+from .sheet.exporter import SheetExporter
+from .sheet.importer import SheetImporter, make_member_table
+from .sheet.snapshot import BalanceSnapshot
 
 class SheetCommands(Commands):
     """
@@ -14,39 +19,43 @@ class SheetCommands(Commands):
     visualization
     """
 
-    def __init__(self, sheet: GoogleSheet, database: Database):
+    def __init__(self, sheet: AsyncGoogleSheet, database: AsyncDatabase):
         self.sheet = sheet
         self.database = database
+        self.snapshot = BalanceSnapshot(sheet)
+        self.exporter = SheetExporter(database, sheet)
+        self.importer = SheetImporter(database, sheet)
 
     def setup(self, bot):
+        bot.add_listener(self.on_ready, "on_ready")
         self.command(bot, self.balance, self.balance_error)
+        sheet_group = self.group(bot, self.sheet_group_entry, name="sheet")
+        self.command(sheet_group, self.refresh_snapshot, name="refresh")
+        self.command(sheet_group, self.snapshot_status, name="status")
         self.command(bot, self.import_sheet, name="import")
         self.command(bot, self.export_sheet, name="export")
 
+    async def on_ready(self):
+        # Can't start background tasks before the event loop is running
+        self.snapshot.start()
+        self.exporter.start()
+
     async def balance(self, ctx, *, user: discord.Member = None):
         """Check the current coin balance for yourself or another user"""
         if not user:
             user = ctx.author
 
-        await ctx.channel.trigger_typing()
-        await ctx.send(self.get_balance(user))
+        await self.reply(ctx, await self.get_balance(user))
 
     async def balance_error(self, ctx, error):
         if isinstance(error, commands.BadArgument):
-            await ctx.send("I couldn't find that member, sorry :(")
+            await self.reply(ctx, "I couldn't find that member, sorry :(")
         else:
             await self.default_error(ctx, error)
 
-    def get_balance(self, user):
+    async def get_balance(self, user):
         discriminator = '#' + str(user.discriminator)
-        balance = None
-        sheet_data = self.sheet.fetch("'User Backpack'!A3:C")
-        for row in sheet_data:
-            if len(row) >= 2:
-                row_user, row_disc, *rest = row
-                if row_user == user.name and row_disc == discriminator:
-                    if len(rest) > 0: balance = rest[0]
-                    else: balance = 0
+        balance = await self.snapshot.get(user.name, discriminator)
 
         log.info(f"{user}: {balance}")
 
@@ -55,12 +64,113 @@ class SheetCommands(Commands):
         else:
             return f"{user.display_name} has **{balance}** coins!"
 
+    @check_user(is_admin)
+    async def sheet_group_entry(self, ctx):
+        """
+        (ADMIN ONLY) Manage the bot's copy of the Google Sheet
+        """
+        if ctx.invoked_subcommand is None:
+            await self.snapshot_status(ctx)
+
+    @check_user(is_admin)
+    async def refresh_snapshot(self, ctx):
+        """
+        (ADMIN ONLY) Re-download balances from the Google Sheet right now
+        """
+        self.typing(ctx)
+        try:
+            changed = await self.snapshot.refresh()
+        except SheetError as e:
+            await self.reply(ctx, f"Couldn't read the Google Sheet: {e}")
+            return
+
+        if changed:
+            await self.reply(ctx, f"Refreshed! The sheet has {len(self.snapshot.balances)} users.")
+        else:
+            await self.reply(ctx, "Refreshed! Nothing changed on the sheet.")
+
+    @check_user(is_admin)
+    async def snapshot_status(self, ctx):
+        """
+        (ADMIN ONLY) Show how old the bot's copy of the Google Sheet is
+        """
+        if (age := self.snapshot.age()) is None:
+            await self.reply(ctx, "The sheet hasn't been downloaded yet.")
+            return
+
+        changed_ago = time.time() - self.snapshot.changed_at
+        await self.reply(ctx,
+            f"The sheet was last downloaded {age:.0f}s ago and last changed "
+            f"{changed_ago:.0f}s ago. {len(self.snapshot.balances)} users are on it; "
+            f"it refreshes every {self.snapshot.refresh_interval:.0f}s."
+        )
+
     @check_user(is_admin)
     async def import_sheet(self, ctx):
-        """INCOMPLETE: Imports data from the Google Sheet into the bot's database"""
-        await ctx.send("I didn't do anything!")
+        """
+        (ADMIN ONLY) Imports everyone's balance and backpack from the Google
+        Sheet into the bot's database, overwriting what the bot has for them.
+        Names on the sheet are matched against the members of this server.
+        """
+        if ctx.guild is None:
+            await self.reply(ctx, "This has to be run in a server, so I can match names to members.")
+            return
+
+        status = await self.reply(ctx, "Importing from the Google Sheet...", merge=False)
+        last_edit = time.monotonic()
+
+        async def progress(text):
+            # Editing on every page would run into Discord's rate limits
+            nonlocal last_edit
+            if time.monotonic() - last_edit >= 2:
+                last_edit = time.monotonic()
+                await status.edit(content=text)
+
+        try:
+            report = await self.importer.run(make_member_table(ctx.guild.members), progress)
+        except SheetError as e:
+            await status.edit(content=f"Couldn't read the Google Sheet, nothing was imported: {e}")
+            return
+
+        counts = report.counts
+        lines = [
+            f"Imported {report.rows_read} rows in {report.requests} requests: "
+            f"{counts.users_created} new users, {counts.balances_changed} balances changed, "
+            f"{counts.backpack_rows} backpack entries."
+        ]
+        if report.unmatched:
+            lines.append(f"{len(report.unmatched)} names didn't match anyone in this server: "
+                         + ", ".join(report.unmatched[:10])
+                         + (", ..." if len(report.unmatched) > 10 else ""))
+        if report.bad_rows:
+            lines.append(f"{len(report.bad_rows)} rows had something that isn't a number, and were skipped: "
+                         + ", ".join(report.bad_rows[:10])
+                         + (", ..." if len(report.bad_rows) > 10 else ""))
+        if counts.unknown_items:
+            lines.append("These items aren't registered, so nobody got them: "
+                         + ", ".join(counts.unknown_items))
+        await status.edit(content="\n".join(lines)[:2000])
 
     @check_user(is_admin)
     async def export_sheet(self, ctx):
-        """INCOMPLETE: Exports data from the bot's database into the Google Sheet"""
-        await ctx.send("I didn't do anything!")
+        """
+        (ADMIN ONLY) Exports everything that changed in the bot's database to
+        the Google Sheet right now, instead of waiting for the next automatic
+        export
+        """
+        self.typing(ctx)
+        requests_before = self.exporter.requests
+        try:
+            exported = await self.exporter.export()
+        except SheetError as e:
+            remaining = await self.database.count_outbox()
+            await self.reply(ctx, f"Couldn't write to the Google Sheet: {e}\n{remaining} changed rows are still waiting to be exported.")
+            return
+
+        # In case automatic exports stopped because the tabs couldn't be set up
+        self.exporter.start()
+
+        if exported == 0:
+            await self.reply(ctx, "Nothing changed since the last export.")
+        else:
+            await self.reply(ctx, f"Exported {exported} changed rows in {self.exporter.requests - requests_before} requests.")
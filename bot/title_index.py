@@ -0,0 +1,108 @@
+from bisect import bisect_left, insort
+from collections import Counter
+import logging
+log = logging.getLogger(__name__)
+from typing import Dict, Iterable, List, Set
+
+# Length of the n-grams titles are broken into
+GRAM_SIZE = 3
+
+def grams(title: str) -> Set[str]:
+    """
+    Returns the set of trigrams in an uppercased title. The title is padded
+    so that its start and end count for more, and so that even one or two
+    letter titles have some grams.
+    """
+    padded = f"  {title} "
+    return {padded[i:i + GRAM_SIZE] for i in range(len(padded) - GRAM_SIZE + 1)}
+
+class TitleIndex:
+    """
+    A search index over item titles, for when someone doesn't type a title
+    exactly right. Titles are uppercased, like `ItemCatalog` keys them.
+
+    Prefix completion binary searches a sorted list of every title. Closest
+    matches are found through a trigram -> titles index: only titles sharing
+    at least one trigram with the query are looked at, and they're ranked by
+    how many trigrams they share relative to their combined size (the Dice
+    coefficient). Adding or removing a title only touches its own trigrams.
+
+    Not thread safe on its own; `ItemCatalog` only uses it under its lock.
+    """
+
+    def __init__(self, titles: Iterable[str] = ()):
+        self._sorted: List[str] = []
+        self._grams: Dict[str, Set[str]] = {}
+        self._postings: Dict[str, Set[str]] = {}
+        for title in titles:
+            self.add(title)
+
+    def add(self, title: str):
+        if title in self._grams:
+            return
+
+        insort(self._sorted, title)
+        title_grams = self._grams[title] = grams(title)
+        for gram in title_grams:
+            self._postings.setdefault(gram, set()).add(title)
+
+    def remove(self, title: str):
+        if (title_grams := self._grams.pop(title, None)) is None:
+            return
+
+        del self._sorted[bisect_left(self._sorted, title)]
+        for gram in title_grams:
+            postings = self._postings[gram]
+            postings.discard(title)
+            if not postings:
+                del self._postings[gram]
+
+    def complete(self, prefix: str, limit: int = 5) -> List[str]:
+        """
+        Returns up to `limit` titles starting with `prefix`, alphabetically
+        """
+        start = bisect_left(self._sorted, prefix)
+        matches = []
+        for title in self._sorted[start:start + limit]:
+            if not title.startswith(prefix):
+                break
+            matches.append(title)
+        return matches
+
+    def closest(self, query: str, limit: int = 5, cutoff: float = 0.3) -> List[str]:
+        """
+        Returns up to `limit` titles that look most like `query`, best first.
+        Titles that `query` is a prefix of come before everything else;
+        the rest need a similarity of at least `cutoff` to be returned.
+        """
+        matches = self.complete(query, limit)
+        if len(matches) == limit:
+            return matches
+
+        query_grams = grams(query)
+        shared = Counter()
+        for gram in query_grams:
+            shared.update(self._postings.get(gram, ()))
+
+        # Even a title made up of nothing but shared trigrams needs at least
+        # this many of them to reach `cutoff`, which rules out most titles
+        # without working out their score
+        min_shared = cutoff * len(query_grams) / (2 - cutoff)
+        scored = []
+        for title, count in shared.items():
+            if count < min_shared:
+                continue
+            score = 2 * count / (len(query_grams) + len(self._grams[title]))
+            if score >= cutoff:
+                scored.append((-score, title))
+        scored.sort()
+
+        for _, title in scored:
+            if len(matches) == limit:
+                break
+            if title not in matches:
+                matches.append(title)
+        return matches
+
+    def __len__(self):
+        return len(self._sorted)
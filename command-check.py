@@ -0,0 +1,82 @@
+#!/bin/env python3
+"""
+Ad-hoc checks that commands registered through `bot.commands.Commands` run
+correctly under the installed discord.py, without connecting to discord.
+Commands are invoked the same way `Bot.process_commands` would.
+
+Usage: python command-check.py
+"""
+
+import asyncio
+import sys
+from types import SimpleNamespace
+
+from discord.ext import commands
+
+from bot.commands import Commands
+
+class CheckCommands(Commands):
+    def __init__(self):
+        self.calls = []
+
+    def setup(self, bot):
+        group = self.group(bot, self.group_entry, name="group")
+        self.command(group, self.subcommand, name="sub")
+        self.command(bot, self.plain, name="plain")
+
+    async def group_entry(self, ctx):
+        self.calls.append("group")
+
+    async def subcommand(self, ctx):
+        self.typing(ctx)
+        self.calls.append("sub")
+
+    async def plain(self, ctx):
+        self.typing(ctx)
+        self.calls.append("plain")
+
+async def invoke(bot, message_id: int, content: str):
+    """
+    Runs a command as if a user had sent `content`. Raises whatever the
+    command (or its hooks) raised.
+    """
+    message = SimpleNamespace(
+        _state=None, id=message_id, content=content, guild=None,
+        author=SimpleNamespace(id=1, bot=False), channel=SimpleNamespace(id=1),
+    )
+    ctx = await bot.get_context(message)
+    await ctx.command.invoke(ctx)
+    return ctx
+
+async def check_invoke():
+    """
+    Grouped subcommands and plain commands both run, and the hook run after
+    them calls off the typing indicator they asked for
+    """
+    bot = commands.Bot(command_prefix="ca!")
+    bot._connection.user = SimpleNamespace(id=0)
+    registry = CheckCommands()
+    registry.setup(bot)
+
+    await invoke(bot, 1, "ca!group sub")
+    await invoke(bot, 2, "ca!plain")
+
+    problems = []
+    if registry.calls != ["group", "sub", "plain"]:
+        problems.append(f"expected group, sub, plain to run, got {registry.calls}")
+    if len(registry.responder._typing) != 0:
+        problems.append(f"{len(registry.responder._typing)} typing indicators still pending")
+    return problems
+
+CHECKS = [check_invoke]
+
+if __name__ == "__main__":
+    failed = False
+    for check in CHECKS:
+        problems = asyncio.run(check())
+        print(f"{check.__name__}: {'ok' if not problems else 'FAILED'}")
+        for problem in problems:
+            print(f"  {problem}")
+        failed = failed or len(problems) > 0
+
+    sys.exit(1 if failed else 0)
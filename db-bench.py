@@ -0,0 +1,527 @@
+#!/bin/env python3
+"""
+Ad-hoc benchmarks for the bot's database layer. Each benchmark works on a
+scratch database in a temporary directory, never on the real `coins.db`.
+
+Usage: python db-bench.py <benchmark>
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import os
+import random
+import statistics
+import string
+import sys
+import tempfile
+import time
+
+from bot.async_database import AsyncDatabase
+from bot.database import Database, connect_database, migrate_database
+from bot.database import ItemDefinition
+from bot.identity_cache import IdentityCache
+from bot.item_catalog import ItemCatalog
+from bot.ranking import Ranking
+from bot.sheet.async_sheet import AsyncGoogleSheet
+from bot.sheet.fake_sheet import FakeSheetsAPI
+from bot.sheet.importer import SheetImporter
+
+def make_scratch_database(directory, users=200, items=20, coins=10**6):
+    """
+    Creates and fills a scratch database, returning the path to it
+    """
+    path = os.path.join(directory, "bench.db")
+    conn = connect_database(path)
+    migrate_database(conn)
+    db = Database(conn)
+    for discord_id in range(users):
+        user_tid, _ = db.register_user(discord_id)
+        db.give_coins(user_tid, 0, datetime.datetime.now(), coins)
+    for item in range(items):
+        db.register_item(f"Item {item}", "An item", "https://example.com/item.png", 1)
+    conn.close()
+    return path
+
+async def measure_lag(workload, interval=0.001):
+    """
+    Runs `workload` while a ticker coroutine measures how late the event loop
+    wakes it up. Returns (elapsed seconds, list of lag samples in ms)
+    """
+    samples = []
+    done = False
+
+    async def ticker():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            samples.append((time.perf_counter() - start - interval) * 1000)
+
+    ticker_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await workload()
+    elapsed = time.perf_counter() - start
+    done = True
+    await ticker_task
+
+    return elapsed, samples
+
+def report_lag(name, elapsed, samples):
+    samples = sorted(samples)
+    p99 = samples[int(len(samples) * 0.99)] if samples else 0.0
+    print(f"{name:>6}: {elapsed:7.3f}s total, loop lag "
+          f"mean={statistics.mean(samples or [0]):7.3f}ms "
+          f"p99={p99:7.3f}ms max={max(samples or [0]):7.3f}ms")
+
+def bench_loop_lag(tasks=50, operations=20):
+    """
+    Event loop lag under concurrent `buy`/`givecoin` traffic, comparing
+    calling `Database` directly on the loop against `AsyncDatabase`
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_scratch_database(directory)
+        now = datetime.datetime.now()
+
+        conn = connect_database(path)
+        conn.execute('PRAGMA synchronous = FULL')
+        db = Database(conn)
+        item = db.find_item("Item 0")
+
+        async def sync_worker(n):
+            for i in range(operations):
+                db.buy_item_discord(n, 2 * i + 1, now, item)
+                db.give_coins_discord(n, 2 * i + 2, now, 1)
+                await asyncio.sleep(0)
+
+        async def sync_workload():
+            await asyncio.gather(*(sync_worker(n) for n in range(tasks)))
+
+        report_lag("before", *asyncio.run(measure_lag(sync_workload)))
+        conn.close()
+
+        adb = AsyncDatabase(path)
+
+        async def async_worker(n):
+            for i in range(operations):
+                # Message ids picked up where the first run left off
+                await adb.buy_item_discord(n, 2 * (operations + i) + 1, now, item)
+                await adb.give_coins_discord(n, 2 * (operations + i) + 2, now, 1)
+
+        async def async_workload():
+            await adb.run_write(lambda db: db.conn.execute('PRAGMA synchronous = FULL'))
+            await asyncio.gather(*(async_worker(n) for n in range(tasks)))
+
+        report_lag("after", *asyncio.run(measure_lag(async_workload)))
+        adb.close()
+
+def time_lookups(function, keys, repeat):
+    """
+    Returns the mean time in microseconds of `function(key)` over `keys`
+    """
+    start = time.perf_counter()
+    for i in range(repeat):
+        function(keys[i % len(keys)])
+    return (time.perf_counter() - start) / repeat * 10**6
+
+def bench_scaling(sizes=(10**4, 10**5, 10**6)):
+    """
+    Lookup latency of `get_user_tid`, `find_item` and `user_has_item` as the
+    tables grow, on the original schema (version 1) and fully migrated
+    """
+    print(f"{'rows':>8} {'schema':>6} {'get_user_tid':>14} {'find_item':>11} {'user_has_item':>15}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            conn = connect_database(os.path.join(directory, "bench.db"))
+            migrate_database(conn, target=1)
+            now = datetime.datetime.now()
+            conn.executemany(
+                'INSERT INTO users (id, user_id, coins) VALUES (?, ?, 0)',
+                ((i, str(10**17 + i)) for i in range(1, size + 1)))
+            conn.executemany(
+                '''INSERT INTO item_definitions (id, title, title_upper, desc, image_url, cost)
+                   VALUES (?, ?, ?, '', '', 1)''',
+                ((i, f"Item {i}", f"ITEM {i}") for i in range(1, size + 1)))
+            conn.executemany(
+                'INSERT INTO item_backpack (item_id, user_id, count) VALUES (?, ?, 1)',
+                ((i, i) for i in range(1, size + 1)))
+            conn.executemany(
+                '''INSERT INTO coin_gains (message_id, user_id, date_entered, coins)
+                   VALUES (?, ?, ?, 1)''',
+                ((str(i), i, now) for i in range(1, size + 1)))
+            conn.commit()
+
+            # Both caches in front of these lookups are bypassed, this measures
+            # the SQL underneath them
+            db = Database(conn, IdentityCache(capacity=0))
+            def find_item_sql(k):
+                return conn.execute('''SELECT id, title, desc, image_url, cost
+                                       FROM item_definitions
+                                       WHERE title_upper=?''', [f"ITEM {k}"]).fetchall()
+            keys = [(i * 7919) % size + 1 for i in range(1000)]
+            repeat = 20 if size >= 10**5 else 200
+            for schema in ("v1", "latest"):
+                if schema == "latest":
+                    migrate_database(conn)
+                    repeat = 1000
+                print(f"{size:>8} {schema:>6} "
+                      f"{time_lookups(lambda k: db.get_user_tid(10**17 + k), keys, repeat):>12.1f}us "
+                      f"{time_lookups(find_item_sql, keys, repeat):>9.1f}us "
+                      f"{time_lookups(lambda k: db.user_has_item(k, k), keys, repeat):>13.1f}us")
+            conn.close()
+
+def two_commit_purchase(db, discord_id, message_id, message_date, item):
+    """
+    How `Database.buy_item` used to work: charging the user and giving them
+    the item committed separately, so every purchase paid for two fsyncs
+    """
+    user_tid = db.get_user_tid(discord_id)
+    if not db.give_coins(user_tid, message_id, message_date, -item.cost):
+        return False
+    return db.give_item(user_tid, item.tid)
+
+def bench_purchases(purchases=2000):
+    """
+    Purchases per second with the charge and the item committed separately,
+    versus through `Database.buy_item_discord` in one transaction, with
+    SQLite fsyncing on every commit like it does on the real bot
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_scratch_database(directory)
+        now = datetime.datetime.now()
+
+        conn = connect_database(path)
+        conn.execute('PRAGMA synchronous = FULL')
+        db = Database(conn)
+        items = db.get_item_definitions()
+
+        def run(name, buy, first_message_id):
+            start = time.perf_counter()
+            for i in range(purchases):
+                buy(db, i % 200, first_message_id + i, now, items[i % len(items)])
+            elapsed = time.perf_counter() - start
+            print(f"{name:>7}: {purchases} purchases in {elapsed:.3f}s: {purchases / elapsed:.0f} purchases/s")
+
+        run("before", two_commit_purchase, 1)
+        run("after", lambda db, *args: db.buy_item_discord(*args), purchases + 1)
+        conn.close()
+
+def bench_group_commit(tasks=200, operations=10):
+    """
+    Throughput of many concurrent `givecoin`s through `AsyncDatabase`, with
+    one commit per mutation versus group commit
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = make_scratch_database(directory)
+        now = datetime.datetime.now()
+
+        for group_commit in (False, True):
+            adb = AsyncDatabase(path, group_commit=group_commit)
+            base = 2 * operations if group_commit else 0
+
+            async def worker(n):
+                for i in range(operations):
+                    await adb.give_coins_discord(n % 200, base + i + 1, now, 1)
+
+            async def workload():
+                start = time.perf_counter()
+                await asyncio.gather(*(worker(n) for n in range(tasks)))
+                elapsed = time.perf_counter() - start
+                await adb.aclose()
+                return elapsed
+
+            elapsed = asyncio.run(workload())
+            total = tasks * operations
+            print(f"group_commit={group_commit!s:>5}: {total} givecoins in {elapsed:.3f}s, "
+                  f"{total / elapsed:.0f}/s")
+
+def check_user_state(db, discord_id, starting_coins, cost, bought, used):
+    """
+    Checks that a user's balance, ledger and backpack agree with the number of
+    successful purchases and uses. Returns a list of problems.
+    """
+    balance = db.get_balance_discord(discord_id)
+    ledger = sum(gain.coins for gain in db.get_coin_gains(discord_id))
+    entries = db.get_backpack_view(discord_id)
+    count = entries[0].count if entries else 0
+
+    problems = []
+    if balance != starting_coins - cost * bought:
+        problems.append(f"balance {balance} != {starting_coins} - {cost} * {bought}")
+    if balance < 0:
+        problems.append(f"negative balance {balance}")
+    if ledger != balance:
+        problems.append(f"ledger total {ledger} != balance {balance}")
+    if count != bought - used or count < 0:
+        problems.append(f"backpack has {count}, expected {bought} - {used}")
+    return problems
+
+def bench_stress(rounds=10, buys=50, uses=50, cost=3, starting_coins=100):
+    """
+    Fires concurrent buys and uses at a single user, who can't afford all of
+    them, and checks the books balance afterwards. Exits with an error if
+    anything went wrong.
+    """
+    problems = []
+    for group_commit in (False, True):
+        for round in range(rounds):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "stress.db")
+                adb = AsyncDatabase(path, group_commit=group_commit)
+                now = datetime.datetime.now()
+
+                async def stress():
+                    await adb.register_user(1)
+                    await adb.give_coins_discord(1, 0, now, starting_coins)
+                    await adb.register_item("Thing", "", "https://example.com", cost)
+                    item = await adb.find_item("Thing")
+
+                    results = await asyncio.gather(
+                        *(adb.buy_item_discord(1, i + 1, now, item) for i in range(buys)),
+                        *(adb.use_item_discord(1, item.tid) for _ in range(uses)))
+                    await adb.aclose()
+                    return sum(results[:buys]), sum(results[buys:])
+
+                bought, used = asyncio.run(stress())
+                conn = connect_database(path)
+                for problem in check_user_state(Database(conn), 1, starting_coins, cost, bought, used):
+                    problems.append(f"group_commit={group_commit} round {round}: {problem}")
+                conn.close()
+                if len(adb.user_locks) != 0:
+                    problems.append(f"{len(adb.user_locks)} user locks left behind")
+
+    # Also hammer the same user from several threads with their own
+    # connections, where only SQLite's own locking keeps things consistent
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "stress.db")
+        conn = connect_database(path)
+        migrate_database(conn)
+        db = Database(conn)
+        now = datetime.datetime.now()
+        user_tid, _ = db.register_user(1)
+        db.give_coins(user_tid, 0, now, starting_coins * rounds)
+        db.register_item("Thing", "", "https://example.com", cost)
+        item = db.find_item("Thing")
+
+        def worker(n):
+            thread_db = Database(connect_database(path))
+            bought = used = 0
+            for i in range(buys):
+                bought += thread_db.buy_item(user_tid, n * buys + i + 1, now, item)
+                used += thread_db.use_item(user_tid, item.tid)
+            thread_db.conn.close()
+            return bought, used
+
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(worker, range(8)))
+        bought = sum(b for b, _ in results)
+        used = sum(u for _, u in results)
+        for problem in check_user_state(db, 1, starting_coins * rounds, cost, bought, used):
+            problems.append(f"threads: {problem}")
+        conn.close()
+
+    if problems:
+        print("\n".join(problems))
+        sys.exit(1)
+    print(f"OK: {rounds * 2} async rounds and 8 threads of concurrent buys and uses kept the books balanced")
+
+def bench_sheet_batching(ranges=10, latency=0.1):
+    """
+    Reading several ranges from a fake Google Sheet with simulated network
+    latency, one request per range versus a single `batch_get`, while
+    watching the event loop's lag
+    """
+    tabs = {f"Tab {i}": [[f"user {j}", f"#{j:04}", str(j)] for j in range(1000)]
+            for i in range(ranges)}
+    cells = [f"'Tab {i}'!A1:C" for i in range(ranges)]
+
+    for batched in (False, True):
+        api = FakeSheetsAPI(tabs, latency=latency)
+        sheet = AsyncGoogleSheet(api)
+
+        async def workload():
+            if batched:
+                await sheet.batch_get(cells)
+            else:
+                for cell in cells:
+                    await sheet.fetch(cell)
+
+        elapsed, samples = asyncio.run(measure_lag(workload))
+        report_lag("batch" if batched else "single", elapsed, samples)
+        print(f"{'':>6}  {api.requests} requests for {ranges} ranges")
+        sheet.close()
+
+def bench_sheet_import(rows=50000, items=20, latency=0.05):
+    """
+    Importing a synthetic sheet with `rows` users on each of the backpack and
+    directory tabs from a fake Google Sheet with simulated network latency,
+    at a couple of page sizes, then importing it again when nothing changed
+    """
+    titles = [f"Item {item}" for item in range(items)]
+    backpack = [["Legacy backpack"], ["Name", "Tag", "Coins", *titles]]
+    backpack += [[f"user{i}", f"#{i % 10000:04}", str(i % 1000),
+                  *(str((i + item) % 3) if (i + item) % 5 == 0 else "" for item in range(items))]
+                 for i in range(rows)]
+    # Half of the directory is people who don't have a backpack row
+    directory = [["Legacy directory"], ["", "", "Name", "Tag"]]
+    directory += [["", "", f"user{i}", f"#{i % 10000:04}"] for i in range(rows // 2, rows + rows // 2)]
+    members = {(f"user{i}", f"#{i % 10000:04}"): 10**17 + i for i in range(rows + rows // 2)}
+
+    for page_rows in (1000, 5000):
+        with tempfile.TemporaryDirectory() as directory_path:
+            adb = AsyncDatabase(os.path.join(directory_path, "bench.db"))
+            api = FakeSheetsAPI({"User Backpack": backpack, "User Directory": directory}, latency=latency)
+            importer = SheetImporter(adb, AsyncGoogleSheet(api), page_rows=page_rows)
+            reports = []
+
+            async def workload():
+                for title in titles:
+                    await adb.register_item(title, "", "https://example.com/item.png", 1)
+                reports.append(await importer.run(members))
+
+            for run in ("first", "again"):
+                elapsed, samples = asyncio.run(measure_lag(workload))
+                report = reports[-1]
+                report_lag(run, elapsed, samples)
+                print(f"{'':>6}  page_rows={page_rows}: {report.rows_read} rows in {report.requests} requests, "
+                      f"{report.counts.users_created} users created, "
+                      f"{report.counts.balances_changed} balances changed, "
+                      f"{report.counts.backpack_rows} backpack entries, "
+                      f"{rows * 2 / elapsed:.0f} rows/s")
+            adb.close()
+
+def bench_ledger(users=1000, gains=10**6):
+    """
+    Checking balances against the ledger, adding up every coin gain versus
+    only the ones after each user's checkpoint, for a single user and for an
+    audit of everyone
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        conn = connect_database(os.path.join(directory, "bench.db"))
+        migrate_database(conn)
+        now = datetime.datetime.now()
+        conn.executemany('INSERT INTO users (id, user_id, coins) VALUES (?, ?, ?)',
+                         ((i, str(10**17 + i), gains // users) for i in range(1, users + 1)))
+        conn.executemany('INSERT INTO coin_gains (user_id, date_entered, coins) VALUES (?, ?, 1)',
+                         ((i % users + 1, now) for i in range(gains)))
+        conn.commit()
+        db = Database(conn)
+
+        def full_sum(user_tid):
+            return conn.execute('SELECT SUM(coins) FROM coin_gains WHERE user_id=?', [user_tid]).fetchone()[0]
+
+        def audit():
+            cursor = 0
+            while statuses := db.get_ledger_statuses(cursor, 500):
+                db.checkpoint_ledgers([status.user_tid for status in statuses])
+                cursor = statuses[-1].user_tid
+
+        keys = [(i * 7919) % users + 1 for i in range(1000)]
+        print(f"{gains} coin gains over {users} users")
+        print(f"  one user, full sum:        {time_lookups(full_sum, keys, 2000):8.1f}us")
+        print(f"  one user, no checkpoint:   {time_lookups(db.get_ledger_status, keys, 2000):8.1f}us")
+        start = time.perf_counter()
+        audit()
+        print(f"  first audit (checkpoints everyone): {time.perf_counter() - start:.3f}s")
+
+        # A few new coin gains per user since the checkpoints
+        conn.executemany('INSERT INTO coin_gains (user_id, date_entered, coins) VALUES (?, ?, 1)',
+                         ((i % users + 1, now) for i in range(users * 3)))
+        conn.execute('UPDATE users SET coins = coins + 3')
+        conn.commit()
+        print(f"  one user, from checkpoint: {time_lookups(db.get_ledger_status, keys, 2000):8.1f}us")
+        start = time.perf_counter()
+        audit()
+        print(f"  next audit:                         {time.perf_counter() - start:.3f}s")
+        drifted = [status for status in db.get_ledger_statuses(0, users) if status.drift != 0]
+        print(f"  {len(drifted)} users drifted")
+        conn.close()
+
+def bench_leaderboard(users=10**5, updates=10000):
+    """
+    Top 10 and rank lookups with SQL before and after indexing balances,
+    versus the in-memory `Ranking`, and the cost of keeping the ranking up
+    to date
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        conn = connect_database(os.path.join(directory, "bench.db"))
+        migrate_database(conn, target=4)
+        conn.executemany('INSERT INTO users (id, user_id, coins) VALUES (?, ?, ?)',
+                         ((i, str(10**17 + i), (i * 7919) % 100000) for i in range(1, users + 1)))
+        conn.commit()
+
+        def top_sql(_):
+            return conn.execute('SELECT user_id, coins FROM users ORDER BY coins DESC, id LIMIT 10').fetchall()
+
+        def rank_sql(k):
+            coins = conn.execute('SELECT coins FROM users WHERE id=?', [k]).fetchone()[0]
+            return conn.execute('SELECT COUNT(*) FROM users WHERE coins > ?', [coins]).fetchone()[0] + 1
+
+        keys = [(i * 7919) % users + 1 for i in range(1000)]
+        print(f"{users} users      {'top 10':>10} {'rank':>10}")
+        print(f"  sql, v4 schema {time_lookups(top_sql, keys, 50):8.1f}us {time_lookups(rank_sql, keys, 50):8.1f}us")
+        migrate_database(conn)
+        print(f"  sql, indexed   {time_lookups(top_sql, keys, 2000):8.1f}us {time_lookups(rank_sql, keys, 200):8.1f}us")
+
+        ranking = Ranking()
+        start = time.perf_counter()
+        ranking.load(Database(conn, ranking=ranking).select_rankings())
+        load = time.perf_counter() - start
+        print(f"  ranking        {time_lookups(lambda _: ranking.top(10), keys, 2000):8.1f}us "
+              f"{time_lookups(lambda k: ranking.rank(10**17 + k), keys, 2000):8.1f}us")
+
+        start = time.perf_counter()
+        for i in range(updates):
+            ranking.update([(keys[i % len(keys)], i)])
+        update = (time.perf_counter() - start) / updates * 10**6
+        print(f"  loading the ranking took {load:.3f}s, each balance change {update:.1f}us")
+        conn.close()
+
+def bench_item_search(items=5000):
+    """
+    Exact, prefix and closest-match title lookups in the item catalog, and
+    how long registering and unregistering an item takes with the search
+    index kept up to date
+    """
+    rng = random.Random(0)
+    words = ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9))).title() for _ in range(items // 2)]
+    titles = list({f"{rng.choice(words)} {rng.choice(words)}": None for _ in range(items)})
+    items = len(titles)
+
+    catalog = ItemCatalog()
+    start = time.perf_counter()
+    catalog.load([ItemDefinition(i, title, "", "", 1) for i, title in enumerate(titles)])
+    load = time.perf_counter() - start
+
+    # Typos: the last letter swapped for another
+    keys = [titles[(i * 7919) % items][:-1] + "x" for i in range(1000)]
+    print(f"{items} items")
+    print(f"  exact          {time_lookups(catalog.find, keys, 200):8.1f}us")
+    print(f"  prefix         {time_lookups(lambda k: catalog.complete(k[:4]), keys, 200):8.1f}us")
+    print(f"  closest match  {time_lookups(catalog.suggest, keys, 20):8.1f}us")
+
+    start = time.perf_counter()
+    for i in range(1000):
+        catalog.add(ItemDefinition(items + i, f"New Item {i}", "", "", 1))
+        catalog.remove(f"New Item {i}")
+    update = (time.perf_counter() - start) / 2000 * 10**6
+    print(f"  loading the catalog took {load:.3f}s, each register/unregister {update:.1f}us")
+
+BENCHMARKS = {
+    "loop-lag": bench_loop_lag,
+    "scaling": bench_scaling,
+    "purchases": bench_purchases,
+    "group-commit": bench_group_commit,
+    "stress": bench_stress,
+    "sheet-batching": bench_sheet_batching,
+    "sheet-import": bench_sheet_import,
+    "ledger": bench_ledger,
+    "leaderboard": bench_leaderboard,
+    "item-search": bench_item_search,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print(f"Usage: {sys.argv[0]} <{'|'.join(BENCHMARKS)}>")
+        sys.exit(1)
+
+    BENCHMARKS[sys.argv[1]]()